@@ -1,63 +1,181 @@
 # https_client.py - Client implementation for the HTTPS server
 
+import time
+# startup phases for --profile-startup
+STARTED = time.perf_counter()
+
 import os
 import json
 import base64
 import uuid
-import requests
+import sys
+import hashlib
+import random
+import threading
 import argparse
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+# requests, concurrent.futures and the key exchange parts of cryptography are imported where they are used: a CLI
+# run that sends one message with a cached session needs none of them
+from cryptography.hazmat.primitives.asymmetric import ec, utils
+from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-from tools import load_private_key, load_or_create_client_id, load_token
+from cryptography.exceptions import InvalidTag
+import wire
+from tools import (load_identity, save_identity, load_records, percentile, load_json_file, save_json_file, retry_after,
+                   request_not_sent)
+
+IMPORTED = time.perf_counter()
 
 
 
 class SecureHTTPSClient:
-    def __init__(self, server_url, verify_ssl=True, signing_key_path="private_key.pem", ca_cert_path=None):
+    def __init__(self, server_url, verify_ssl=True, signing_key_path="private_key.pem", ca_cert_path=None, max_connections=10,
+                 wire_format='binary', payload_encoding='json', identity_cache='client_identity.json', compression='zlib',
+                 compress_threshold=1024, light_http=False):
         # Server URL (e.g., https://example.com:5000)
         self.server_url = server_url.rstrip('/')
         self.verify_ssl = ca_cert_path if ca_cert_path else verify_ssl
         
-        if not verify_ssl:
+        if not verify_ssl and not light_http:
             # Suppress insecure request warnings when verify_ssl is False
             import urllib3
             urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
         
-        # Generate client ID
-        self.client_id = load_or_create_client_id()
-        self.token = load_token(str(self.client_id) + '.json')
-        
+        # seconds spent in the slow parts (identity, key_exchange), for --profile-startup
+        self.timings = {}
         
-        # Generate ECDH key pair
-        self.ecdh_private_key = ec.generate_private_key(ec.SECP256R1())
-        self.ecdh_public_key = self.ecdh_private_key.public_key()
-        
-        # Load signing key if provided
-        self.signing_key = None
-        if signing_key_path and os.path.exists(signing_key_path):
-            self.signing_key = load_private_key(signing_key_path)
+        # Client ID, token, signing key and the last session, all from one file (rebuilt when the files they come
+        # from change, see tools.load_identity)
+        start = time.perf_counter()
+        self.identity_cache = identity_cache
+        self.identity, changed = load_identity(identity_cache, signing_key_path)
+        self.client_id = self.identity['client_id']
+        self.token = self.identity['token']
+        self.signing_key = self.identity['signing_key']
+        if changed and identity_cache:
+            self._save_identity()
+        self.timings['identity'] = time.perf_counter() - start
         
         self.server_public_key = None
         self.derived_key = None
+        # session ticket from the server, sent back with every request so it finds our session key even after a restart
+        self.ticket = None
+        
+        # What we would like to use, the key exchange tells us what the server actually supports
+        self.preferred_format = wire_format
+        self.preferred_encoding = payload_encoding
+        self.preferred_compression = compression
+        self.wire_format = 'json'
+        self.payload_encoding = 'json'
+        self.compression = None
+        # smaller messages aren't worth compressing (and zlib may even make them bigger)
+        self.compress_threshold = compress_threshold
+        self._key_exchange_lock = threading.Lock()
+        
+        # the HTTP session is made on first use (see http)
+        self.max_connections = max_connections
+        self.light_http = light_http
+        self._http = None
+        
+        # reuse the session of the last run if it's still good, no key exchange needed then
+        self._resume_session()
+
+    @property
+    def http(self):
+        if self._http is None:
+            if self.light_http:
+                # a message or two from the command line: http.client does it without the import time of requests
+                import simple_http
+                self._http = simple_http.Session()
+            else:
+                import requests
+                from requests.adapters import HTTPAdapter
+                # One keep-alive session for every request, so we pay the TLS handshake once per connection instead of once per message
+                http = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections)
+                http.mount('https://', adapter)
+                http.mount('http://', adapter)
+                self._http = http
+        return self._http
+
+    def _negotiate(self, formats, encodings, compressions):
+        # old servers don't advertise anything and only understand base64 JSON envelopes
+        self.wire_format = self.preferred_format if self.preferred_format in formats else 'json'
+        if self.preferred_encoding in encodings and self.preferred_encoding in wire.available_encodings():
+            self.payload_encoding = self.preferred_encoding
+        else:
+            self.payload_encoding = 'json'
+        if self.preferred_compression in compressions and self.preferred_compression in wire.available_compressions():
+            self.compression = self.preferred_compression
+        else:
+            self.compression = None
+
+    def _save_identity(self):
+        try:
+            save_identity(self.identity_cache, self.identity)
+        except OSError as e:
+            print(f"Could not save the identity cache: {e}")
+
+    def _resume_session(self):
+        cached = self.identity['session']
+        # a minute of margin so the ticket doesn't expire on the way to the server
+        if (not cached or cached.get('server') != self.server_url or not cached.get('ticket')
+                or cached.get('expires', 0) < time.time() + 60):
+            return False
+        self.derived_key = base64.b64decode(cached['key'])
+        self.ticket = cached['ticket']
+        self._negotiate(cached.get('formats', ['json']), cached.get('encodings', ['json']), cached.get('compressions', []))
+        return True
+
+    def _save_session(self, expires, formats, encodings, compressions):
+        if not self.identity_cache or not self.ticket:
+            return
+        self.identity['session'] = {
+            'server': self.server_url,
+            'key': base64.b64encode(self.derived_key).decode(),
+            'ticket': self.ticket,
+            'expires': expires,
+            'formats': formats,
+            'encodings': encodings,
+            'compressions': compressions
+        }
+        self._save_identity()
+
+    def _headers(self):
+        headers = {'X-Client-ID': self.client_id, 'token' : self.token}
+        if self.ticket:
+            headers['X-Session-Ticket'] = self.ticket
+        return headers
 
     def perform_key_exchange(self):
+        start = time.perf_counter()
         try:
-            public_key_pem = self.ecdh_public_key.public_bytes(
+            from cryptography.hazmat.primitives import serialization
+            from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+            # a new ECDH key pair for every key exchange, only made when we actually need one
+            ecdh_private_key = ec.generate_private_key(ec.SECP256R1())
+            public_key_pem = ecdh_private_key.public_key().public_bytes(
                 encoding=serialization.Encoding.PEM,
                 format=serialization.PublicFormat.SubjectPublicKeyInfo
             ).decode()
             
             # Send key exchange request
-            response = requests.post(
-                f"{self.server_url}/api/key_exchange",
-                json={
-                    'client_id': self.client_id,
-                    'public_key': public_key_pem
-                },
-                verify=self.verify_ssl
-            )
+            for attempt in range(4):
+                response = self.http.post(
+                    f"{self.server_url}/api/key_exchange",
+                    json={
+                        'client_id': self.client_id,
+                        'public_key': public_key_pem
+                    },
+                    # the server counts its rate limits by client ID
+                    headers={'X-Client-ID': self.client_id},
+                    verify=self.verify_ssl
+                )
+                # server busy: wait as long as it asks us to and try again
+                delay = retry_after(response.headers.get('Retry-After'))
+                if response.status_code in (429, 503) and delay is not None and attempt < 3:
+                    time.sleep(delay)
+                    continue
+                break
             
             # Check response
             if response.status_code != 200:
@@ -72,7 +190,8 @@ class SecureHTTPSClient:
             )
             
             # Derive shared secret
-            shared_key = self.ecdh_private_key.exchange(ec.ECDH(), self.server_public_key)
+            shared_key = ecdh_private_key.exchange(ec.ECDH(), self.server_public_key)
+            self.ticket = data.get('ticket')
             self.derived_key = HKDF(
                 algorithm=hashes.SHA256(),
                 length=32,
@@ -80,53 +199,103 @@ class SecureHTTPSClient:
                 info=b'handshake data'
             ).derive(shared_key)
             
+            formats = data.get('formats', ['json'])
+            encodings = data.get('encodings', ['json'])
+            compressions = data.get('compressions', [])
+            self._negotiate(formats, encodings, compressions)
+            self._save_session(data.get('ticket_expires', 0), formats, encodings, compressions)
+            
             print(" Key exchange successful")
             return True
             
         except Exception as e:
             print(f"Error during key exchange: {e}")
             return False
+        finally:
+            self.timings['key_exchange'] = self.timings.get('key_exchange', 0.0) + time.perf_counter() - start
 
-    def send_data(self, data, sign=True):
+    def _encrypt(self, data, sign=True):
+        """Encrypts (and signs) data, returns the keyword arguments for the POST request"""
+        encoding = 'json'
+        if isinstance(data, (dict, list)):
+            encoding = self.payload_encoding
+            plaintext = wire.encode_payload(data, encoding)
+        elif isinstance(data, str):
+            plaintext = data.encode('utf-8')
+        else:
+            plaintext = data
+        
+        # Compress before encrypting (encrypted data doesn't compress), only when it actually saves something
+        compression = None
+        payload = plaintext
+        if self.compression and len(plaintext) >= self.compress_threshold:
+            compressed = wire.compress(plaintext, self.compression)
+            if len(compressed) < len(plaintext):
+                compression = self.compression
+                payload = compressed
+        
+        # Generate nonce for AES-GCM
+        nonce = os.urandom(12)
+        # Encrypt the data
+        aesgcm = AESGCM(self.derived_key)
+        ciphertext = aesgcm.encrypt(nonce, payload, None)
+        
+        # Sign the plaintext if requested and signing key is available
+        signature = b''
+        if sign and self.signing_key:
+            signature = self.signing_key.sign(
+                plaintext,
+                ec.ECDSA(hashes.SHA256())
+            )
+        
+        headers = self._headers()
+        if self.wire_format == 'binary':
+            headers['Content-Type'] = wire.CONTENT_TYPE
+            return {'data': wire.pack_envelope(nonce, ciphertext, signature, encoding, compression), 'headers': headers}
+        
+        # Prepare request data
+        request_data = {
+            'nonce': base64.b64encode(nonce).decode(),
+            'ciphertext': base64.b64encode(ciphertext).decode()
+        }
+        if signature:
+            request_data['signature'] = base64.b64encode(signature).decode()
+        if encoding != 'json':
+            request_data['encoding'] = encoding
+        if compression:
+            request_data['compression'] = compression
+        return {'json': request_data, 'headers': headers}
+
+    def _upload(self, path, data, sign=True, retries=3):
         if not self.derived_key:
             if not self.perform_key_exchange():
                 return False
         
         try:
-            if isinstance(data, dict):
-                plaintext = json.dumps(data).encode('utf-8')
-            elif isinstance(data, str):
-                plaintext = data.encode('utf-8')
-            else:
-                plaintext = data
-            
-            # Generate nonce for AES-GCM
-            nonce = os.urandom(12)
-            # Encrypt the data
-            aesgcm = AESGCM(self.derived_key)
-            ciphertext = aesgcm.encrypt(nonce, plaintext, None)
-            
-            # Prepare request data
-            request_data = {
-                'nonce': base64.b64encode(nonce).decode(),
-                'ciphertext': base64.b64encode(ciphertext).decode()
-            }
-            
-            # Sign the plaintext if requested and signing key is available
-            if sign and self.signing_key:
-                signature = self.signing_key.sign(
-                    plaintext,
-                    ec.ECDSA(hashes.SHA256())
+            rekeyed = False
+            for attempt in range(retries + 1):
+                key = self.derived_key
+                request_data = self._encrypt(data, sign)
+                
+                # Send the request
+                response = self.http.post(
+                    f"{self.server_url}{path}",
+                    verify=self.verify_ssl,
+                    **request_data
                 )
-                request_data['signature'] = base64.b64encode(signature).decode()
-            
-            # Send the request
-            response = requests.post(
-                f"{self.server_url}/api/upload",
-                json=request_data,
-                headers={'X-Client-ID': self.client_id, 'token' : self.token},
-                verify=self.verify_ssl
-            )
+                # our cached session is gone (expired ticket, server without tickets restarted...): handshake once and resend
+                if response.status_code == 401 and 'Invalid or missing client ID' in response.text and not rekeyed:
+                    rekeyed = True
+                    if not self._ensure_session(stale_key=key):
+                        return False
+                    continue
+                # server busy: wait as long as it asks us to and send again
+                delay = retry_after(response.headers.get('Retry-After'))
+                if response.status_code in (429, 503) and delay is not None and attempt < retries:
+                    print(f"Server busy, retrying in {delay:.0f}s")
+                    time.sleep(delay)
+                    continue
+                break
             
             # Check response
             if response.status_code != 200:
@@ -140,25 +309,358 @@ class SecureHTTPSClient:
             print(f"Error sending data: {e}")
             return False
 
-    
+    def send_data(self, data, sign=True):
+        return self._upload('/api/upload', data, sign)
+
+    def send_batch(self, records, sign=True):
+        # all records travel in one envelope with one signature, the server answers with a status per record
+        return self._upload('/api/upload_batch', {'records': list(records)}, sign)
+
+    def _ensure_session(self, stale_key=None):
+        # several worker threads may notice a missing session at the same time, only one of them does the handshake
+        with self._key_exchange_lock:
+            if self.derived_key and self.derived_key != stale_key:
+                return True
+            self.derived_key = None
+            return self.perform_key_exchange()
+
+    def _send_with_retry(self, path, data, sign=True, retries=3, backoff=0.5):
+        """Quiet upload used by send_many. Returns (ok, status code, latency of the successful attempt)"""
+        status = None
+        delay = None
+        for attempt in range(retries + 1):
+            if attempt:
+                if delay is not None:
+                    # the server told us how long to wait (Retry-After)
+                    time.sleep(delay)
+                else:
+                    # exponential backoff with some jitter so the workers don't retry in lockstep
+                    time.sleep(backoff * (2 ** (attempt - 1)) * (0.5 + random.random()))
+                delay = None
+            key = self.derived_key
+            if not key and not self._ensure_session():
+                continue
+            start = time.perf_counter()
+            try:
+                response = self.http.post(
+                    f"{self.server_url}{path}",
+                    verify=self.verify_ssl,
+                    **self._encrypt(data, sign)
+                )
+            except OSError as e:
+                # requests' errors are OSErrors too. Only resend what never reached the server: after a read
+                # timeout or a connection dropped mid-answer the record may be stored already
+                if request_not_sent(e):
+                    continue
+                return False, None, None
+            latency = time.perf_counter() - start
+            status = response.status_code
+            if status == 200:
+                return True, status, latency
+            delay = retry_after(response.headers.get('Retry-After'))
+            if status == 401 and 'Invalid or missing client ID' in response.text:
+                # the server lost our session (restart or cleanup), handshake again and retry
+                self._ensure_session(stale_key=key)
+                continue
+            # an upload isn't idempotent: a 500 may come after the record was stored, only retry what the
+            # server refused before doing anything (rate limit, overload)
+            if status in (429, 503):
+                continue
+            # anything else (bad token, malformed data...) won't get better by retrying
+            return False, status, latency
+        return False, status, None
+
+    def send_many(self, records, workers=8, sign=True, retries=3, backoff=0.5, path='/api/upload'):
+        """Send an iterable of records over the keep-alive session using a pool of worker threads.
+        Records are pulled from the iterable as workers free up, so big files are never loaded at once.
+        Returns a report with counts, throughput and latency percentiles."""
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        if not self.derived_key and not self._ensure_session():
+            return False
+
+        latencies = []
+        sent = failed = 0
+        errors = {}
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = set()
+            records = iter(records)
+            while True:
+                # keep a couple of records queued per worker, no more
+                for record in records:
+                    pending.add(pool.submit(self._send_with_retry, path, record, sign, retries, backoff))
+                    if len(pending) >= workers * 2:
+                        break
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    ok, status, latency = future.result()
+                    if ok:
+                        sent += 1
+                        latencies.append(latency)
+                    else:
+                        failed += 1
+                        errors[status] = errors.get(status, 0) + 1
+        elapsed = time.perf_counter() - start
+
+        latencies.sort()
+        return {
+            'sent': sent,
+            'failed': failed,
+            'errors': errors,
+            'elapsed': elapsed,
+            'throughput': sent / elapsed if elapsed else 0.0,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+        }
+
+    def _stream_request(self, method, path, json=None, build=None, retries=5, backoff=0.5):
+        # small retry loop for the streaming upload, chunks are idempotent on the server so resending is safe
+        response = None
+        delay = None
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(delay if delay is not None else backoff * (2 ** (attempt - 1)))
+                delay = None
+            key = self.derived_key
+            if not key and not self._ensure_session():
+                continue
+            try:
+                response = self.http.request(
+                    method,
+                    f"{self.server_url}{path}",
+                    json=json,
+                    # chunks are encrypted with the session key, so they are built again on every attempt
+                    data=build() if build else None,
+                    headers=self._headers(),
+                    verify=self.verify_ssl
+                )
+            except OSError:
+                continue
+            if response.status_code == 401 and 'Invalid or missing client ID' in response.text:
+                # the server lost our session (restart or cleanup), handshake again and retry
+                self._ensure_session(stale_key=key)
+                continue
+            if response.status_code == 429 or response.status_code >= 500:
+                delay = retry_after(response.headers.get('Retry-After'))
+                continue
+            return response
+        return response
+
+    def send_file(self, path, sign=True, resume=True, state_file='uploads_in_progress.json'):
+        """Upload a file of any size in encrypted chunks, with constant memory on both sides.
+        If a previous upload of the same (unchanged) file was interrupted, it continues from the last acknowledged chunk."""
+        st = os.stat(path)
+        file_key = os.path.abspath(path)
+        fingerprint = [st.st_size, st.st_mtime_ns]
+        uploads = load_json_file(state_file) if resume else {}
+        previous = uploads.get(file_key)
+        upload_id = previous['upload_id'] if previous and previous['fingerprint'] == fingerprint else None
+
+        response = self._stream_request('POST', '/api/stream/start',
+                                        json={'filename': os.path.basename(path), 'upload_id': upload_id,
+                                              'size': st.st_size})
+        if response is None or response.status_code != 200:
+            print(f"Upload failed: {response.text if response is not None else 'server unreachable'}")
+            return False
+        status = response.json()
+        upload_id = status['upload_id']
+        chunk_size = status['chunk_size']
+        index = status['next_chunk']
+        if resume:
+            uploads[file_key] = {'upload_id': upload_id, 'fingerprint': fingerprint}
+            save_json_file(state_file, uploads)
+        if index:
+            print(f"Resuming upload at chunk {index}")
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            # the signature covers the whole file, so the part the server already has still goes through the hash
+            for _ in range(index):
+                digest.update(f.read(chunk_size))
+            sent = index * chunk_size
+            while True:
+                chunk = f.read(chunk_size)
+                sent += len(chunk)
+                final = sent >= st.st_size
+                digest.update(chunk)
+                signature = b''
+                if final and sign and self.signing_key:
+                    signature = self.signing_key.sign(digest.digest(), ec.ECDSA(utils.Prehashed(hashes.SHA256())))
+
+                def build(chunk=chunk, index=index, final=final, signature=signature):
+                    nonce = os.urandom(wire.NONCE_SIZE)
+                    ciphertext = AESGCM(self.derived_key).encrypt(nonce, chunk, wire.chunk_aad(upload_id, index, final))
+                    return wire.pack_chunk(nonce, ciphertext, final, signature)
+
+                response = self._stream_request('PUT', f'/api/stream/{upload_id}/{index}', build=build)
+                if response is None or response.status_code != 200:
+                    # keep the state file, the next run picks up from here
+                    print(f"Upload interrupted at chunk {index}: {response.text if response is not None else 'server unreachable'}")
+                    return False
+                index += 1
+                if final:
+                    break
+
+        if resume:
+            uploads = load_json_file(state_file)
+            uploads.pop(file_key, None)
+            save_json_file(state_file, uploads)
+        print(f"File sent successfully ({sent} bytes in {index} chunks)")
+        return response.json()
+
+    def _read_page(self, params):
+        """Yields the records of one page of GET /api/records, then the cursor of the next page (None at the end)"""
+        request_id = uuid.uuid4().hex
+        for attempt in range(2):
+            key = self.derived_key
+            if not key and not self._ensure_session():
+                raise ConnectionError('Key exchange failed')
+            response = self.http.get(
+                f"{self.server_url}/api/records",
+                params=dict(params, request_id=request_id),
+                headers=self._headers(),
+                verify=self.verify_ssl,
+                stream=True
+            )
+            if response.status_code == 401 and 'Invalid or missing client ID' in response.text and not attempt:
+                # the server lost our session (restart or cleanup), handshake again and retry
+                self._ensure_session(stale_key=key)
+                continue
+            break
+        if response.status_code != 200:
+            raise ConnectionError(f"Read failed: {response.text}")
+
+        aesgcm = AESGCM(key)
+        with response:
+            # chunk i must be the i-th one of this response, and the last one must say so, else something was cut or swapped
+            for index, line in enumerate(response.iter_lines()):
+                chunk = json.loads(line)
+                if chunk['index'] != index:
+                    raise ValueError(f"Chunk {chunk['index']} where chunk {index} was expected")
+                try:
+                    plaintext = aesgcm.decrypt(base64.b64decode(chunk['nonce']), base64.b64decode(chunk['ciphertext']),
+                                               wire.read_chunk_aad(request_id, index, chunk['final']))
+                except InvalidTag:
+                    raise ValueError(f"Chunk {index} failed authentication")
+                body = json.loads(plaintext)
+                yield from body['records']
+                if chunk['final']:
+                    yield body['next']
+                    return
+        raise ValueError('Incomplete response, the last chunk is missing')
+
+    def read_records(self, date_from=None, date_to=None, updated_since=None, page_size=100):
+        """Yields the records this client stored on the server (optionally only some dates, or the ones changed since
+        updated_since), following the pages as it goes. Dates are strings like 2025-04-19 or 2025-04-19 21:56:24"""
+        params = {'limit': page_size}
+        for name, value in (('date_from', date_from), ('date_to', date_to), ('updated_since', updated_since)):
+            if value:
+                params[name] = str(value)
+        while True:
+            next_cursor = None
+            for item in self._read_page(params):
+                if isinstance(item, dict):
+                    yield item
+                else:
+                    next_cursor = item
+            if not next_cursor:
+                return
+            params['after'] = next_cursor
+
 
 def main():
     
     parser = argparse.ArgumentParser(description='Secure HTTPS client for file transfer')
     parser.add_argument('--server', default='https://localhost:5000', help='Server URL')
     parser.add_argument('--no-verify', action='store_true', help='Disable SSL verification')
-    parser.add_argument('message', help='JSON message to send')
+    parser.add_argument('--file', help='Send every record of a JSONL or CSV file (e.g. ../test/payloads.txt)')
+    parser.add_argument('--workers', type=int, default=8, help='Concurrent senders when using --file')
+    parser.add_argument('--retries', type=int, default=3, help='Retries per record when using --file')
+    parser.add_argument('--send-file', help='Upload a file of any size in encrypted chunks (resumes interrupted uploads)')
+    parser.add_argument('--json-envelope', action='store_true', help='Use the base64 JSON envelope instead of the binary one')
+    parser.add_argument('--encoding', default='json', choices=['json', 'msgpack', 'cbor'], help='Serialization of the message (msgpack/cbor need the library installed)')
+    parser.add_argument('--read', action='store_true', help='Print the records this client stored on the server (one JSON per line)')
+    parser.add_argument('--date-from', help='With --read, only records from this date (YYYY-MM-DD)')
+    parser.add_argument('--date-to', help='With --read, only records up to this date (YYYY-MM-DD)')
+    parser.add_argument('--updated-since', help='With --read, only records changed since this time (YYYY-MM-DD HH:MM:SS)')
+    parser.add_argument('--compression', default='zlib', choices=['zlib', 'zstd', 'none'], help='Compress messages before encrypting them (zstd needs the zstandard library)')
+    parser.add_argument('--compress-threshold', type=int, default=1024, help='Only compress messages of at least this many bytes')
+    parser.add_argument('--profile-startup', action='store_true', help='Print the time spent in each startup phase (to stderr)')
+    parser.add_argument('message', nargs='?', help='JSON message to send (a JSON list is sent as a batch)')
     args = parser.parse_args()
     
+    if not args.file and not args.send_file and not args.read and args.message is None:
+        parser.error('a message, --file, --send-file or --read is required')
+    
     ca_cert_path = 'cert.pem' if not args.no_verify else False
-    client = SecureHTTPSClient(args.server, verify_ssl=ca_cert_path)
+    # one message doesn't need requests, see simple_http.py
+    one_shot = not (args.file or args.send_file or args.read)
+    client = SecureHTTPSClient(args.server, verify_ssl=ca_cert_path, max_connections=args.workers,
+                               wire_format='json' if args.json_envelope else 'binary', payload_encoding=args.encoding,
+                               compression=None if args.compression == 'none' else args.compression,
+                               compress_threshold=args.compress_threshold, light_http=one_shot)
+    started = time.perf_counter()
+    try:
+        run(args, client)
+    finally:
+        if args.profile_startup:
+            print_profile(client, started)
+
+
+def print_profile(client, started):
+    # imports: from the start of this module (the interpreter's own startup isn't counted), identity: the identity
+    # cache, setup: arguments and the rest of the client, key_exchange: only if there was no usable session,
+    # send: the rest of the request(s)
+    finished = time.perf_counter()
+    key_exchange = client.timings.get('key_exchange', 0.0)
+    phases = [
+        ('imports', IMPORTED - STARTED),
+        ('identity', client.timings['identity']),
+        ('setup', started - IMPORTED - client.timings['identity']),
+        ('key_exchange', key_exchange),
+        ('send', finished - started - key_exchange),
+    ]
+    for name, seconds in phases:
+        print(f"{name:<14}{seconds * 1000:8.1f} ms", file=sys.stderr)
+    print(f"{'total':<14}{(finished - STARTED) * 1000:8.1f} ms", file=sys.stderr)
+
+
+def run(args, client):
+    if args.send_file:
+        client.send_file(args.send_file)
+        return
+    
+    if args.read:
+        try:
+            for record in client.read_records(args.date_from, args.date_to, args.updated_since):
+                print(json.dumps(record))
+        except (ConnectionError, ValueError) as e:
+            print(e)
+        return
+    
+    if args.file:
+        report = client.send_many(load_records(args.file), workers=args.workers, retries=args.retries)
+        if report:
+            print(f"{report['sent']} sent, {report['failed']} failed in {report['elapsed']:.2f}s "
+                  f"({report['throughput']:.1f} msg/s, p50 {report['p50'] * 1000:.1f} ms, p99 {report['p99'] * 1000:.1f} ms)")
+            if report['errors']:
+                print(f"Failures by status code: {report['errors']}")
+        return
     
     try:
         message = json.loads(args.message)
     except json.JSONDecodeError:
         message = args.message
     
-    client.send_data(message)
+    # a JSON list is sent as one batch
+    if isinstance(message, list):
+        result = client.send_batch(message)
+        if result:
+            print(f"{result['saved']} saved, {result['failed']} failed")
+    else:
+        client.send_data(message)
     
 
 if __name__ == "__main__":
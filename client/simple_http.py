@@ -0,0 +1,121 @@
+# simple_http.py - Just enough of requests.Session on top of http.client for one-shot CLI runs
+# Importing requests (urllib3, certifi, idna, charset detection...) takes longer than sending a message, and scripts
+# that call https_client.py in a loop pay it on every call. A single message only needs a POST (two with a key
+# exchange), so the CLI uses this for those and requests for everything else (--file, --read, --send-file).
+#
+# Only what SecureHTTPSClient uses is there: post/get/request with json, data, params and headers, one keep-alive
+# connection per server, and responses with status_code, headers, content, text and json().
+# A request is only sent again (on a new connection) when the kept-alive one failed while we were sending it. Once it
+# is out a lost answer is an error: the server may already have stored the upload.
+
+import http.client
+from json import dumps, loads
+from urllib.parse import urlsplit, urlencode
+
+
+class RequestException(OSError):
+    # an OSError like the requests ones, so the same except clauses catch both
+    # not_sent: the failure happened before the request left (connect, DNS, sending), resending it is safe
+    not_sent = False
+
+
+class ConnectError(RequestException):
+    not_sent = True
+
+
+class Response:
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return loads(self.content)
+
+
+def _ssl_context(verify):
+    import ssl
+    if verify is False:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        return context
+    # a path is the CA certificate to trust (cert.pem), like verify= in requests
+    return ssl.create_default_context(cafile=verify if isinstance(verify, str) else None)
+
+
+class Session:
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self._connections = {}
+
+    def _connection(self, scheme, netloc, verify):
+        """(connection, True if it was used before)"""
+        conn = self._connections.get((scheme, netloc))
+        if conn is not None:
+            return conn, True
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(netloc, timeout=self.timeout, context=_ssl_context(verify))
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        self._connections[(scheme, netloc)] = conn
+        return conn, False
+
+    def request(self, method, url, params=None, data=None, json=None, headers=None, verify=True, **kwargs):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        if params:
+            path += ('&' if parts.query else '?') + urlencode(params)
+        headers = dict(headers or {})
+        if json is not None:
+            data = dumps(json).encode()
+            headers.setdefault('Content-Type', 'application/json')
+        elif isinstance(data, str):
+            data = data.encode()
+
+        conn, reused = self._connection(parts.scheme, parts.netloc, verify)
+        try:
+            self._send(conn, method, path, data, headers)
+        except (ConnectionResetError, BrokenPipeError) as e:
+            if not reused:
+                raise ConnectError(str(e)) from e
+            # the server closed the kept-alive connection before our request got there, send it on a new one
+            try:
+                self._send(conn, method, path, data, headers)
+            except (OSError, http.client.HTTPException) as e:
+                raise ConnectError(str(e)) from e
+        except (OSError, http.client.HTTPException) as e:
+            raise ConnectError(str(e)) from e
+        # once the request is out the server may have acted on it (an upload isn't idempotent): whatever goes
+        # wrong from here is for the caller to decide, it is never sent again here
+        try:
+            response = conn.getresponse()
+            return Response(response.status, response.headers, response.read())
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            raise RequestException(str(e)) from e
+
+    def _send(self, conn, method, path, data, headers):
+        # connects if needed and sends the whole request, a failure here means the server didn't get all of it
+        try:
+            conn.request(method, path, body=data, headers=headers)
+        except BaseException:
+            conn.close()
+            raise
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        for conn in self._connections.values():
+            conn.close()
+        self._connections.clear()
@@ -1,11 +1,12 @@
 import os
 import hashlib
 import base64
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives import serialization
+# the cryptography imports are in the functions, the CLI only pays for them when it needs them
 import os
 import json
 import uuid
+import csv
+import math
 
 def load_or_create_client_id(path='client_id.json'):
     if os.path.exists(path):
@@ -24,12 +25,14 @@ def load_token(path):
         return ''
 
 
-def generate_key_pair(curve=ec.SECP256R1):
-    private_key = ec.generate_private_key(curve())
+def generate_key_pair(curve=None):
+    from cryptography.hazmat.primitives.asymmetric import ec
+    private_key = ec.generate_private_key((curve or ec.SECP256R1)())
     public_key = private_key.public_key()
     return private_key, public_key
 
 def save_keys(private_key, public_key, c_id, private_filename="private_key.pem"):
+    from cryptography.hazmat.primitives import serialization
     # Save private key
     public_filename = c_id + '_public_key.pem'
     with open(private_filename, "wb") as f:
@@ -47,15 +50,160 @@ def save_keys(private_key, public_key, c_id, private_filename="private_key.pem")
         ))
 
 def load_private_key(filename="private_key.pem", password=None):
+    from cryptography.hazmat.primitives import serialization
     with open(filename, "rb") as f:
         return serialization.load_pem_private_key(f.read(), password=password)
 
 def load_public_key(filename="public_key.pem"):
+    from cryptography.hazmat.primitives import serialization
     with open(filename, "rb") as f:
         return serialization.load_pem_public_key(f.read())
 
+def _csv_value(value):
+    # CSV only has strings, turn numbers back into numbers so they match what a JSON payload would carry
+    try:
+        parsed = json.loads(value)
+    except ValueError:
+        return value
+    return parsed if isinstance(parsed, (int, float)) else value
+
+def load_records(path):
+    # Yields one record at a time from a JSONL (one JSON object per line) or CSV file (header row = keys)
+    with open(path, 'r', newline='') as f:
+        if path.lower().endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield {key: _csv_value(value) for key, value in row.items()}
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+def percentile(sorted_values, pct):
+    # nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+def request_not_sent(error):
+    # True if a transport error happened before the request left us (connect, DNS), so sending it again can't
+    # store anything twice. A timeout or a dropped connection while waiting for the answer doesn't count
+    if hasattr(error, 'not_sent'):
+        # simple_http knows
+        return error.not_sent
+    import requests
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        from urllib3.exceptions import NewConnectionError
+        # urllib3 wraps connect and DNS failures (NameResolutionError is a NewConnectionError) in MaxRetryError
+        reason = getattr(error.args[0] if error.args else None, 'reason', None)
+        return isinstance(reason, NewConnectionError)
+    return False
+
+def load_json_file(path):
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {}
+
+def save_json_file(path, data, mode=0o644):
+    tmp = path + '.tmp'
+    # mode=0o600 for files with secrets in them, the permissions are set before anything is written
+    with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def retry_after(value, limit=60):
+    # seconds to wait from a Retry-After header (a number of seconds or an HTTP date), None if there isn't one
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        # dates are rare, the email package is only imported for them
+        from email.utils import parsedate_to_datetime
+        from datetime import datetime, timezone
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return max(0.0, min(limit, seconds))
+
+def _file_stamp(path):
+    # size and modification time, enough to notice that a file was replaced or edited
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+def _signing_key_from_cache(cached):
+    from cryptography.hazmat.primitives.asymmetric import ec
+    return ec.derive_private_key(int(cached['private_value'], 16), getattr(ec, cached['curve'].upper())())
+
+def _signing_key_for_cache(key):
+    from cryptography.hazmat.primitives.asymmetric import ec
+    if not isinstance(key, ec.EllipticCurvePrivateKey) or not hasattr(ec, key.curve.name.upper()):
+        return None
+    return {'curve': key.curve.name, 'private_value': format(key.private_numbers().private_value, 'x')}
+
+def _identity_sources(client_id_path, client_id, signing_key_path):
+    sources = {client_id_path: _file_stamp(client_id_path), f'{client_id}.json': _file_stamp(f'{client_id}.json')}
+    if signing_key_path:
+        sources[signing_key_path] = _file_stamp(signing_key_path)
+    return sources
+
+def load_identity(cache_path, signing_key_path='private_key.pem', client_id_path='client_id.json'):
+    """Client ID, token, signing key and the last session in one read of the identity cache.
+    The cache remembers the size and mtime of the files it was built from, if one of them changed (new key, new
+    token...) it is built again from the files. Returns (identity, True if the cache has to be saved)"""
+    try:
+        cached = load_json_file(cache_path) if cache_path else {}
+    except (OSError, ValueError):
+        # unreadable or half written, built again below
+        cached = {}
+    client_id = cached.get('client_id')
+    if client_id and 'token' in cached:
+        sources = _identity_sources(client_id_path, client_id, signing_key_path)
+        has_key = bool(signing_key_path and sources[signing_key_path])
+        # a key that can't be cached (signing_key None while the file is there) is read from the file every time
+        if cached.get('sources') == sources and bool(cached.get('signing_key')) == has_key:
+            return {
+                'client_id': client_id,
+                'token': cached['token'],
+                'signing_key': _signing_key_from_cache(cached['signing_key']) if has_key else None,
+                'session': cached.get('session'),
+                'sources': sources,
+            }, False
+
+    client_id = load_or_create_client_id(client_id_path)
+    signing_key = None
+    if signing_key_path and os.path.exists(signing_key_path):
+        signing_key = load_private_key(signing_key_path)
+    return {
+        'client_id': client_id,
+        'token': load_token(client_id + '.json'),
+        'signing_key': signing_key,
+        # the session belongs to the client ID it was made for
+        'session': cached.get('session') if cached.get('client_id') == client_id else None,
+        'sources': _identity_sources(client_id_path, client_id, signing_key_path),
+    }, True
+
+def save_identity(cache_path, identity):
+    key = identity['signing_key']
+    # the token, the signing key and the session key are in there, only we can read it
+    save_json_file(cache_path, {
+        'client_id': identity['client_id'],
+        'token': identity['token'],
+        # not every key can be cached (RSA...), those are read from their PEM file every time
+        'signing_key': _signing_key_for_cache(key) if key is not None else None,
+        'session': identity['session'],
+        'sources': identity['sources'],
+    }, mode=0o600)
+
 if __name__ == "__main__":
     c_id = load_or_create_client_id()
     private_key, public_key = generate_key_pair()
     save_keys(private_key, public_key, c_id)
-   
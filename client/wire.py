@@ -0,0 +1,193 @@
+# wire.py - Binary envelope and payload encodings shared by client and server
+# (keep the client and server copies of this file identical)
+#
+# The JSON envelope base64-encodes nonce, ciphertext and signature, which makes every message about a third bigger
+# and costs a few copies on each side. The binary envelope sends the raw bytes instead:
+#
+#   version (1 byte) | payload encoding (1) | flags (1) | nonce length (1) | signature length (2, big endian)
+#   nonce | signature | ciphertext
+#
+# with Content-Type: application/octet-stream. The payload encoding says how the plaintext is serialized
+# (JSON by default, MessagePack or CBOR if the library is installed). The low two bits of flags say how the
+# plaintext was compressed before it was encrypted (0 = not compressed, 1 = zlib, 2 = zstd), the other bits must be 0.
+# The signature is always made over the uncompressed plaintext.
+
+import json
+import zlib
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CONTENT_TYPE = 'application/octet-stream'
+VERSION = 1
+HEADER = struct.Struct('!BBBBH')
+
+ENCODINGS = {'json': 0, 'msgpack': 1, 'cbor': 2}
+ENCODING_NAMES = {value: name for name, value in ENCODINGS.items()}
+
+COMPRESSIONS = {'zlib': 1, 'zstd': 2}
+COMPRESSION_NAMES = {value: name for name, value in COMPRESSIONS.items()}
+
+
+class EnvelopeError(ValueError):
+    pass
+
+
+def available_encodings():
+    encodings = ['json']
+    if msgpack is not None:
+        encodings.append('msgpack')
+    if cbor2 is not None:
+        encodings.append('cbor')
+    return encodings
+
+def available_compressions():
+    compressions = ['zlib']
+    if zstandard is not None:
+        compressions.append('zstd')
+    return compressions
+
+def compress(plaintext, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(plaintext)
+    return zlib.compress(plaintext, 6)
+
+def decompress(data, compression, max_size):
+    """Uncompresses data, raises ValueError if it would be bigger than max_size bytes (a decompression bomb)"""
+    if compression == 'zlib':
+        decompressor = zlib.decompressobj()
+        try:
+            plaintext = decompressor.decompress(data, max_size + 1)
+        except zlib.error as e:
+            raise ValueError(str(e))
+        if len(plaintext) > max_size or decompressor.unconsumed_tail:
+            raise ValueError(f'Decompressed payload bigger than {max_size} bytes')
+        if not decompressor.eof:
+            raise ValueError('Truncated compressed payload')
+        return plaintext
+    if compression == 'zstd' and zstandard is not None:
+        # read through a stream so a lying frame header can't make us allocate more than max_size
+        try:
+            # read() can return less than asked for (one frame, one block...), keep going until the end or the limit
+            chunks = []
+            size = 0
+            with zstandard.ZstdDecompressor().stream_reader(bytes(data)) as reader:
+                while size <= max_size:
+                    chunk = reader.read(max_size + 1 - size)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                    size += len(chunk)
+        except zstandard.ZstdError as e:
+            raise ValueError(str(e))
+        if size > max_size:
+            raise ValueError(f'Decompressed payload bigger than {max_size} bytes')
+        return b''.join(chunks)
+    raise ValueError(f'Unsupported compression {compression}')
+
+def encode_payload(data, encoding='json'):
+    if encoding == 'msgpack':
+        return msgpack.packb(data, use_bin_type=True)
+    if encoding == 'cbor':
+        return cbor2.dumps(data)
+    return json.dumps(data).encode('utf-8')
+
+def decode_payload(plaintext, encoding='json'):
+    """Turns the decrypted bytes back into Python objects, raises ValueError if they can't be decoded"""
+    try:
+        if encoding == 'msgpack' and msgpack is not None:
+            return msgpack.unpackb(plaintext, raw=False)
+        if encoding == 'cbor' and cbor2 is not None:
+            return cbor2.loads(plaintext)
+        if encoding == 'json':
+            return json.loads(plaintext)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(str(e))
+    raise ValueError(f'Unsupported payload encoding {encoding}')
+
+def pack_envelope(nonce, ciphertext, signature=b'', encoding='json', compression=None):
+    flags = COMPRESSIONS[compression] if compression else 0
+    header = HEADER.pack(VERSION, ENCODINGS[encoding], flags, len(nonce), len(signature))
+    return b''.join((header, nonce, signature, ciphertext))
+
+def unpack_envelope(body):
+    """Splits a binary envelope without copying it: nonce, signature and ciphertext are memoryviews of body"""
+    view = memoryview(body)
+    if len(view) < HEADER.size:
+        raise EnvelopeError('Envelope too short')
+    version, encoding, flags, nonce_len, sig_len = HEADER.unpack_from(view)
+    if version != VERSION:
+        raise EnvelopeError(f'Unsupported envelope version {version}')
+    if encoding not in ENCODING_NAMES:
+        raise EnvelopeError(f'Unsupported payload encoding {encoding}')
+    if flags and flags not in COMPRESSION_NAMES:
+        raise EnvelopeError(f'Unsupported envelope flags {flags}')
+    start = HEADER.size
+    if len(view) < start + nonce_len + sig_len:
+        raise EnvelopeError('Envelope too short')
+    nonce = view[start:start + nonce_len]
+    signature = view[start + nonce_len:start + nonce_len + sig_len]
+    ciphertext = view[start + nonce_len + sig_len:]
+    return {
+        'nonce': nonce,
+        'signature': signature,
+        'ciphertext': ciphertext,
+        'encoding': ENCODING_NAMES[encoding],
+        'compression': COMPRESSION_NAMES.get(flags),
+    }
+
+
+# Streaming uploads send a file as a series of chunks, each one its own AES-GCM message:
+#
+#   version (1 byte) | flags (1, bit 0 = last chunk) | signature length (2, big endian) | nonce (12) | signature | ciphertext
+#
+# The upload id, the chunk index and the last chunk flag are authenticated as associated data, so chunks can't be
+# reordered, moved to another upload or cut short without the decryption failing. Only the last chunk carries
+# a signature, made over the SHA-256 of the whole file.
+
+CHUNK_HEADER = struct.Struct('!BBH')
+CHUNK_VERSION = 1
+CHUNK_FINAL = 0x01
+NONCE_SIZE = 12
+
+def chunk_aad(upload_id, index, final):
+    return upload_id.encode() + struct.pack('!Q?', index, final)
+
+def read_chunk_aad(request_id, index, final):
+    # the chunks of GET /api/records (see records.py on the server) are authenticated the same way
+    return b'read:' + chunk_aad(request_id, index, final)
+
+def pack_chunk(nonce, ciphertext, final=False, signature=b''):
+    header = CHUNK_HEADER.pack(CHUNK_VERSION, CHUNK_FINAL if final else 0, len(signature))
+    return b''.join((header, nonce, signature, ciphertext))
+
+def unpack_chunk(body):
+    """Returns (final, nonce, signature, ciphertext), the last three as memoryviews of body"""
+    view = memoryview(body)
+    if len(view) < CHUNK_HEADER.size + NONCE_SIZE:
+        raise EnvelopeError('Chunk too short')
+    version, flags, sig_len = CHUNK_HEADER.unpack_from(view)
+    if version != CHUNK_VERSION:
+        raise EnvelopeError(f'Unsupported chunk version {version}')
+    start = CHUNK_HEADER.size
+    if len(view) < start + NONCE_SIZE + sig_len:
+        raise EnvelopeError('Chunk too short')
+    nonce = view[start:start + NONCE_SIZE]
+    signature = view[start + NONCE_SIZE:start + NONCE_SIZE + sig_len]
+    ciphertext = view[start + NONCE_SIZE + sig_len:]
+    return bool(flags & CHUNK_FINAL), nonce, signature, ciphertext
@@ -0,0 +1,129 @@
+# admission.py - Admission control for /api/upload, /api/upload_batch and /api/key_exchange
+# Without it every client shares the server equally: one client looping send_data (or retrying failed uploads)
+# can take every worker thread and every database connection while the others time out. Before anything
+# expensive runs (reading the body, PBKDF2, ECDH, AES-GCM) a request has to get past two checks:
+#
+#   - a token bucket per client (the X-Client-ID header, the remote address without one): CLIENT_RATE uploads and
+#     KEY_EXCHANGE_RATE key exchanges per second, with some burst. Over it: 429 with Retry-After, the time until
+#     the bucket has a token again.
+#   - a cap on the requests being served at once (MAX_INFLIGHT). Key exchanges and clients that used up more than
+#     half of their bucket are low priority and only get LOW_PRIORITY_SHARE of the cap, so under overload they are
+#     shed first and the clients sending now and then keep their latency. Over it: 503 with Retry-After.
+#
+# Both are per worker process. Refusing costs a dict lookup and a few additions under a lock.
+
+import math
+import time
+import threading
+from collections import OrderedDict
+
+
+class TokenBuckets:
+    """One token bucket per key, refilled at rate tokens per second up to burst. Only the most recently seen
+    max_entries keys are remembered, a forgotten key starts again with a full bucket"""
+
+    def __init__(self, rate, burst, max_entries=100000):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()   # key -> [tokens, time of the last refill]
+        self._lock = threading.Lock()
+
+    def _bucket(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            while len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def take(self, key, cost=1.0):
+        """Takes cost tokens from the bucket of key. Returns (0, level after) if there were enough, else
+        (seconds until there are, level). The level is the part of the burst left, 0 to 1"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._bucket(key, now)
+            if bucket[0] < cost:
+                return (cost - bucket[0]) / self.rate, bucket[0] / self.burst
+            bucket[0] -= cost
+            return 0, bucket[0] / self.burst
+
+    def give_back(self, key, cost=1.0):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + cost)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class Admission:
+    def __init__(self, max_inflight=64, low_priority_share=0.75, client_rate=100.0, client_burst=200.0,
+                 key_exchange_rate=2.0, key_exchange_burst=10.0, max_clients=100000, retry_after=1):
+        self.max_inflight = max_inflight
+        self.low_priority_limit = max(1, int(max_inflight * low_priority_share))
+        self.retry_after = retry_after
+        # 0 turns a limit off
+        self.buckets = {
+            'upload': TokenBuckets(client_rate, client_burst, max_clients) if client_rate > 0 else None,
+            'key_exchange': TokenBuckets(key_exchange_rate, key_exchange_burst, max_clients) if key_exchange_rate > 0 else None,
+        }
+        self._lock = threading.Lock()
+        self.inflight = 0
+        self.peak_inflight = 0
+        self.admitted = 0
+        self.shed_rate = 0         # 429, the client went over its rate
+        self.shed_priority = 0     # 503, low priority request with the server nearly full
+        self.shed_overload = 0     # 503, the server is full
+
+    def enter(self, kind, client):
+        """kind is 'upload' or 'key_exchange'. Returns None if the request may go on (then leave() has to be
+        called when it is done), otherwise the (body, status, headers) to answer with"""
+        buckets = self.buckets.get(kind)
+        low_priority = kind == 'key_exchange'
+        if buckets is not None:
+            wait, level = buckets.take(client)
+            if wait:
+                with self._lock:
+                    self.shed_rate += 1
+                return ('Too many requests, please slow down', 429, {'Retry-After': str(max(1, math.ceil(wait)))})
+            # a client that keeps its bucket half empty is the one filling the server
+            low_priority = low_priority or level < 0.5
+
+        with self._lock:
+            limit = self.low_priority_limit if low_priority else self.max_inflight
+            if not self.max_inflight or self.inflight < limit:
+                self.inflight += 1
+                self.admitted += 1
+                self.peak_inflight = max(self.peak_inflight, self.inflight)
+                return None
+            if self.inflight >= self.max_inflight:
+                self.shed_overload += 1
+            else:
+                self.shed_priority += 1
+        # the request wasn't served, it doesn't count against the client's rate
+        if buckets is not None:
+            buckets.give_back(client)
+        return ('Server busy, please try again later', 503, {'Retry-After': str(self.retry_after)})
+
+    def leave(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'inflight': self.inflight,
+                'peak_inflight': self.peak_inflight,
+                'max_inflight': self.max_inflight,
+                'admitted': self.admitted,
+                'shed_rate': self.shed_rate,
+                'shed_priority': self.shed_priority,
+                'shed_overload': self.shed_overload,
+                'clients': sum(len(buckets) for buckets in self.buckets.values() if buckets is not None),
+            }
@@ -0,0 +1,296 @@
+# async_server.py - asyncio serving mode for the HTTPS server
+# Same endpoints as https_server.py, served by Quart on top of hypercorn. A single event loop keeps thousands of
+# (slow) client connections open without a thread for each one. The expensive steps never run on the loop:
+# PBKDF2, ECDH/HKDF, AES-GCM and ECDSA go to a bounded crypto thread pool and the storage calls (MySQL, SQLite or
+# columnar files, see storage.py) go to their own pool, sized like the connection pool so a DB thread never waits
+# for a connection.
+#
+# Requires: pip install quart hypercorn
+# Run with:
+#   python3 async_server.py
+# or with any ASGI server, e.g.
+#   hypercorn async_server:app --certfile cert.pem --keyfile key.pem --bind 0.0.0.0:5000
+
+import os
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from quart import Quart, request, jsonify, Response
+import config
+# sessions, caches, the storage backend and the upload logic are shared with the Flask server
+import https_server as core
+from storage import StorageError
+from tools import hash_token
+import wire
+import metrics
+from metrics import stage
+
+app = Quart(__name__)
+
+crypto_executor = ThreadPoolExecutor(max_workers=config.ASYNC_CRYPTO_WORKERS, thread_name_prefix='crypto')
+db_executor = ThreadPoolExecutor(max_workers=config.DB_POOL_SIZE, thread_name_prefix='db')
+
+
+async def run_crypto(fn, *args):
+    # the copied context carries the request trace (metrics.py) into the worker thread
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(crypto_executor, context.run, functools.partial(fn, *args))
+
+async def run_db(fn, *args):
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(db_executor, context.run, functools.partial(fn, *args))
+
+def lookup_session(client_id, headers):
+    # the session can be a SQLite read (SESSION_STORE=sqlite) or a ticket decrypt and the auth cache can look up
+    # revocations in the same file, one trip to the executor for both
+    return core.find_session(client_id, headers), core.auth_cache.get(client_id, headers.get('token'))
+
+def reply(result):
+    # (body, status) or (body, status, headers)
+    return (jsonify(result[0]),) + tuple(result[1:])
+
+
+@app.before_request
+async def start_trace():
+    metrics.begin(request.endpoint or 'unknown', request.headers.get('X-Client-ID'))
+
+@app.after_request
+async def finish_trace(response):
+    metrics.finish(response.status_code)
+    return response
+
+@app.route('/api/key_exchange', methods=['POST'])
+async def key_exchange():
+    # refused on the event loop before the body is read (see admission.py)
+    refused = core.admission.enter('key_exchange', core.admission_key(request.headers, request.remote_addr))
+    if refused:
+        return reply(refused)
+    try:
+        data = await request.get_json()
+        client_id = data.get('client_id')
+        client_public_key_pem = data.get('public_key')
+
+        if not client_id or not client_public_key_pem:
+            return jsonify('Missing client ID or public key'), 400
+
+        return jsonify(await run_crypto(core.derive_session, client_id, client_public_key_pem))
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        core.admission.leave()
+
+async def authorized_upload(store):
+    """Async version of https_server.process_upload, every blocking step is awaited on an executor"""
+    try:
+        client_id = request.headers.get('X-Client-ID')
+        session, cached_user = await run_crypto(lookup_session, client_id, request.headers)
+        if session is None:
+            return jsonify({'error': 'Invalid or missing client ID'}), 401
+        try:
+            if request.mimetype == wire.CONTENT_TYPE:
+                envelope = core.read_envelope(request.mimetype, await request.get_data())
+            else:
+                envelope = core.read_envelope(request.mimetype, await request.get_json())
+        except (ValueError, TypeError) as e:
+            return jsonify('Malformed envelope: ' + str(e)), 400
+
+        token = request.headers.get('token')
+        try:
+            # skip the PBKDF2 + users query if we accepted this exact token recently
+            if cached_user is None:
+                # without a token there is nothing to hash, authenticate_client refuses it (or registers a new client)
+                token_hash = None
+                if token:
+                    with stage('pbkdf2'):
+                        token_hash = await run_crypto(hash_token, token, client_id[:16])
+                refused = await run_db(core.authenticate_client, client_id, token, token_hash)
+                if refused:
+                    return reply(refused)
+        except StorageError as e:
+            return jsonify('Connection refused, please contact your administrator'), 401
+
+        plaintext, refused = await run_crypto(core.open_envelope, client_id, session, envelope)
+        if refused:
+            return reply(refused)
+
+        try:
+            return reply(await run_db(store, client_id, plaintext, envelope['encoding']))
+        except StorageError as e:
+            return jsonify('Connection refused, please contact your administrator'), 401
+
+    except Exception as e:
+        return jsonify(str(e)), 500
+
+@app.route('/api/upload', methods=['POST'])
+async def upload_data():
+    # over its rate or server full: refuse before spending anything on the token check or the decryption
+    refused = core.admission.enter('upload', core.admission_key(request.headers, request.remote_addr))
+    if refused:
+        return reply(refused)
+    try:
+        if core.ingest is None:
+            return await authorized_upload(core.store_record)
+        # queue full: same thing
+        if core.ingest.full():
+            return reply(core.queue_full())
+        return await authorized_upload(core.queue_record)
+    finally:
+        core.admission.leave()
+
+@app.route('/api/upload_batch', methods=['POST'])
+async def upload_batch():
+    refused = core.admission.enter('upload', core.admission_key(request.headers, request.remote_addr))
+    if refused:
+        return reply(refused)
+    try:
+        return await authorized_upload(core.store_batch)
+    finally:
+        core.admission.leave()
+
+@app.route('/api/stream/start', methods=['POST'])
+async def stream_start():
+    """Start (or resume, when upload_id is given) a chunked file upload"""
+    try:
+        client_id, session, refused = await run_db(core.authorize_request, request.headers)
+        if refused:
+            return reply(refused)
+        data = (await request.get_json(silent=True)) or {}
+        return reply(await run_db(core.stream_store.start, client_id, data.get('filename'),
+                                  data.get('upload_id'), data.get('size')))
+    except Exception as e:
+        return jsonify(str(e)), 500
+
+@app.route('/api/stream/<upload_id>', methods=['GET'])
+async def stream_status(upload_id):
+    try:
+        client_id, session, refused = await run_db(core.authorize_request, request.headers)
+        if refused:
+            return reply(refused)
+        return reply(await run_db(core.stream_store.status, client_id, upload_id))
+    except Exception as e:
+        return jsonify(str(e)), 500
+
+def write_chunk(client_id, key, upload_id, index, body):
+    return core.stream_store.write_chunk(client_id, key, upload_id, index, body, core.verify_keys.get(client_id))
+
+@app.route('/api/stream/<upload_id>/<int:index>', methods=['PUT'])
+async def stream_chunk(upload_id, index):
+    try:
+        # chunks have a fixed maximum size, don't even read bodies bigger than that
+        if request.content_length and request.content_length > core.stream_store.chunk_size + 1024:
+            return jsonify(f'Chunk too big, the limit is {core.stream_store.chunk_size} bytes'), 413
+        client_id, session, refused = await run_db(core.authorize_request, request.headers)
+        if refused:
+            return reply(refused)
+        body = await request.get_data()
+        # loading the verify key (file stat, maybe a PEM parse) + decrypt + append + fsync, all blocking
+        return reply(await run_crypto(write_chunk, client_id, session.key, upload_id, index, body))
+    except Exception as e:
+        return jsonify(str(e)), 500
+
+@app.route('/api/records', methods=['GET'])
+async def read_records():
+    """The client's records, one page at a time, as encrypted NDJSON chunks (see records.py)"""
+    try:
+        client_id, session, refused = await run_db(core.authorize_request, request.headers)
+        if refused:
+            return reply(refused)
+        lines, request_id, refused = await run_db(core.open_records, client_id, session, request.args)
+        if refused:
+            return reply(refused)
+
+        async def stream():
+            # every fetch from the database (and the encryption of its chunk) happens on the DB executor
+            try:
+                while True:
+                    line = await run_db(next, lines, None)
+                    if line is None:
+                        break
+                    yield line
+            finally:
+                # finished or client gone: give the connection back to the pool
+                await run_db(lines.close)
+
+        return Response(stream(), mimetype='application/x-ndjson', headers={'X-Request-ID': request_id})
+    except Exception as e:
+        return jsonify(str(e)), 500
+
+@app.route('/api/stats', methods=['GET'])
+async def stats():
+    """Admin endpoint to see how the server resources are used"""
+    if not core.is_admin(request.headers):
+        return jsonify('error : Unauthorized'), 401
+    return jsonify(await run_db(core.server_stats))
+
+@app.route('/metrics', methods=['GET'])
+async def prometheus_metrics():
+    """Stage timers, request counters and server_stats() in the Prometheus text format"""
+    if not core.metrics_allowed(request.headers):
+        return jsonify('error : Unauthorized'), 401
+    return Response(await run_db(metrics.render), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/revoke', methods=['POST'])
+async def revoke_client():
+    """Admin endpoint to revoke a client token"""
+    if not core.is_admin(request.headers):
+        return jsonify('error : Unauthorized'), 401
+    client_id = ((await request.get_json(silent=True)) or {}).get('client_id')
+    if not client_id:
+        return jsonify('Missing client ID'), 400
+    try:
+        revoked = await run_db(core.revoke_user, client_id)
+    except StorageError as e:
+        return jsonify(str(e)), 500
+    return jsonify({
+        'status': 'success',
+        'revoked': revoked
+    })
+
+@app.route('/api/schema_refresh', methods=['POST'])
+async def schema_refresh():
+    """Admin endpoint to reload the data table columns right away (after an ALTER TABLE)"""
+    if not core.is_admin(request.headers):
+        return jsonify('error : Unauthorized'), 401
+    try:
+        columns = await run_db(core.refresh_schema)
+    except StorageError as e:
+        return jsonify(str(e)), 500
+    return jsonify({
+        'status': 'success',
+        'columns': columns
+    })
+
+@app.route('/api/session_cleanup', methods=['POST'])
+async def cleanup_sessions():
+    """Admin endpoint to cleanup old sessions"""
+    if not core.is_admin(request.headers):
+        return jsonify('error : Unauthorized'), 401
+
+    # Sessions expire on their own (SESSION_TTL), this only forces the expired ones out right now
+    # (with SESSION_STORE=sqlite both are queries on the shared file, off the loop)
+    removed = await run_db(core.client_sessions.expire)
+
+    return jsonify({
+        'status': 'success',
+        'removed': removed,
+        'remaining': await run_db(len, core.client_sessions)
+    })
+
+if __name__ == "__main__":
+    from hypercorn.config import Config
+    from hypercorn.asyncio import serve
+
+    # If cert files don't exist, inform user they need to create them
+    if not os.path.exists('cert.pem') or not os.path.exists('key.pem'):
+        print("SSL certificates not found. Create them with:")
+        print("openssl req -x509 -newkey rsa:4096 -nodes -out cert.pem -keyout key.pem -days 365")
+        print("The server is not secure, please create the SSL certificates and start again\n")
+
+    hypercorn_config = Config()
+    hypercorn_config.bind = ['0.0.0.0:5000']
+    hypercorn_config.certfile = 'cert.pem'
+    hypercorn_config.keyfile = 'key.pem'
+    hypercorn_config.keep_alive_timeout = config.ASYNC_KEEP_ALIVE
+    asyncio.run(serve(app, hypercorn_config))
@@ -0,0 +1,92 @@
+# auth_cache.py - Remembers recent successful authentications
+# Checking a token costs a 10,000 round PBKDF2 plus a query on the users table. A client sending many messages
+# presents the same token every time, so we keep the verdict for a while and skip both on the next upload.
+# With several worker processes each one has its own cache, `revocations` (see shared_sessions.py) lets a worker
+# hear about the clients revoked by the others before it trusts a cached verdict.
+
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import date
+
+
+class AuthCache:
+    def __init__(self, max_entries=10000, ttl=300.0, revocations=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.revocations = revocations  # generation -> (latest generation, client ids revoked after it)
+        self.generation = revocations(None)[0] if revocations is not None else None
+        self._entries = OrderedDict()   # (client_id, token digest) -> (user ID, until, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _key(client_id, token):
+        # a plain SHA-256 is enough here, it only needs to tell tokens apart (and keeps raw tokens out of memory)
+        if isinstance(token, str):
+            token = token.encode('utf-8')
+        return (client_id, hashlib.sha256(token or b'').digest())
+
+    def get(self, client_id, token):
+        """Returns the cached users.ID if this client/token pair was accepted recently, otherwise None"""
+        if self.revocations is not None:
+            self._sync()
+        key = self._key(client_id, token)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                user_id, until, expires_at = entry
+                # the token may expire while cached, the DB path takes care of revoking it
+                if now < expires_at and date.today() < until:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return user_id
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def _sync(self):
+        # one indexed read when nothing was revoked
+        generation, client_ids = self.revocations(self.generation)
+        for revoked in client_ids:
+            self.invalidate(revoked)
+        with self._lock:
+            self.generation = max(self.generation, generation)
+
+    def put(self, client_id, token, user_id, until):
+        key = self._key(client_id, token)
+        with self._lock:
+            self._entries[key] = (user_id, until, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, client_id):
+        """Drop every cached verdict for a client (used when the client gets revoked)"""
+        with self._lock:
+            stale = [key for key in self._entries if key[0] == client_id]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+            return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
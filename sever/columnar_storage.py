@@ -0,0 +1,418 @@
+# columnar_storage.py - Append-only column files on local disk (STORAGE_BACKEND=columnar)
+# For sites that receive far more records than they ever read back. Records are never updated, so there is no need
+# for a database: the records that arrive within COLUMNAR_LINGER seconds (up to COLUMNAR_ROW_GROUP of them) become
+# one row group, written with a single append and fsync. Inside a row group every column is stored on its own, as a
+# zlib compressed JSON array (values of one column look alike, so they compress far better than whole records).
+#
+# Row groups are records of a journal (journal.py: CRC checked, segments in COLUMNAR_FOLDER/data-00000001.log...,
+# a crash loses at most the row group being written). The journal metadata is the row group header
+#
+#   {"rows": 250, "first_id": 1001, "columns": {"Age": [offset, length], ...},
+#    "users": [client ids], "min_date": "2024-05-01", "max_date": "2024-05-02", "max_updated": "...",
+#    "last": ["2024-05-02", 1250]}
+#
+# so a read skips the row groups without records of the client (or of the dates asked for) without uncompressing
+# anything. Reads scan the files, they are meant to be rare; use MySQL or SQLite when records are read often.
+#
+# Next to the segments: columns.json (the columns of the data table, the ones of project_CSS.sql to start with,
+# add a column there and call /api/schema_refresh), users.json (the users table) and ids (the next record ID,
+# shared by the worker processes).
+
+import os
+import json
+import time
+import zlib
+import fcntl
+import heapq
+import threading
+from datetime import date, datetime
+from journal import Journal, list_segments
+from schema import InsertPlanner, SchemaError
+from storage import StorageUnavailable
+from metrics import stage
+
+# the data table of project_CSS.sql, in the shape of INFORMATION_SCHEMA.COLUMNS
+DEFAULT_COLUMNS = [
+    {'name': 'ID', 'type': 'int', 'nullable': False, 'default': None, 'extra': 'auto_increment', 'max_length': None},
+    {'name': 'FirstName', 'type': 'varchar', 'nullable': False, 'default': None, 'extra': '', 'max_length': 50},
+    {'name': 'LastName', 'type': 'varchar', 'nullable': False, 'default': None, 'extra': '', 'max_length': 50},
+    {'name': 'Age', 'type': 'int', 'nullable': False, 'default': None, 'extra': '', 'max_length': None},
+    {'name': 'hight', 'type': 'float', 'nullable': False, 'default': None, 'extra': '', 'max_length': None},
+    {'name': 'Address', 'type': 'varchar', 'nullable': False, 'default': None, 'extra': '', 'max_length': 200},
+    {'name': 'Comments', 'type': 'text', 'nullable': False, 'default': None, 'extra': '', 'max_length': 65535},
+    {'name': 'date', 'type': 'date', 'nullable': False, 'default': 'current_date', 'extra': '', 'max_length': None},
+    {'name': 'updated', 'type': 'timestamp', 'nullable': False, 'default': 'current_timestamp', 'extra': '', 'max_length': None},
+    {'name': 'user', 'type': 'varchar', 'nullable': False, 'default': None, 'extra': '', 'max_length': 128},
+]
+
+
+class _Group:
+    # records waiting for the writer thread, the callers wait on done
+    __slots__ = ('rows', 'done', 'error')
+
+    def __init__(self):
+        self.rows = []
+        self.done = threading.Event()
+        self.error = None
+
+
+def _write_json(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class ColumnarStorage:
+    name = 'columnar'
+
+    def __init__(self, folder, planner=None, row_group_rows=1000, linger=0.005, max_segment_bytes=64 * 1024 * 1024,
+                 fsync=True, suffix=''):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.row_group_rows = row_group_rows
+        self.linger = linger
+        self.columns_path = os.path.join(folder, 'columns.json')
+        self.users_path = os.path.join(folder, 'users.json')
+        self.ids_path = os.path.join(folder, 'ids')
+        self.planner = planner or InsertPlanner('data')
+        self.planner.read_columns = self._read_columns
+        self._defaults = {}
+        self._types = {}
+        self._id_column = None
+
+        with self._file_lock(self.columns_path):
+            if not os.path.exists(self.columns_path):
+                _write_json(self.columns_path, DEFAULT_COLUMNS)
+        self.planner.load(None)
+
+        # each worker process appends to its own segments (data.<worker>-...), reads go through all of them
+        self.journal = Journal(folder, 'data' + suffix, max_segment_bytes=max_segment_bytes, fsync=fsync)
+        self._recover_ids()
+
+        self._users = {}
+        self._users_version = None
+
+        self._group = _Group()
+        self._ready = threading.Condition()
+        self.row_groups = 0
+        self.rows = 0
+        self.bytes_written = 0
+        self.errors = 0
+        self._thread = threading.Thread(target=self._run, name='columnar-writer', daemon=True)
+        self._thread.start()
+
+    def _file_lock(self, path):
+        # the read-modify-write of the shared files is serialized between processes with a lock file
+        lock = open(path + '.lock', 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def segments(self):
+        # data-*.log plus the data.<worker>-*.log segments of the other worker processes
+        prefixes = sorted({name.split('-', 1)[0] for name in os.listdir(self.folder) if name.endswith('.log')})
+        return [path for prefix in prefixes if prefix == 'data' or prefix.startswith('data.')
+                for path in list_segments(self.folder, prefix)]
+
+    # catalog
+
+    def _read_columns(self, conn, table):
+        with open(self.columns_path) as f:
+            columns = json.load(f)
+        self._defaults = {column['name']: column['default'] for column in columns if column.get('default') is not None}
+        self._types = {column['name']: column['type'].lower() for column in columns}
+        self._id_column = next((column['name'] for column in columns if 'auto_increment' in (column.get('extra') or '')), None)
+        return [(column['name'], column['type'], 'YES' if column['nullable'] else 'NO', column.get('default'),
+                 column.get('extra') or '', column.get('max_length')) for column in columns]
+
+    def refresh_schema(self):
+        return [column.name for column in self.planner.load(None).values()]
+
+    # users
+
+    def _load_users(self):
+        try:
+            with open(self.users_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def _valid_users(self):
+        # users.json is small and read on every token check, keep it parsed until another process changes it
+        try:
+            st = os.stat(self.users_path)
+            version = (st.st_ino, st.st_mtime_ns)
+        except FileNotFoundError:
+            version = None
+        if version != self._users_version:
+            valid = {}
+            for user in self._load_users():
+                if user['valid']:
+                    valid.setdefault(user['userid'], []).append(user)
+            self._users = valid
+            self._users_version = version
+        return self._users
+
+    def _change_users(self, change):
+        with self._file_lock(self.users_path):
+            users = self._load_users()
+            result = change(users)
+            _write_json(self.users_path, users)
+        return result
+
+    def find_user(self, client_id):
+        users = self._valid_users().get(client_id, [])
+        if len(users) != 1:
+            return None
+        return {'ID': users[0]['ID'], 'token': users[0]['token'], 'until': date.fromisoformat(users[0]['until'])}
+
+    def add_user(self, client_id, token_hash, created, until):
+        def add(users):
+            # userid is a unique key of the users table, an expired or revoked client gets its old entry back
+            for user in users:
+                if user['userid'] == client_id:
+                    user.update(token=token_hash, created=created.isoformat(), until=until.isoformat(), valid=1)
+                    return
+            users.append({'ID': max((user['ID'] for user in users), default=0) + 1, 'userid': client_id,
+                          'token': token_hash, 'created': created.isoformat(), 'until': until.isoformat(), 'valid': 1})
+        self._change_users(add)
+
+    def _invalidate(self, match):
+        def invalidate(users):
+            changed = 0
+            for user in users:
+                if user['valid'] and match(user):
+                    user['valid'] = 0
+                    changed += 1
+            return changed
+        return self._change_users(invalidate)
+
+    def expire_user(self, user_id):
+        self._invalidate(lambda user: user['ID'] == user_id)
+
+    def revoke_user(self, client_id):
+        return self._invalidate(lambda user: user['userid'] == client_id)
+
+    # writing
+
+    def _recover_ids(self):
+        # the ids file isn't fsynced, after a power cut it may be behind the IDs already in the segments.
+        # IDs only grow, so the last segment of each worker has the highest ones
+        highest = 0
+        prefixes = {}
+        for path in self.segments():
+            prefixes[os.path.basename(path).split('-', 1)[0]] = path
+        for path in prefixes.values():
+            for offset, header, payload in Journal.read(path):
+                highest = max(highest, header['first_id'] + header['rows'] - 1)
+        with open(self.ids_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            if int(f.read().strip() or 1) <= highest:
+                f.seek(0)
+                f.truncate()
+                f.write(str(highest + 1))
+
+    def _reserve_ids(self, count):
+        """First of count new record IDs, unique across the worker processes"""
+        with open(self.ids_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            first = int(f.read().strip() or 1)
+            f.seek(0)
+            f.truncate()
+            f.write(str(first + count))
+        return first
+
+    def _encode(self, rows, first_id):
+        """(header, payload) of one row group"""
+        now = datetime.now().replace(microsecond=0)
+        defaults = {'current_date': now.date(), 'current_timestamp': now}
+        names = list(self._types)
+        for row in rows:
+            names.extend(name for name in row if name not in self._types and name not in names)
+        # built column by column, that's how they are stored
+        columns = {}
+        for name in names:
+            if name == self._id_column:
+                values = [row.get(name, first_id + i) for i, row in enumerate(rows)]
+            else:
+                fill = self._defaults.get(name)
+                fill = defaults.get(str(fill).lower(), fill)
+                values = [row.get(name, fill) for row in rows]
+            if self._types.get(name, 'date') in ('date', 'datetime', 'timestamp'):
+                values = [value.isoformat() if isinstance(value, (date, datetime)) else value for value in values]
+            columns[name] = values
+
+        payload = bytearray()
+        header = {'rows': len(rows), 'first_id': first_id, 'columns': {}}
+        for name, values in columns.items():
+            block = zlib.compress(json.dumps(values).encode('utf-8'))
+            header['columns'][name] = [len(payload), len(block)]
+            payload += block
+        header['users'] = sorted({str(value) for value in columns.get('user', [])})
+        dates = [value for value in columns.get('date', []) if value is not None]
+        header['min_date'] = min(dates, default=None)
+        header['max_date'] = max(dates, default=None)
+        header['max_updated'] = max((value for value in columns.get('updated', []) if value is not None), default=None)
+        # the last (date, ID) of the group: pages after it don't need to look inside
+        keys = [(day, record_id) for day, record_id in zip(columns.get('date', []), columns.get(self._id_column, []))
+                if day is not None and record_id is not None]
+        header['last'] = max(keys, default=None)
+        return header, bytes(payload)
+
+    def _write(self, rows):
+        first_id = self._reserve_ids(len(rows))
+        seq = None
+        for start in range(0, len(rows), self.row_group_rows):
+            header, payload = self._encode(rows[start:start + self.row_group_rows], first_id + start)
+            path, offset, seq = self.journal.write(header, payload)
+            self.row_groups += 1
+            self.bytes_written += len(payload)
+        # one fsync for the whole group
+        self.journal.sync(seq)
+        self.rows += len(rows)
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._group.rows:
+                    self._ready.wait()
+                # wait a little for more records, a row group of one record compresses badly. But stop as soon as
+                # they stop coming: with every writer already waiting on this group, lingering only adds latency
+                deadline = time.monotonic() + self.linger
+                while len(self._group.rows) < self.row_group_rows:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    before = len(self._group.rows)
+                    self._ready.wait(min(remaining, self.linger / 4))
+                    if len(self._group.rows) == before:
+                        break
+                group, self._group = self._group, _Group()
+            try:
+                self._write(group.rows)
+            except Exception as e:
+                self.errors += 1
+                group.error = e
+            group.done.set()
+
+    def _append(self, rows):
+        """Returns once the rows are on disk"""
+        with self._ready:
+            group = self._group
+            group.rows.extend(rows)
+            self._ready.notify()
+        group.done.wait()
+        if group.error is not None:
+            raise StorageUnavailable(f'could not write the row group: {group.error}')
+
+    def check(self, record):
+        return self.planner.plan(None, record)
+
+    def insert(self, record):
+        columns, values = self.planner.plan(None, record)
+        self._append([dict(zip(columns, values))])
+
+    def insert_many(self, batch):
+        failed = []
+        rows = []
+        for i, record in enumerate(batch):
+            try:
+                columns, values = self.planner.plan(None, record)
+            except SchemaError as e:
+                failed.append((i, 'malformed data: ' + str(e)))
+                continue
+            rows.append(dict(zip(columns, values)))
+        if rows:
+            self._append(rows)
+        return failed
+
+    # reading
+
+    def _value(self, name, value):
+        data_type = self._types.get(name)
+        if value is None:
+            return None
+        if data_type == 'date':
+            return date.fromisoformat(value)
+        if data_type in ('datetime', 'timestamp'):
+            return datetime.fromisoformat(value)
+        return value
+
+    def _skip(self, header, client_id, filters):
+        # decided on the header alone, nothing is uncompressed
+        if client_id not in header['users']:
+            return True
+        if 'date_from' in filters and header['max_date'] and header['max_date'] < filters['date_from'].isoformat():
+            return True
+        if 'date_to' in filters and header['min_date'] and header['min_date'] > filters['date_to'].isoformat():
+            return True
+        if 'after' in filters and header.get('last'):
+            last_date, last_id = filters['after']
+            if (header['last'][0], header['last'][1]) <= (last_date.isoformat(), last_id):
+                return True
+        if 'updated_since' in filters and header['max_updated'] \
+                and header['max_updated'] < filters['updated_since'].isoformat():
+            return True
+        return False
+
+    def _matches(self, row, client_id, filters):
+        if row.get('user') != client_id:
+            return False
+        if 'date_from' in filters and row['date'] < filters['date_from']:
+            return False
+        if 'date_to' in filters and row['date'] > filters['date_to']:
+            return False
+        if 'updated_since' in filters and row['updated'] < filters['updated_since']:
+            return False
+        if 'after' in filters and (row['date'], row['ID']) <= filters['after']:
+            return False
+        return True
+
+    def _scan(self, client_id, filters):
+        for path in self.segments():
+            for offset, header, payload in Journal.read(path):
+                if self._skip(header, client_id, filters):
+                    continue
+
+                def column(name):
+                    start, length = header['columns'][name]
+                    return json.loads(zlib.decompress(payload[start:start + length]))
+
+                # only the user column at first, the others for groups shared with other clients are mostly wasted
+                users = column('user')
+                wanted = [i for i, user in enumerate(users) if user == client_id]
+                if not wanted:
+                    continue
+                columns = {name: column(name) for name in header['columns']}
+                for i in wanted:
+                    row = {name: self._value(name, values[i]) for name, values in columns.items()}
+                    if self._matches(row, client_id, filters):
+                        yield row
+
+    def read(self, client_id, filters):
+        """Yields the client's records in (date, ID) order, at most filters['limit'] + 1 of them"""
+        with stage('read_query'):
+            # keeps only the first limit + 1 in memory, not every record of the client
+            found = heapq.nsmallest(filters['limit'] + 1, self._scan(client_id, filters),
+                                    key=lambda row: (row['date'], row['ID']))
+        yield from found
+
+    def stats(self):
+        return {
+            'columnar': {
+                'row_groups': self.row_groups,
+                'rows': self.rows,
+                'avg_group_rows': round(self.rows / self.row_groups, 1) if self.row_groups else 0,
+                'bytes_written': self.bytes_written,
+                'fsyncs': self.journal.syncs,
+                'errors': self.errors,
+            },
+            'schema': self.planner.stats(),
+        }
+
+    def close(self):
+        self.journal.close()
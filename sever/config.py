@@ -0,0 +1,112 @@
+# config.py - Server configuration
+# Every value can be overridden with an environment variable so we stop hardcoding things in the server code.
+
+import os
+
+# Where users and records are kept (storage.py): 'mysql', 'sqlite' (one local file) or 'columnar' (append-only
+# column files, for sites that write a lot and read little)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mysql')
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'project_CSS.db')
+COLUMNAR_FOLDER = os.environ.get('COLUMNAR_FOLDER', 'columnar')
+COLUMNAR_ROW_GROUP = int(os.environ.get('COLUMNAR_ROW_GROUP', 1000))        # most records per row group
+COLUMNAR_LINGER = float(os.environ.get('COLUMNAR_LINGER', 0.005))           # seconds to wait for a row group to fill up
+COLUMNAR_SEGMENT_BYTES = int(os.environ.get('COLUMNAR_SEGMENT_BYTES', 256 * 1024 * 1024))
+COLUMNAR_FSYNC = os.environ.get('COLUMNAR_FSYNC', '1') == '1'
+
+# MySQL connection settings (the defaults match a fresh lampp install)
+DB_CONFIG = {
+    'user': os.environ.get('DB_USER', 'root'),
+    'password': os.environ.get('DB_PASSWORD', ''),
+    'host': os.environ.get('DB_HOST', '127.0.0.1'),
+    'database': os.environ.get('DB_NAME', 'project_CSS'),
+    'use_pure': False,
+}
+
+# Connection pool
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))               # max open connections
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 5))       # seconds to wait for a free connection
+DB_POOL_MAX_IDLE = float(os.environ.get('DB_POOL_MAX_IDLE', 300))   # close connections idle for longer than this
+DB_POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', 3600))  # recycle connections older than this
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', 30))  # ping connections idle for longer than this before use
+
+# Authentication cache (skips PBKDF2 + users query for recently accepted tokens)
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', 10000))
+AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', 300))      # seconds
+
+# Batched uploads (/api/upload_batch)
+MAX_BATCH_RECORDS = int(os.environ.get('MAX_BATCH_RECORDS', 1000))
+
+# Reading records back (/api/records, records.py)
+READ_PAGE_MAX = int(os.environ.get('READ_PAGE_MAX', 1000))     # most records a client can ask for in one page
+READ_CHUNK_ROWS = int(os.environ.get('READ_CHUNK_ROWS', 100))  # records per encrypted NDJSON line
+
+# Compressed payloads (wire.py)
+MAX_DECOMPRESSED_BYTES = int(os.environ.get('MAX_DECOMPRESSED_BYTES', 16 * 1024 * 1024))  # bigger payloads are refused
+
+# Key exchange sessions
+SESSION_MAX_ENTRIES = int(os.environ.get('SESSION_MAX_ENTRIES', 200000))  # least recently used sessions are dropped past this
+SESSION_TTL = float(os.environ.get('SESSION_TTL', 7200))                  # seconds (2 hours)
+
+# Where the sessions live: 'memory' (one process) or 'sqlite' (SESSION_DB, shared by the worker processes)
+SESSION_STORE = os.environ.get('SESSION_STORE', 'memory')
+SESSION_DB = os.environ.get('SESSION_DB', 'sessions.db')
+
+# Session tickets (tickets.py), let clients resume a session without a new key exchange
+SESSION_TICKETS = os.environ.get('SESSION_TICKETS', '1') == '1'
+TICKET_KEY_FILE = os.environ.get('TICKET_KEY_FILE', 'ticket_keys.json')      # ticket encryption keys, keep it private
+TICKET_KEY_ROTATE = float(os.environ.get('TICKET_KEY_ROTATE', 86400))        # seconds before a new ticket key is made
+
+# Ephemeral server ECDH keys (key_pool.py), a new key pair for every key exchange
+KEY_POOL_SIZE = int(os.environ.get('KEY_POOL_SIZE', 64))                    # key pairs made ahead of time (0 = no pool)
+KEY_POOL_REFILL_RATE = float(os.environ.get('KEY_POOL_REFILL_RATE', 0))     # most key pairs made per second (0 = no limit)
+KEY_POOL_FALLBACK = os.environ.get('KEY_POOL_FALLBACK', 'generate')         # pool empty: 'generate' one now or use the 'static' key
+
+# Signature verification key cache
+KEY_CACHE_RECHECK = float(os.environ.get('KEY_CACHE_RECHECK', 5))            # seconds between checks of a key file for changes
+KEY_CACHE_NEGATIVE_TTL = float(os.environ.get('KEY_CACHE_NEGATIVE_TTL', 30))  # remember clients without a key this long
+KEY_CACHE_PRELOAD = os.environ.get('KEY_CACHE_PRELOAD', '0') == '1'           # parse the whole keys folder at startup
+
+# Multi-process serving (prefork.py)
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', os.cpu_count() or 1))  # worker processes
+SERVER_KEY_FILE = os.environ.get('SERVER_KEY_FILE', 'server_ecdh_key.pem')   # static server ECDH key (KEY_POOL_FALLBACK=static)
+WORKER_ID = int(os.environ.get('WORKER_ID', 0))                              # set by prefork.py for each worker
+
+# Async serving mode (async_server.py)
+ASYNC_CRYPTO_WORKERS = int(os.environ.get('ASYNC_CRYPTO_WORKERS', os.cpu_count() or 4))  # threads for PBKDF2/ECDH/AES-GCM/ECDSA
+ASYNC_KEEP_ALIVE = float(os.environ.get('ASYNC_KEEP_ALIVE', 30))                          # seconds an idle client connection stays open
+
+# Streaming file uploads (/api/stream/...)
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 1024 * 1024))  # plaintext bytes per chunk
+STREAM_TTL = float(os.environ.get('STREAM_TTL', 86400))                     # seconds an unfinished upload is kept without new chunks
+STREAM_MAX_FILE_SIZE = int(os.environ.get('STREAM_MAX_FILE_SIZE', 4 * 1024 ** 3))  # bytes per file, 0 = no limit
+STREAM_MAX_UPLOADS = int(os.environ.get('STREAM_MAX_UPLOADS', 8))           # unfinished uploads per client, 0 = no limit
+
+# Dead-letter log (received_messages/deadletter)
+DEAD_LETTER_SEGMENT_BYTES = int(os.environ.get('DEAD_LETTER_SEGMENT_BYTES', 64 * 1024 * 1024))  # rotate segments at this size
+DEAD_LETTER_FSYNC = os.environ.get('DEAD_LETTER_FSYNC', '1') == '1'                              # fsync before answering the client
+
+# Column catalog of the data table (schema.py)
+SCHEMA_TTL = float(os.environ.get('SCHEMA_TTL', 300))   # seconds before the columns are read again from INFORMATION_SCHEMA
+
+# Write-behind ingest queue for /api/upload (ingest_queue.py)
+INGEST_QUEUE = os.environ.get('INGEST_QUEUE', '0') == '1'                 # answer uploads once queued, not once inserted
+INGEST_HIGH_WATER = int(os.environ.get('INGEST_HIGH_WATER', 10000))         # queued records before uploads get a 503
+INGEST_BATCH = int(os.environ.get('INGEST_BATCH', 500))                     # records per commit
+INGEST_LINGER = float(os.environ.get('INGEST_LINGER', 0.01))                # seconds to wait for a batch to fill up
+INGEST_SEGMENT_BYTES = int(os.environ.get('INGEST_SEGMENT_BYTES', 64 * 1024 * 1024))
+INGEST_FSYNC = os.environ.get('INGEST_FSYNC', '1') == '1'
+
+# Admission control for /api/upload, /api/upload_batch and /api/key_exchange (admission.py), per worker process
+MAX_INFLIGHT = int(os.environ.get('MAX_INFLIGHT', 64))                     # requests served at once, more get a 503 (0 = no cap)
+LOW_PRIORITY_SHARE = float(os.environ.get('LOW_PRIORITY_SHARE', 0.75))     # part of MAX_INFLIGHT for key exchanges and heavy senders
+CLIENT_RATE = float(os.environ.get('CLIENT_RATE', 100))                    # uploads per second per client, more get a 429 (0 = no limit)
+CLIENT_BURST = float(os.environ.get('CLIENT_BURST', 200))                  # uploads a quiet client can send at once
+KEY_EXCHANGE_RATE = float(os.environ.get('KEY_EXCHANGE_RATE', 2))          # key exchanges per second per client (0 = no limit)
+KEY_EXCHANGE_BURST = float(os.environ.get('KEY_EXCHANGE_BURST', 10))
+ADMISSION_MAX_CLIENTS = int(os.environ.get('ADMISSION_MAX_CLIENTS', 100000))  # clients whose rate is tracked
+BUSY_RETRY_AFTER = int(os.environ.get('BUSY_RETRY_AFTER', 1))              # Retry-After (seconds) of the 503s
+
+# Metrics (/metrics) and the slow-request log
+SLOW_REQUEST_LOG = os.environ.get('SLOW_REQUEST_LOG', '')                # file for slow requests, empty = no log
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 500))          # what counts as slow
+SLOW_REQUEST_SAMPLE = float(os.environ.get('SLOW_REQUEST_SAMPLE', 1.0))  # fraction of the slow requests that get logged
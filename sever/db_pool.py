@@ -0,0 +1,202 @@
+# db_pool.py - Reusable MySQL connections for the server
+# Opening a MySQL connection costs a TCP + auth handshake, which is more than the actual work of most uploads,
+# so we keep a bounded set of connections around and hand them out to requests.
+# A connection is borrowed for one storage call (the users query, or one insert), never across the decryption.
+# It goes back to the pool rolled back, unless a mysql.connector.Error got out of the `with pool.connection()`
+# block: then we don't know its state and it is closed. An error caught inside the block doesn't count, so
+# callers let the "database is gone" errors through (see storage.py).
+
+import time
+import threading
+from contextlib import contextmanager
+import mysql.connector
+from metrics import stage
+
+
+class PoolTimeout(mysql.connector.Error):
+    # subclass of mysql.connector.Error so the existing "DB is down" handling also covers a full pool
+    pass
+
+
+class _PooledEntry:
+    __slots__ = ('conn', 'created_at', 'last_used')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+class ConnectionPool:
+    def __init__(self, db_config, size=8, timeout=5.0, max_idle=300.0, max_lifetime=3600.0, ping_after=30.0,
+                 reap_interval=60.0):
+        self.db_config = dict(db_config)
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.ping_after = ping_after
+
+        self._idle = []          # free connections, most recently used at the end
+        self._open = 0           # connections currently open (idle + in use)
+        self._lock = threading.Condition()
+
+        # counters for sizing the pool
+        self._in_use = 0
+        self._waiting = 0
+        self._created = 0
+        self._recycled = 0
+        self._timeouts = 0
+
+        # background thread that closes idle/old connections so we don't sit on them forever
+        if reap_interval:
+            reaper = threading.Thread(target=self._reap, args=(reap_interval,), daemon=True)
+            reaper.start()
+
+    def _reap(self, interval):
+        while True:
+            time.sleep(interval)
+            self.evict_idle()
+
+    def _connect(self):
+        conn = mysql.connector.connect(**self.db_config)
+        with self._lock:
+            self._created += 1
+        return _PooledEntry(conn)
+
+    def _close(self, entry):
+        try:
+            entry.conn.close()
+        except Exception:
+            pass
+
+    def _expired(self, entry, now):
+        return (now - entry.created_at > self.max_lifetime or
+                now - entry.last_used > self.max_idle)
+
+    def _healthy(self, entry, now):
+        # only ping connections that sat idle for a while, recently used ones are almost always fine
+        if now - entry.last_used < self.ping_after:
+            return True
+        try:
+            entry.conn.ping(reconnect=False, attempts=1)
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, entry):
+        self._close(entry)
+        with self._lock:
+            self._open -= 1
+            self._recycled += 1
+            self._lock.notify()
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._lock:
+            while True:
+                if self._idle:
+                    entry = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._open < self.size:
+                    # reserve the slot, the actual connect happens outside the lock
+                    self._open += 1
+                    self._in_use += 1
+                    entry = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(msg='Timed out waiting for a database connection')
+                self._waiting += 1
+                try:
+                    self._lock.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+        if entry is not None:
+            now = time.monotonic()
+            if not self._expired(entry, now) and self._healthy(entry, now):
+                return entry
+            # stale or broken, replace it with a fresh one using the same slot
+            self._close(entry)
+            with self._lock:
+                self._recycled += 1
+
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self._open -= 1
+                self._in_use -= 1
+                self._lock.notify()
+            raise
+
+    def release(self, entry, broken=False):
+        if not broken:
+            try:
+                # never hand out a connection with a half done transaction
+                if entry.conn.in_transaction:
+                    entry.conn.rollback()
+            except Exception:
+                broken = True
+
+        now = time.monotonic()
+        with self._lock:
+            self._in_use -= 1
+        if broken or now - entry.created_at > self.max_lifetime:
+            self._discard(entry)
+            return
+        entry.last_used = now
+        with self._lock:
+            self._idle.append(entry)
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection: with pool.connection() as conn: ..."""
+        with stage('db_connect'):
+            entry = self.acquire()
+        broken = False
+        try:
+            yield entry.conn
+        except mysql.connector.Error:
+            # we don't know what state the connection is in, drop it
+            broken = True
+            raise
+        finally:
+            self.release(entry, broken=broken)
+
+    def evict_idle(self):
+        """Close idle connections past their idle time or lifetime"""
+        now = time.monotonic()
+        with self._lock:
+            keep = []
+            stale = []
+            for entry in self._idle:
+                (stale if self._expired(entry, now) else keep).append(entry)
+            self._idle = keep
+        for entry in stale:
+            self._discard(entry)
+        return len(stale)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for entry in idle:
+            self._discard(entry)
+
+    def stats(self):
+        self.evict_idle()
+        with self._lock:
+            return {
+                'size': self.size,
+                'open': self._open,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'waiting': self._waiting,
+                'created': self._created,
+                'recycled': self._recycled,
+                'timeouts': self._timeouts,
+            }
@@ -0,0 +1,168 @@
+# dead_letter.py - Messages we couldn't store, and the tool to put them back
+# Every message that can't go into the data table (database down, unknown columns, data we can't decode...) is
+# appended to a dead-letter journal in received_messages/deadletter instead of one small file per message.
+# The raw decrypted bytes are kept as they arrived, together with the sender, the time and the reason.
+#
+# Once the problem is fixed, replay the backlog into the data table:
+#   python3 dead_letter.py replay [--workers 4] [--batch 500]
+# Replay is idempotent: replayed record ids are written to the dead_letter_replayed table in the same transaction
+# as the data, so running it twice (or after a crash) never inserts a record twice. It needs a SQL storage backend
+# (STORAGE_BACKEND=mysql or sqlite), the columnar files have no transactions to keep the ledger in.
+
+import os
+import sys
+import uuid
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from journal import Journal, list_segments
+from metrics import stage
+from schema import SchemaError
+import wire
+
+DEAD_LETTER_FOLDER = os.path.join('received_messages', 'deadletter')
+
+LEDGER_TABLE = """CREATE TABLE IF NOT EXISTS dead_letter_replayed (
+  record_id char(32) NOT NULL PRIMARY KEY,
+  replayed timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+)"""
+
+
+class DeadLetterLog:
+    def __init__(self, folder=DEAD_LETTER_FOLDER, name='deadletter', max_segment_bytes=64 * 1024 * 1024, fsync=True):
+        self.journal = Journal(folder, name, max_segment_bytes=max_segment_bytes, fsync=fsync)
+        self.count = 0
+
+    def add(self, client_id, payload, reason, encoding='json'):
+        """Keeps a message we couldn't store, returns its dead-letter id"""
+        record_id = uuid.uuid4().hex
+        with stage('dead_letter'):
+            self.journal.append({
+                'id': record_id,
+                'client_id': client_id,
+                'received': datetime.now().isoformat(),
+                'reason': reason,
+                'encoding': encoding,
+            }, payload)
+        self.count += 1
+        return record_id
+
+    def stats(self):
+        return {
+            'records': self.count,
+            'fsyncs': self.journal.syncs,
+            'segment': os.path.basename(self.journal.current_segment),
+        }
+
+
+def dead_letter_segments(folder):
+    # deadletter-*.log plus the deadletter.<worker>-*.log journals of the other worker processes
+    prefixes = sorted({name.split('-', 1)[0] for name in os.listdir(folder) if name.endswith('.log')})
+    return [path for prefix in prefixes if prefix == 'deadletter' or prefix.startswith('deadletter.')
+            for path in list_segments(folder, prefix)]
+
+def _decode_record(meta, payload):
+    # a dead letter holds one record (a dict); anything else can't be replayed into the data table
+    try:
+        data = wire.decode_payload(payload, meta.get('encoding', 'json'))
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not data:
+        return None
+    data = dict(data)
+    data['user'] = meta['client_id']
+    return data
+
+def _insert_batch(storage, batch, counts):
+    """batch is a list of (record id, record). Inserts the ones not replayed yet and marks them, in one transaction"""
+    with storage.transaction() as (conn, cursor):
+        ids = [record_id for record_id, _ in batch]
+        cursor.execute(f"SELECT record_id FROM dead_letter_replayed WHERE record_id IN ({', '.join(['%s'] * len(ids))})", ids)
+        done = {row[0] for row in cursor.fetchall()}
+        counts['skipped'] += len(done)
+
+        groups = {}
+        rejected = set()
+        for record_id, record in batch:
+            if record_id in done:
+                continue
+            # checked against the table like an upload: the keys come from the client and must never reach the SQL
+            # text unchecked, and the values are converted to the column types
+            try:
+                columns, values = storage.planner.plan(conn, record)
+            except SchemaError:
+                rejected.add(record_id)
+                continue
+            groups.setdefault(columns, []).append((record_id, values))
+
+        # same as the upload path: the bad rows are found one by one, they stay in the log
+        rejected.update(record_id for record_id, reason in storage.write_groups(cursor, groups))
+        counts['rejected'] += len(rejected)
+        replayed = [record_id for rows in groups.values() for record_id, _ in rows if record_id not in rejected]
+        if replayed:
+            cursor.executemany("INSERT INTO dead_letter_replayed (record_id) VALUES (%s)", [(r,) for r in replayed])
+        counts['replayed'] += len(replayed)
+
+def replay_segment(path, storage, batch_size=500):
+    counts = {'replayed': 0, 'skipped': 0, 'rejected': 0, 'undecodable': 0}
+    batch = []
+    for offset, meta, payload in Journal.read(path):
+        record = _decode_record(meta, payload)
+        if record is None:
+            counts['undecodable'] += 1
+            continue
+        batch.append((meta['id'], record))
+        if len(batch) >= batch_size:
+            _insert_batch(storage, batch, counts)
+            batch = []
+    if batch:
+        _insert_batch(storage, batch, counts)
+    return counts
+
+def replay(folder, storage, workers=4, batch_size=500):
+    """Replays every segment in parallel (one connection per worker), returns the totals"""
+    with storage.transaction() as (conn, cursor):
+        cursor.execute(LEDGER_TABLE)
+
+    segments = dead_letter_segments(folder)
+    totals = {'segments': len(segments), 'replayed': 0, 'skipped': 0, 'rejected': 0, 'undecodable': 0}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, counts in zip(segments, pool.map(lambda p: replay_segment(p, storage, batch_size), segments)):
+            print(f"{os.path.basename(path)}: {counts}")
+            for key, value in counts.items():
+                totals[key] += value
+    return totals
+
+def show(folder, limit=None):
+    shown = 0
+    for path in dead_letter_segments(folder):
+        for offset, meta, payload in Journal.read(path):
+            print(f"{meta['received']} {meta['client_id']} [{meta['reason']}] {meta['id']}: {payload[:200]!r}")
+            shown += 1
+            if limit and shown >= limit:
+                return
+
+
+if __name__ == "__main__":
+    import config
+
+    parser = argparse.ArgumentParser(description='Dead-letter log tools')
+    parser.add_argument('command', choices=['replay', 'show'])
+    parser.add_argument('--folder', default=DEAD_LETTER_FOLDER, help='Dead-letter folder')
+    parser.add_argument('--workers', type=int, default=4, help='Segments replayed in parallel')
+    parser.add_argument('--batch', type=int, default=500, help='Records per transaction')
+    parser.add_argument('--limit', type=int, help='Only show this many records')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        print(f"No dead-letter folder at {args.folder}")
+        sys.exit(1)
+    if args.command == 'show':
+        show(args.folder, args.limit)
+    else:
+        from storage import open_storage, SQLStorage
+        storage = open_storage(config)
+        if not isinstance(storage, SQLStorage):
+            print(f"Replay needs the mysql or sqlite storage backend, not {storage.name}")
+            sys.exit(1)
+        print(replay(args.folder, storage, args.workers, args.batch))
@@ -9,10 +9,27 @@ from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.exceptions import InvalidSignature
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
+import re
 import uuid
-import mysql.connector
-from tools import load_public_key, generate_key_pair, generate_token, hash_token
+from tools import load_or_create_server_key, generate_token, hash_token
+from auth_cache import AuthCache
+from session_store import SessionStore
+from shared_sessions import SQLiteSessionStore
+from tickets import TicketKeys, Tickets
+from key_cache import VerifyKeyCache
+import wire
+from streaming import StreamStore
+from dead_letter import DeadLetterLog
+from schema import SchemaError
+from storage import open_storage, SQLStorage, StorageError
+import records
+from ingest_queue import IngestQueue
+from admission import Admission
+from key_pool import KeyPool
+import metrics
+from metrics import stage
+import config
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
 
@@ -21,16 +38,156 @@ app = Flask(__name__)
 # Directory for storing malformed messages (kind of a log to avoid losing data if something fails)
 UPLOAD_FOLDER = 'received_messages'
 KEY_FOLDER = 'keys'
+# Files sent with the streaming upload (unfinished ones stay in received_messages/streams until complete)
+FILES_FOLDER = 'received_files'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(KEY_FOLDER, exist_ok=True)
 
-# Server ECDH key
-server_private_key, server_public_key = generate_key_pair()
+# Server ECDH keys: a new key pair for every key exchange, taken from a pool a background thread keeps full (see key_pool.py)
+# the static key in SERVER_KEY_FILE (the same for every worker process) is only loaded for KEY_POOL_FALLBACK=static
+static_server_key = None
+if config.KEY_POOL_FALLBACK == 'static':
+    server_private_key, server_public_key = load_or_create_server_key(config.SERVER_KEY_FILE)
+    # it never changes, serialize it once instead of on every key exchange
+    static_server_key = (server_private_key, server_public_key.public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode())
+key_pool = KeyPool(size=config.KEY_POOL_SIZE, refill_rate=config.KEY_POOL_REFILL_RATE,
+                   fallback=config.KEY_POOL_FALLBACK, static_key=static_server_key)
 
-client_sessions = {}
+# Parsed signature verification keys (see key_cache.py)
+verify_keys = VerifyKeyCache(KEY_FOLDER, recheck=config.KEY_CACHE_RECHECK, negative_ttl=config.KEY_CACHE_NEGATIVE_TTL)
+if config.KEY_CACHE_PRELOAD:
+    print(f"Preloaded {verify_keys.preload()} verification keys")
+
+# Messages that can't be stored go to an append-only dead-letter log (see dead_letter.py to replay them)
+# every worker process writes its own journal (deadletter.<worker>-*.log), the replay tool reads them all
+WORKER_SUFFIX = f'.{config.WORKER_ID}' if config.WORKER_ID else ''
+dead_letters = DeadLetterLog(os.path.join(UPLOAD_FOLDER, 'deadletter'), name='deadletter' + WORKER_SUFFIX,
+                             max_segment_bytes=config.DEAD_LETTER_SEGMENT_BYTES,
+                             fsync=config.DEAD_LETTER_FSYNC)
+
+# Chunked file uploads, see streaming.py
+stream_store = StreamStore(os.path.join(UPLOAD_FOLDER, 'streams'), FILES_FOLDER, chunk_size=config.STREAM_CHUNK_SIZE,
+                           ttl=config.STREAM_TTL, max_file_size=config.STREAM_MAX_FILE_SIZE,
+                           max_uploads=config.STREAM_MAX_UPLOADS)
+
+# Key exchange sessions, bounded and expired automatically (see session_store.py)
+# with several worker processes they go to a SQLite file every worker reads (see shared_sessions.py)
+if config.SESSION_STORE == 'sqlite':
+    client_sessions = SQLiteSessionStore(config.SESSION_DB, max_entries=config.SESSION_MAX_ENTRIES, ttl=config.SESSION_TTL)
+else:
+    client_sessions = SessionStore(max_entries=config.SESSION_MAX_ENTRIES, ttl=config.SESSION_TTL)
+
+# Session tickets, a client sending one back doesn't need a session in client_sessions (see tickets.py)
+tickets = None
+if config.SESSION_TICKETS:
+    tickets = Tickets(TicketKeys(config.TICKET_KEY_FILE, config.SESSION_TTL, rotate_after=config.TICKET_KEY_ROTATE))
+
+# Users and records: MySQL (pooled connections, see db_pool.py), SQLite or columnar files (see storage.py)
+storage = open_storage(config)
+
+# Recently accepted client id / token pairs, see auth_cache.py
+# with the shared session store the revokes of the other workers reach this cache through it
+auth_cache = AuthCache(max_entries=config.AUTH_CACHE_SIZE, ttl=config.AUTH_CACHE_TTL,
+                       revocations=client_sessions.revocations_since if config.SESSION_STORE == 'sqlite' else None)
+
+# Columns of the data table, records are checked against them before the insert (see schema.py)
+schema = storage.planner
+
+# Write-behind queue for /api/upload, off unless INGEST_QUEUE=1 (see ingest_queue.py)
+# the queue keeps its checkpoint in the database, next to the records, so it needs a SQL backend
+ingest = None
+if config.INGEST_QUEUE and not isinstance(storage, SQLStorage):
+    print(f"INGEST_QUEUE needs the mysql or sqlite storage backend, uploads go straight to {storage.name}")
+elif config.INGEST_QUEUE:
+    ingest = IngestQueue(os.path.join(UPLOAD_FOLDER, 'ingest'), storage, dead_letters, name='ingest' + WORKER_SUFFIX,
+                         high_water=config.INGEST_HIGH_WATER,
+                         batch_size=config.INGEST_BATCH,
+                         linger=config.INGEST_LINGER,
+                         max_segment_bytes=config.INGEST_SEGMENT_BYTES,
+                         fsync=config.INGEST_FSYNC)
+
+# Per-client rate limits and a cap on concurrent requests for the upload and key exchange endpoints (see admission.py)
+admission = Admission(max_inflight=config.MAX_INFLIGHT,
+                      low_priority_share=config.LOW_PRIORITY_SHARE,
+                      client_rate=config.CLIENT_RATE,
+                      client_burst=config.CLIENT_BURST,
+                      key_exchange_rate=config.KEY_EXCHANGE_RATE,
+                      key_exchange_burst=config.KEY_EXCHANGE_BURST,
+                      max_clients=config.ADMISSION_MAX_CLIENTS,
+                      retry_after=config.BUSY_RETRY_AFTER)
+
+# Requests slower than SLOW_REQUEST_MS are logged with the time of each stage (off unless SLOW_REQUEST_LOG is set)
+metrics.configure_slow_log(config.SLOW_REQUEST_LOG, config.SLOW_REQUEST_MS, config.SLOW_REQUEST_SAMPLE)
+
+@app.before_request
+def start_trace():
+    metrics.begin(request.endpoint or 'unknown', request.headers.get('X-Client-ID'))
+
+@app.after_request
+def finish_trace(response):
+    metrics.finish(response.status_code)
+    return response
+
+def derive_session(client_id, client_public_key_pem):
+    """ECDH with the client key, stores the session and returns what the client needs to derive the same key"""
+    # Load client public key
+    client_public_key = serialization.load_pem_public_key(client_public_key_pem.encode())
+    
+    # an ephemeral key pair only used for this key exchange, gone with the end of this function
+    with stage('key_pool'):
+        server_private_key, server_public_key_pem = key_pool.take()
+    
+    # Generate shared key
+    with stage('ecdh'):
+        shared_key = server_private_key.exchange(ec.ECDH(), client_public_key)
+        derived_key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b'handshake data'
+        ).derive(shared_key)
+    
+    # Store session info
+    session = client_sessions.put(client_id, derived_key)
+    
+    # Return server public key
+    # plus the wire formats we understand, new clients pick the binary envelope, old ones ignore this
+    response = {
+        'public_key': server_public_key_pem,
+        'formats': ['json', 'binary'],
+        'encodings': wire.available_encodings(),
+        'compressions': wire.available_compressions()
+    }
+    # and a ticket so the client can come back (even after a restart) without doing this again
+    if tickets is not None:
+        response['ticket'] = tickets.issue(client_id, derived_key, session.expires_at)
+        response['ticket_expires'] = int(session.expires_at)
+    return response
+
+def find_session(client_id, headers):
+    """The session of client_id: from its X-Session-Ticket header if it sent one, else from client_sessions"""
+    if not client_id:
+        return None
+    ticket = headers.get('X-Session-Ticket')
+    if ticket and tickets is not None:
+        session = tickets.open(client_id, ticket)
+        if session is not None:
+            return session
+    return client_sessions.get(client_id)
+
+def admission_key(headers, remote_addr):
+    # what the rate limits are counted by: the client id, or the address of clients that don't send one
+    return headers.get('X-Client-ID') or remote_addr or 'unknown'
 
 @app.route('/api/key_exchange', methods=['POST'])
 def key_exchange():
+    # refused before the body is even read, the ECDH is what we are protecting
+    refused = admission.enter('key_exchange', admission_key(request.headers, request.remote_addr))
+    if refused:
+        return respond(refused)
     try:
         data = request.json
         client_id = data.get('client_id')
@@ -39,212 +196,502 @@ def key_exchange():
         if not client_id or not client_public_key_pem:
             return jsonify('Missing client ID or public key'), 400
         
-        # Load client public key
-        client_public_key = serialization.load_pem_public_key(client_public_key_pem.encode())
-        
-        # Generate shared key
-        shared_key = server_private_key.exchange(ec.ECDH(), client_public_key)
-        derived_key = HKDF(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=None,
-            info=b'handshake data'
-        ).derive(shared_key)
-        
-        # Store session info
-        client_sessions[client_id] = {
-            'key': derived_key,
-            'public_key': client_public_key,
-            'created_at': time.time()
-        }
-        
-        # Return server public key
-        return jsonify({
-            'public_key': server_public_key.public_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PublicFormat.SubjectPublicKeyInfo
-            ).decode()
-        })
+        return jsonify(derive_session(client_id, client_public_key_pem))
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    finally:
+        admission.leave()
 
-@app.route('/api/upload', methods=['POST'])
-def upload_data():
+def authenticate_client(client_id, token, token_hash=None):
+    """Check the client id / token pair. Returns None if the client is allowed in, otherwise the (body, status) to send.
+    token_hash can be passed in when the PBKDF2 was already computed somewhere else (the async server does that)"""
+    #check if the clinet id exists and have a token to validate access
+    user = storage.find_user(client_id)
+
+    if user is not None:
+        if not token:
+            return ('Connection refused...', 401)
+        #authenticate token, use client_id first part as salt (not a good idea, but just testing is ok...)
+        client_token = token_hash
+        if client_token is None:
+            with stage('pbkdf2'):
+                client_token = hash_token(token, client_id[:16])
+        db_token = user['token']
+        current_date = date.today()
+        revoke_date = user['until']
+        if client_token != db_token:
+            return ('Connection refused...', 401)
+        if current_date >= revoke_date: #check the validity of the presented token
+            storage.expire_user(user['ID'])
+            auth_cache.invalidate(client_id)
+            return ('Invalid token, please contact your administrator...', 401)
+        auth_cache.put(client_id, token, user['ID'], revoke_date)
+        return None
+
+    #no token, we make the entry and generate a token for the client 
+    print("Connection refused, please contact your administrator and ask for a valid authentication code\n")
+    token = generate_token()
+    #add a part of teh client id as salt (I know... not optimal) and calculate the hash for the database.
+    #we NEVER save teh token in the server, we generate the file here, but the dea is to give the only copy to the client.
+    #We could use a symmetric key to encrypt it for extra security. Maybe if we have time...
+    token_db = hash_token(token, client_id[:16])
+    today = date.today()
+    until = today + relativedelta(years=1)
+    storage.add_user(client_id, token_db, today, until)
+    with open(str(client_id) + '.json', 'w') as f:
+        json.dump({'token': token}, f)
+        f.close()
+    return ('Request accepted.\nplease contact the administrator to receive a valid authentication token', 401) # terminate the connection
+
+def authorized_upload(store):
+    """Common path of the upload endpoints: session + token check, decrypt, then store(client_id, plaintext)"""
     try:
-        client_id = request.headers.get('X-Client-ID')
-        if not client_id or client_id not in client_sessions:
-            return jsonify({'error': 'Invalid or missing client ID'}), 401
-        #check if the clinet id exists and have a token to validate access
-        try:
-            conn = mysql.connector.connect(user='root', password='',
-                    host='127.0.0.1',
-                    database='project_CSS',
-                    use_pure=False)
-            cursor = conn.cursor(dictionary=True)
-            sql = f"SELECT * from users WHERE userid = %s AND valid = 1"
-            cursor.execute(sql, (client_id,))
-            users = cursor.fetchall()
-
-            if len(users) == 1:
-                user = users[0]
-                #authenticate token, use client_id first part as salt (not a good idea, but just testing is ok...)
-                client_token = hash_token(request.headers.get('token'), client_id[:16])
-                db_token = user['token']
-                current_date = date.today()
-                revoke_date = user['until']
-                if client_token != db_token:
-                    if conn.is_connected():
-                        conn.close()
-                        cursor.close()
-                    return jsonify('Connection refused...'), 401
-                if current_date >= revoke_date: #check the validity of the presented token
-                    sql = f"UPDATE users SET valid = 0 WHERE ID = %s"
-                    cursor.execute(sql, (user['ID'],))
-                    conn.commit()
-                    if conn.is_connected():
-                        conn.close()
-                        cursor.close()
-                    return jsonify('Invalid token, please contact your administrator...'), 401
-            else:
-                #no token, we make the entry and generate a token for the client 
-                print("Connection refused, please contact your administrator and ask for a valid authentication code\n")
-                token = generate_token()
-                #add a part of teh client id as salt (I know... not optimal) and calculate the hash for the database.
-                #we NEVER save teh token in the server, we generate the file here, but the dea is to give the only copy to the client.
-                #We could use a symmetric key to encrypt it for extra security. Maybe if we have time...
-                token_db = hash_token(token, client_id[:16])
-                today = date.today()
-                until = today + relativedelta(years=1)
-                sql = f"INSERT INTO users (userid, token, created, until) VALUES (%s, %s, %s, %s)"
-                cursor.execute(sql, (client_id, token_db, today, until))
-                conn.commit()
-                with open(str(client_id) + '.json', 'w') as f:
-                    json.dump({'token': token}, f)
-                    f.close()
-                if conn.is_connected():
-                    conn.close()
-                    cursor.close()
-                return jsonify('Request accepted.\nplease contact the administrator to receive a valid authentication token'), 401 # terminate the connection
-        except mysql.connector.Error as e:
-            return jsonify('Connection refused, please contact your administrator'), 401
-
-        if conn.is_connected():
-            conn.close()
-            cursor.close()
+        envelope = read_envelope(request.mimetype, request.get_data() if request.mimetype == wire.CONTENT_TYPE else request.json)
+    except (ValueError, TypeError) as e:
+        return jsonify('Malformed envelope: ' + str(e)), 400
+    return respond(process_upload(store, request.headers, envelope))
+
+def respond(result):
+    # (body, status) or (body, status, headers) to a Flask response
+    return (jsonify(result[0]),) + tuple(result[1:])
+
+def read_envelope(mimetype, body):
+    """Normalizes both envelope formats to {'nonce', 'ciphertext', 'signature', 'encoding', 'compression'}.
+    body is the raw request body for binary envelopes and the parsed JSON for the old base64 ones"""
+    if mimetype == wire.CONTENT_TYPE:
+        return wire.unpack_envelope(body)
+    # JSON envelope, still used by old clients
+    return {
+        'nonce': base64.b64decode(body.get('nonce', '')),
+        'ciphertext': base64.b64decode(body.get('ciphertext', '')),
+        'signature': base64.b64decode(body.get('signature', '')),
+        'encoding': body.get('encoding', 'json'),
+        'compression': body.get('compression'),
+    }
+
+def process_upload(store, headers, envelope):
+    try:
+        client_id = headers.get('X-Client-ID')
+        session = find_session(client_id, headers)
+        if session is None:
+            return ({'error': 'Invalid or missing client ID'}, 401)
 
-        
-        # Get client session
-        session = client_sessions[client_id]
-        
-        # Get encrypted data parts
-        nonce = base64.b64decode(request.json.get('nonce', ''))
-        ciphertext = base64.b64decode(request.json.get('ciphertext', ''))
-        signature = base64.b64decode(request.json.get('signature', ''))
-        
-        if not nonce or not ciphertext:
-            return jsonify('Missing encryption data'), 400
-        
-        # Decrypt the data
         try:
-            aesgcm = AESGCM(session['key'])
+            token = headers.get('token')
+            # skip the PBKDF2 + users query if we accepted this exact token recently
+            if auth_cache.get(client_id, token) is None:
+                refused = authenticate_client(client_id, token)
+                if refused:
+                    return refused
+            plaintext, refused = open_envelope(client_id, session, envelope)
+            if refused:
+                return refused
+            return store(client_id, plaintext, envelope['encoding'])
+        except StorageError as e:
+            return ('Connection refused, please contact your administrator', 401)
+            
+    except Exception as e:
+        return (str(e), 500)
+
+def open_envelope(client_id, session, envelope):
+    """Decrypt and verify the request body. Returns (plaintext, None) or (None, error response)"""
+    # Get encrypted data parts (memoryviews of the request body for binary envelopes, AES-GCM reads them in place)
+    nonce = envelope['nonce']
+    ciphertext = envelope['ciphertext']
+    signature = bytes(envelope['signature'])
+    
+    if not nonce or not ciphertext:
+        return None, ('Missing encryption data', 400)
+    
+    # Decrypt the data
+    try:
+        with stage('decrypt'):
+            aesgcm = AESGCM(session.key)
             plaintext = aesgcm.decrypt(nonce, ciphertext, None)
-        except Exception as e:
-            return jsonify(str(e)), 400
-        
-        # Verify signature 
-        if signature:
-            verify_key = load_public_key( KEY_FOLDER + "/" + client_id + "_public_key.pem")
-            try:
-                verify_key.verify(signature, plaintext, ec.ECDSA(hashes.SHA256()))
-            except InvalidSignature:
-                return jsonify('Invalid signature'), 400
-        
-        # Process the decrypted data
+    except Exception as e:
+        return None, (str(e), 400)
+    
+    # Uncompress, never past MAX_DECOMPRESSED_BYTES whatever the payload claims
+    if envelope.get('compression'):
         try:
-            data = json.loads(plaintext)
-                                            
-            try:
-                link = mysql.connector.connect(user='root', password='',
-                        host='127.0.0.1',
-                        database='project_CSS',
-                        use_pure=False)
-                cursor = link.cursor(dictionary=True)
-
-            except mysql.connector.Error as e:
-                filename = f'data_{uuid.uuid4().hex}.txt'
-                filepath = os.path.join(UPLOAD_FOLDER, filename)
-                with open(filepath, 'w') as f:
-                    f.write("Message received: " + str(datetime.now()) + "\nSender: " + client_id +"\n Message = "+ str(plaintext))
-                    f.close()
-                #I had these as json in the beggining but the client side is showing the entire thing.. so it looks ugly but it works
-                return jsonify('Something went wrong, please contact the network administrator'), 400  
-
-            #some columns have no default value and are NEEDED for teh insert to work, this is in purpose...
-            try:
-                data['user'] = client_id
-                columns = [x for x in data.keys()]
-                query = f"INSERT INTO data ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
-                cursor.execute(query, [data[column] for column in columns])
-                link.commit()
-                
-                if link.is_connected():
-                    link.close()
-                    cursor.close()
-                    
-                return jsonify({
-                    'status': 'success',
-                    'message': f'Data saved'
-                })
-            except Exception as e:
-                filename = f'data_{uuid.uuid4().hex}.txt'
-                filepath = os.path.join(UPLOAD_FOLDER, filename)
-                with open(filepath, 'w') as f:
-                    f.write("Message received: " + str(datetime.now()) + "\nSender: " + client_id +"\n Message = "+ str(plaintext))
-                    f.close()
-
-                return jsonify('Malformed data... please try again...'), 400
-                
-        except json.JSONDecodeError:
-            # Handle non-JSON data
-            filename = f'data_{uuid.uuid4().hex}.txt'
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
-            with open(filepath, 'w') as f:
-                f.write("Message received: " + str(datetime.now()) + "\nSender: " + client_id +"\n Message = "+ str(plaintext))
-                f.close()
-            return jsonify({
-                'status': 'success',
-                'message': f'Raw data saved as {filename}',
-                'size': len(plaintext)
-            })
+            with stage('decompress'):
+                plaintext = wire.decompress(plaintext, envelope['compression'], config.MAX_DECOMPRESSED_BYTES)
+        except ValueError as e:
+            return None, ('Malformed data... please try again... (' + str(e) + ')', 400)
+    
+    # Verify signature 
+    if signature:
+        with stage('verify_key'):
+            verify_key = verify_keys.get(client_id)
+        if verify_key is None:
+            return None, ('No verification key for this client', 400)
+        try:
+            with stage('verify'):
+                verify_key.verify(signature, plaintext, ec.ECDSA(hashes.SHA256()))
+        except InvalidSignature:
+            return None, ('Invalid signature', 400)
+
+    return plaintext, None
+
+@app.route('/api/upload', methods=['POST'])
+def upload_data():
+    # over its rate or server full: refuse before spending anything on the token check or the decryption
+    refused = admission.enter('upload', admission_key(request.headers, request.remote_addr))
+    if refused:
+        return respond(refused)
+    try:
+        if ingest is None:
+            return authorized_upload(store_record)
+        # queue full: same thing
+        if ingest.full():
+            return respond(queue_full())
+        return authorized_upload(queue_record)
+    finally:
+        admission.leave()
+
+@app.route('/api/upload_batch', methods=['POST'])
+def upload_batch():
+    # a batch counts as one upload, it is one PBKDF2 and one decryption
+    refused = admission.enter('upload', admission_key(request.headers, request.remote_addr))
+    if refused:
+        return respond(refused)
+    try:
+        return authorized_upload(store_batch)
+    finally:
+        admission.leave()
+
+def decode_record(client_id, plaintext, encoding):
+    """Returns (data, None), or (None, response) for data we can't decode"""
+    try:
+        return wire.decode_payload(plaintext, encoding), None
+    except ValueError:
+        # Handle data we can't decode
+        record_id = dead_letters.add(client_id, plaintext, 'not decodable', encoding)
+        return None, ({
+            'status': 'success',
+            'message': f'Raw data saved as dead letter {record_id}',
+            'size': len(plaintext)
+        }, 200)
+
+def store_record(client_id, plaintext, encoding='json'):
+    # Process the decrypted data
+    data, refused = decode_record(client_id, plaintext, encoding)
+    if refused:
+        return refused
+
+    #some columns have no default value and are NEEDED for teh insert to work, this is in purpose...
+    #(they are checked here now, against the table definition, so bad records never reach MySQL)
+    try:
+        if not isinstance(data, dict):
+            raise SchemaError('not a JSON object')
+        data['user'] = client_id
+        with stage('insert'):
+            storage.insert(data)
             
+        return {
+            'status': 'success',
+            'message': f'Data saved'
+        }, 200
+    except SchemaError as e:
+        dead_letters.add(client_id, plaintext, 'malformed data: ' + str(e), encoding)
+        return (f'Malformed data... please try again... ({e})', 400)
+    except StorageError:
+        # lost the database in the middle of the insert. storage.insert let the driver error out of the pool's
+        # block, so that connection was closed, not handed to the next request. The pool connection was only
+        # held for the insert itself, the token check and the decryption came before it
+        dead_letters.add(client_id, plaintext, 'database unavailable', encoding)
+        #I had these as json in the beggining but the client side is showing the entire thing.. so it looks ugly but it works
+        return ('Something went wrong, please contact the network administrator', 400)
+
+def queue_record(client_id, plaintext, encoding='json'):
+    # same checks as store_record, but the record goes to the write-behind queue and the writer inserts it
+    data, refused = decode_record(client_id, plaintext, encoding)
+    if refused:
+        return refused
+    try:
+        if not isinstance(data, dict):
+            raise SchemaError('not a JSON object')
+        data['user'] = client_id
+        storage.check(data)
+    except SchemaError as e:
+        dead_letters.add(client_id, plaintext, 'malformed data: ' + str(e), encoding)
+        return (f'Malformed data... please try again... ({e})', 400)
+    except StorageError:
+        # couldn't read the columns, the writer checks the record again anyway
+        pass
+    # it may have filled up while we were decrypting
+    if ingest.full():
+        return queue_full()
+    with stage('enqueue'):
+        ingest.put(client_id, data)
+    return {
+        'status': 'success',
+        'message': f'Data queued'
+    }, 200
+
+def queue_full():
+    ingest.rejected += 1
+    return ('Server busy, please try again later', 503, {'Retry-After': str(ingest.retry_after())})
+
+def store_batch(client_id, plaintext, encoding='json'):
+    # A batch is one envelope holding {"records": [{...}, {...}]} (a bare list is accepted too)
+    try:
+        batch = wire.decode_payload(plaintext, encoding)
+    except ValueError:
+        dead_letters.add(client_id, plaintext, 'not decodable', encoding)
+        return ('Malformed batch... please try again...', 400)
+    batch_records = batch.get('records') if isinstance(batch, dict) else batch
+    if not isinstance(batch_records, list) or not batch_records:
+        dead_letters.add(client_id, plaintext, 'malformed batch', encoding)
+        return ('Malformed batch... please try again...', 400)
+    if len(batch_records) > config.MAX_BATCH_RECORDS:
+        return (f'Too many records, the limit is {config.MAX_BATCH_RECORDS} per batch', 413)
+
+    results = [{'index': i, 'status': 'saved'} for i in range(len(batch_records))]
+
+    def dead_letter(index, reason):
+        # each record is kept on its own, in the encoding it came in (msgpack and cbor can carry bytes, JSON can't),
+        # so it can be replayed later
+        record_id = dead_letters.add(client_id, wire.encode_payload(batch_records[index], encoding), reason, encoding)
+        results[index] = {'index': index, 'status': 'dead_letter', 'error': reason, 'dead_letter_id': record_id}
+
+    # every record is checked in memory first, the good ones are written together (see storage.insert_many)
+    indexes = []
+    rows = []
+    for i, record in enumerate(batch_records):
+        if not isinstance(record, dict) or not record:
+            dead_letter(i, 'not a JSON object')
+            continue
+        record = dict(record)
+        record['user'] = client_id
+        indexes.append(i)
+        rows.append(record)
+    try:
+        for position, reason in (storage.insert_many(rows) if rows else []):
+            dead_letter(indexes[position], reason)
+    except StorageError:
+        # lost the database, nothing of this batch was committed so every record goes to the dead letters
+        for result in results:
+            if result['status'] == 'saved':
+                dead_letter(result['index'], 'database unavailable')
+
+    failed = sum(1 for result in results if result['status'] != 'saved')
+    return {
+        'status': 'success' if not failed else 'partial',
+        'saved': len(batch_records) - failed,
+        'failed': failed,
+        'results': results
+    }, 200
+
+
+def authorize_request(headers):
+    """Session + token check for endpoints that don't write to the data table.
+    Returns (client_id, session, None) or (None, None, (body, status))"""
+    client_id = headers.get('X-Client-ID')
+    session = find_session(client_id, headers)
+    if session is None:
+        return None, None, ({'error': 'Invalid or missing client ID'}, 401)
+    token = headers.get('token')
+    if auth_cache.get(client_id, token) is None:
+        try:
+            refused = authenticate_client(client_id, token)
+        except StorageError as e:
+            return None, None, ('Connection refused, please contact your administrator', 401)
+        if refused:
+            return None, None, refused
+    return client_id, session, None
+
+@app.route('/api/stream/start', methods=['POST'])
+def stream_start():
+    """Start (or resume, when upload_id is given) a chunked file upload"""
+    try:
+        client_id, session, refused = authorize_request(request.headers)
+        if refused:
+            body, status = refused
+            return jsonify(body), status
+        data = request.json or {}
+        body, status = stream_store.start(client_id, data.get('filename'), data.get('upload_id'), data.get('size'))
+        return jsonify(body), status
     except Exception as e:
         return jsonify(str(e)), 500
 
+@app.route('/api/stream/<upload_id>', methods=['GET'])
+def stream_status(upload_id):
+    try:
+        client_id, session, refused = authorize_request(request.headers)
+        if refused:
+            body, status = refused
+            return jsonify(body), status
+        body, status = stream_store.status(client_id, upload_id)
+        return jsonify(body), status
+    except Exception as e:
+        return jsonify(str(e)), 500
+
+@app.route('/api/stream/<upload_id>/<int:index>', methods=['PUT'])
+def stream_chunk(upload_id, index):
+    try:
+        # chunks have a fixed maximum size, don't even read bodies bigger than that
+        if request.content_length and request.content_length > stream_store.chunk_size + 1024:
+            return jsonify(f'Chunk too big, the limit is {stream_store.chunk_size} bytes'), 413
+        client_id, session, refused = authorize_request(request.headers)
+        if refused:
+            body, status = refused
+            return jsonify(body), status
+        body, status = stream_store.write_chunk(client_id, session.key, upload_id, index,
+                                                request.get_data(), verify_keys.get(client_id))
+        return jsonify(body), status
+    except Exception as e:
+        return jsonify(str(e)), 500
+
+REQUEST_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+def record_lines(client_id, session, filters, request_id):
+    rows = storage.read(client_id, filters)
+    try:
+        yield from records.stream_records(rows, session.key, filters['limit'], request_id, config.READ_CHUNK_ROWS)
+    finally:
+        rows.close()
+
+def resume_lines(first, lines):
+    # a generator (not itertools.chain) so closing it, when the client goes away, closes the query too
+    yield first
+    yield from lines
+
+def open_records(client_id, session, args):
+    """Starts reading a page of the client's records. Returns (NDJSON lines, request id, None) or (None, None, (body, status))"""
+    try:
+        filters = records.parse_query(args, max_limit=config.READ_PAGE_MAX)
+    except ValueError as e:
+        return None, None, ('Malformed query... please try again... (' + str(e) + ')', 400)
+    # the client's request id goes into the associated data of every chunk, so a response can't be replayed to it
+    request_id = args.get('request_id') or uuid.uuid4().hex
+    if not REQUEST_ID.match(request_id):
+        return None, None, ('Malformed query... please try again... (invalid request_id)', 400)
+    lines = record_lines(client_id, session, filters, request_id)
+    # run the query (and get the first chunk) now, while we can still answer with an error
+    try:
+        first = next(lines)
+    except StorageError as e:
+        return None, None, ('Connection refused, please contact your administrator', 401)
+    return resume_lines(first, lines), request_id, None
+
+@app.route('/api/records', methods=['GET'])
+def read_records():
+    """The client's records, one page at a time, as encrypted NDJSON chunks (see records.py)"""
+    try:
+        client_id, session, refused = authorize_request(request.headers)
+        if refused:
+            body, status = refused
+            return jsonify(body), status
+        lines, request_id, refused = open_records(client_id, session, request.args)
+        if refused:
+            body, status = refused
+            return jsonify(body), status
+        return Response(lines, mimetype='application/x-ndjson', headers={'X-Request-ID': request_id})
+    except Exception as e:
+        return jsonify(str(e)), 500
+
+def is_admin(headers):
+    # Simple auth check - in production use better auth
+    return headers.get('X-Admin-Token') == os.environ.get('ADMIN_TOKEN', 'admin_secret')
+
+def server_stats():
+    stats = {
+        # db_pool (mysql), sqlite or columnar, and schema
+        **storage.stats(),
+        'auth_cache': auth_cache.stats(),
+        'sessions': client_sessions.stats(),
+        'verify_keys': verify_keys.stats(),
+        'dead_letters': dead_letters.stats(),
+        'admission': admission.stats(),
+        'key_pool': key_pool.stats(),
+        'streams': stream_store.stats(),
+        # with several worker processes every number here is the one of the worker that answered
+        'worker': {'id': config.WORKER_ID, 'pid': os.getpid()}
+    }
+    if tickets is not None:
+        stats['tickets'] = tickets.stats()
+    if ingest is not None:
+        stats['ingest'] = ingest.stats()
+    return stats
+
+def refresh_schema():
+    return storage.refresh_schema()
+
+# every number of server_stats() is exported by /metrics as well
+metrics.add_stats(server_stats)
+
+def metrics_allowed(headers):
+    # Prometheus can send the admin token as a bearer token
+    return is_admin(headers) or headers.get('Authorization') == 'Bearer ' + os.environ.get('ADMIN_TOKEN', 'admin_secret')
+
+def revoke_user(client_id):
+    revoked = storage.revoke_user(client_id)
+    # cached verdicts must go as well, otherwise the client keeps uploading until the cache entry expires
+    auth_cache.invalidate(client_id)
+    if config.SESSION_STORE == 'sqlite':
+        # the other workers have their own auth cache
+        client_sessions.add_revocation(client_id)
+    return revoked
+
+@app.route('/api/stats', methods=['GET'])
+def stats():
+    """Admin endpoint to see how the server resources are used"""
+    if not is_admin(request.headers):
+        return jsonify('error : Unauthorized'), 401
+    return jsonify(server_stats())
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Stage timers, request counters and server_stats() in the Prometheus text format"""
+    if not metrics_allowed(request.headers):
+        return jsonify('error : Unauthorized'), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/revoke', methods=['POST'])
+def revoke_client():
+    """Admin endpoint to revoke a client token"""
+    if not is_admin(request.headers):
+        return jsonify('error : Unauthorized'), 401
+    client_id = (request.json or {}).get('client_id')
+    if not client_id:
+        return jsonify('Missing client ID'), 400
+    try:
+        revoked = revoke_user(client_id)
+    except StorageError as e:
+        return jsonify(str(e)), 500
+    return jsonify({
+        'status': 'success',
+        'revoked': revoked
+    })
+
+@app.route('/api/schema_refresh', methods=['POST'])
+def schema_refresh():
+    """Admin endpoint to reload the data table columns right away (after an ALTER TABLE)"""
+    if not is_admin(request.headers):
+        return jsonify('error : Unauthorized'), 401
+    try:
+        columns = refresh_schema()
+    except StorageError as e:
+        return jsonify(str(e)), 500
+    return jsonify({
+        'status': 'success',
+        'columns': columns
+    })
 
 @app.route('/api/session_cleanup', methods=['POST'])
 def cleanup_sessions():
     """Admin endpoint to cleanup old sessions"""
-    # Simple auth check - in production use better auth
-    if request.headers.get('X-Admin-Token') != os.environ.get('ADMIN_TOKEN', 'admin_secret'):
+    if not is_admin(request.headers):
         return jsonify('error : Unauthorized'), 401
     
-    # Current time
-    now = time.time()
-    # Max session age (2 hours)
-    max_age = 7200
-    
-    # Find expired sessions
-    expired = [client_id for client_id, session in client_sessions.items() 
-               if now - session['created_at'] > max_age]
-    
-    # Remove expired sessions
-    for client_id in expired:
-        del client_sessions[client_id]
+    # Sessions expire on their own (SESSION_TTL), this only forces the expired ones out right now
+    removed = client_sessions.expire()
     
     return jsonify({
         'status': 'success',
-        'removed': len(expired),
+        'removed': removed,
         'remaining': len(client_sessions)
     })
 
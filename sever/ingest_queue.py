@@ -0,0 +1,193 @@
+# ingest_queue.py - Write-behind queue between /api/upload and the data table
+# With INGEST_QUEUE=1 an upload is acknowledged as soon as the decrypted record is on disk in a local write-ahead
+# queue (a journal in received_messages/ingest), not after its INSERT and commit. A background writer drains the
+# queue into the data table with multi-row inserts and one commit per batch, so a slow database no longer holds up
+# every request. Past INGEST_HIGH_WATER queued records new uploads get a 503 with Retry-After.
+#
+# The position of the last written record is kept in the ingest_checkpoint table and updated in the same
+# transaction as the records, so after a crash the writer continues exactly where it stopped (nothing lost,
+# nothing inserted twice).
+
+import os
+import json
+import time
+import math
+import threading
+from collections import deque
+from journal import Journal, list_segments
+from schema import SchemaError
+from metrics import stage
+
+CHECKPOINT_TABLE = """CREATE TABLE IF NOT EXISTS ingest_checkpoint (
+  queue varchar(64) NOT NULL PRIMARY KEY,
+  segment varchar(64) NOT NULL,
+  position bigint NOT NULL
+)"""
+
+
+class IngestQueue:
+    def __init__(self, folder, storage, dead_letters, name='ingest', high_water=10000, batch_size=500,
+                 linger=0.01, max_segment_bytes=64 * 1024 * 1024, fsync=True):
+        self.storage = storage    # a SQL backend (storage.SQLStorage), the checkpoint goes in the same transaction
+        self.planner = storage.planner
+        self.dead_letters = dead_letters
+        self.name = name
+        self.high_water = high_water
+        self.batch_size = batch_size
+        self.linger = linger     # seconds the writer waits for a batch to fill up before committing what it has
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        # segments left by the last run, records after the checkpoint in them were never written to the database
+        self._old_segments = list_segments(folder, name)
+        self.journal = Journal(folder, name, max_segment_bytes=max_segment_bytes, fsync=fsync)
+
+        self._pending = deque()    # (segment, offset, client_id, record) in journal order
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._recovered = False
+        self._checkpoint_segment = ''
+
+        self.enqueued = 0
+        self.committed = 0
+        self.commits = 0
+        self.last_batch = 0
+        self.drain_rate = 0.0      # records per second the writer gets into the database (moving average)
+        self.rejected = 0          # uploads refused with a 503
+        self.dead_lettered = 0
+        self.errors = 0
+
+        self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def full(self):
+        return len(self._pending) >= self.high_water
+
+    def retry_after(self):
+        """Seconds a refused client should wait: roughly the time the writer needs to drain the queue"""
+        if not self.drain_rate:
+            return 30
+        return max(1, min(30, math.ceil(len(self._pending) / self.drain_rate)))
+
+    def put(self, client_id, record):
+        """Queues one record (a dict with the user column set) and returns once it is durable"""
+        payload = json.dumps(record, default=str).encode('utf-8')
+        # write and queue under one lock so the in-memory order is the journal order (the checkpoint relies on it),
+        # the fsync happens outside so concurrent uploads share it
+        with self._lock:
+            path, offset, seq = self.journal.write({'client_id': client_id}, payload)
+            self._pending.append((os.path.basename(path), offset, client_id, record))
+            self.enqueued += 1
+            self._ready.notify()
+        self.journal.sync(seq)
+
+    def _run(self):
+        while True:
+            try:
+                if not self._recovered:
+                    self._recover()
+                self._write(self._next_batch())
+            except Exception as e:
+                # database down or no free connection: the records stay queued, try again in a moment
+                self.errors += 1
+                print(f"Ingest writer: {e}")
+                time.sleep(1)
+
+    def _recover(self):
+        with self.storage.transaction() as (conn, cursor):
+            cursor.execute(CHECKPOINT_TABLE)
+            cursor.execute("SELECT segment, position FROM ingest_checkpoint WHERE queue = %s", (self.name,))
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute("INSERT INTO ingest_checkpoint (queue, segment, position) VALUES (%s, %s, %s)",
+                               (self.name, '', -1))
+        done_segment, done_position = row or ('', -1)
+
+        recovered = []
+        for path in self._old_segments:
+            segment = os.path.basename(path)
+            if segment < done_segment:
+                continue
+            for offset, meta, payload in Journal.read(path):
+                if segment == done_segment and offset <= done_position:
+                    continue
+                recovered.append((segment, offset, meta['client_id'], json.loads(payload)))
+        if recovered:
+            print(f"Ingest queue: {len(recovered)} records from the last run still to write")
+        with self._lock:
+            # they are older than anything queued since we started
+            self._pending.extendleft(reversed(recovered))
+            self._recovered = True
+        self._drop_segments(done_segment)
+
+    def _next_batch(self):
+        with self._lock:
+            while not self._pending:
+                self._ready.wait()
+            deadline = time.monotonic() + self.linger
+            while len(self._pending) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._ready.wait(remaining)
+            return [self._pending[i] for i in range(min(self.batch_size, len(self._pending)))]
+
+    def _write(self, batch):
+        start = time.monotonic()
+        rejected = []
+        with stage('ingest_commit'), self.storage.transaction() as (conn, cursor):
+            # records with the same columns go in one multi-row INSERT, the whole batch is one transaction
+            groups = {}
+            for segment, offset, client_id, record in batch:
+                try:
+                    columns, values = self.planner.plan(conn, record)
+                except SchemaError as e:
+                    rejected.append((client_id, record, 'malformed data: ' + str(e)))
+                    continue
+                groups.setdefault(columns, []).append(((client_id, record), values))
+            # the bad rows are found one by one, like the batch endpoint does
+            for (client_id, record), reason in self.storage.write_groups(cursor, groups):
+                rejected.append((client_id, record, reason))
+            segment, offset = batch[-1][:2]
+            cursor.execute("UPDATE ingest_checkpoint SET segment = %s, position = %s WHERE queue = %s",
+                           (segment, offset, self.name))
+
+        # only now, a failed commit would write the batch again and dead-letter these twice
+        for client_id, record, reason in rejected:
+            self.dead_letters.add(client_id, json.dumps(record, default=str).encode('utf-8'), reason)
+        with self._lock:
+            for _ in batch:
+                self._pending.popleft()
+        self.dead_lettered += len(rejected)
+        self.committed += len(batch)
+        self.commits += 1
+        self.last_batch = len(batch)
+        rate = len(batch) / max(time.monotonic() - start, 1e-6)
+        self.drain_rate = rate if not self.drain_rate else 0.8 * self.drain_rate + 0.2 * rate
+        if segment != self._checkpoint_segment:
+            self._drop_segments(segment)
+
+    def _drop_segments(self, segment):
+        # every record of the segments before the checkpoint one is in the database
+        self._checkpoint_segment = segment
+        for path in list_segments(self.folder, self.name):
+            if os.path.basename(path) < segment and path != self.journal.current_segment:
+                os.remove(path)
+
+    def stats(self):
+        return {
+            'depth': len(self._pending),
+            'high_water': self.high_water,
+            'enqueued': self.enqueued,
+            'committed': self.committed,
+            'commits': self.commits,
+            'last_batch': self.last_batch,
+            'avg_batch': round(self.committed / self.commits, 1) if self.commits else 0,
+            'drain_rate': round(self.drain_rate, 1),
+            'rejected': self.rejected,
+            'dead_lettered': self.dead_lettered,
+            'errors': self.errors,
+            'fsyncs': self.journal.syncs,
+        }
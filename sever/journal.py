@@ -0,0 +1,146 @@
+# journal.py - Append-only, segmented log on local disk
+# Records are appended to segment files (<prefix>-00000001.log, ...) that rotate once they pass a size limit.
+# Each record is framed as
+#
+#   magic (4 bytes) | metadata length (4) | payload length (4) | CRC32 of metadata + payload (4) | metadata (JSON) | payload
+#
+# so the payload is kept byte for byte. Appends use group commit: a writer waits until its record is on disk, but
+# a single fsync covers every record written so far, so many concurrent writers share one fsync.
+
+import os
+import json
+import zlib
+import struct
+import threading
+
+MAGIC = b'JNL1'
+RECORD = struct.Struct('!4sIII')
+
+
+def list_segments(folder, prefix):
+    """Segment files in the order they were written"""
+    names = [name for name in os.listdir(folder)
+             if name.startswith(prefix + '-') and name.endswith('.log')]
+    return [os.path.join(folder, name) for name in sorted(names)]
+
+
+class Journal:
+    def __init__(self, folder, prefix, max_segment_bytes=64 * 1024 * 1024, fsync=True):
+        self.folder = folder
+        self.prefix = prefix
+        self.max_segment_bytes = max_segment_bytes
+        self.fsync = fsync
+        os.makedirs(folder, exist_ok=True)
+
+        self._lock = threading.Lock()        # protects the current file and the write counter
+        self._sync_lock = threading.Lock()   # one fsync (or rotation) at a time
+        self._written = 0
+        self._synced = 0
+        self.syncs = 0
+
+        # always start a new segment, the last one may end with a record torn by a crash.
+        # It's only created with the first record, so restarts don't leave empty segments around
+        existing = self.segments()
+        self._segment_no = self._number(existing[-1]) + 1 if existing else 1
+        self._path = self._segment_path(self._segment_no)
+        self._file = None
+        self._size = 0
+
+    def _number(self, path):
+        return int(os.path.basename(path)[len(self.prefix) + 1:-4])
+
+    def _segment_path(self, number):
+        return os.path.join(self.folder, f'{self.prefix}-{number:08d}.log')
+
+    def _open_segment(self):
+        self._path = self._segment_path(self._segment_no)
+        self._file = open(self._path, 'ab')
+        self._size = self._file.tell()
+
+    def segments(self):
+        return list_segments(self.folder, self.prefix)
+
+    @property
+    def current_segment(self):
+        return self._path
+
+    def append(self, meta, payload):
+        """Writes one record and returns once it is durable. Returns (segment path, offset)"""
+        path, offset, seq = self.write(meta, payload)
+        self.sync(seq)
+        return path, offset
+
+    def write(self, meta, payload):
+        """Writes one record without waiting for the disk. Returns (segment path, offset, seq), pass seq to sync()
+        to wait until the record is durable. Callers that need the records in order can call this under their own lock"""
+        meta_bytes = json.dumps(meta).encode('utf-8')
+        payload = bytes(payload)
+        crc = zlib.crc32(payload, zlib.crc32(meta_bytes))
+        record = RECORD.pack(MAGIC, len(meta_bytes), len(payload), crc) + meta_bytes + payload
+        with self._lock:
+            if self._file is None:
+                self._open_segment()
+            path = self._path
+            offset = self._size
+            self._file.write(record)
+            self._size += len(record)
+            self._written += 1
+            return path, offset, self._written
+
+    def sync(self, seq):
+        with self._sync_lock:
+            # somebody else's fsync may already have covered our record
+            if self._synced >= seq:
+                return
+            with self._lock:
+                target = self._written
+                self._file.flush()
+                fd = self._file.fileno()
+            if self.fsync:
+                os.fsync(fd)
+            self._synced = target
+            self.syncs += 1
+            # rotating here (holding the sync lock) means nobody is fsyncing the file we close
+            if self._size >= self.max_segment_bytes:
+                with self._lock:
+                    # records written since our fsync are in this file too, make them durable before closing it
+                    self._file.flush()
+                    if self.fsync:
+                        os.fsync(self._file.fileno())
+                    self._synced = self._written
+                    self._file.close()
+                    self._segment_no += 1
+                    self._path = self._segment_path(self._segment_no)
+                    self._file = None
+                    self._size = 0
+
+    def close(self):
+        with self._sync_lock, self._lock:
+            if self._file is None:
+                return
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._file.close()
+
+    @staticmethod
+    def read(path):
+        """Yields (offset, meta, payload) for every complete record of a segment.
+        Stops at the first torn or corrupted record (the tail of a segment that was being written during a crash)"""
+        with open(path, 'rb') as f:
+            offset = 0
+            while True:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    return
+                magic, meta_len, payload_len, crc = RECORD.unpack(header)
+                if magic != MAGIC:
+                    return
+                meta_bytes = f.read(meta_len)
+                payload = f.read(payload_len)
+                if len(meta_bytes) < meta_len or len(payload) < payload_len:
+                    return
+                if zlib.crc32(payload, zlib.crc32(meta_bytes)) != crc:
+                    return
+                yield offset, json.loads(meta_bytes), payload
+                offset += RECORD.size + meta_len + payload_len
@@ -0,0 +1,108 @@
+# key_cache.py - Parsed signature verification keys
+# Loading a client key means reading keys/<client_id>_public_key.pem and parsing the PEM on every signed upload.
+# We keep the parsed keys in memory and only look at the file again (a stat, not a read) every few seconds
+# to notice when a key was replaced. Clients without a key file are remembered too.
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from tools import load_public_key
+
+KEY_SUFFIX = '_public_key.pem'
+
+
+class _KeyEntry:
+    __slots__ = ('key', 'file_id', 'check_at')
+
+    def __init__(self, key, file_id, check_at):
+        self.key = key            # parsed public key, None if the client has no key file
+        self.file_id = file_id    # (mtime, inode, size) of the file we parsed, None if it didn't exist
+        self.check_at = check_at  # don't look at the file again before this time
+
+
+class VerifyKeyCache:
+    def __init__(self, folder, recheck=5.0, negative_ttl=30.0, max_entries=100000):
+        self.folder = folder
+        self.recheck = recheck
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+        self.missing = 0
+
+    def _path(self, client_id):
+        return os.path.join(self.folder, client_id + KEY_SUFFIX)
+
+    def _store(self, client_id, entry):
+        with self._lock:
+            self._keys[client_id] = entry
+            self._keys.move_to_end(client_id)
+            while len(self._keys) > self.max_entries:
+                self._keys.popitem(last=False)
+
+    def get(self, client_id):
+        """Returns the parsed verification key of a client, or None if there is no key for it"""
+        # the client id comes from a request header, never let it point outside the keys folder
+        if not client_id or os.path.basename(client_id) != client_id:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._keys.get(client_id)
+            if entry is not None and now < entry.check_at:
+                self._keys.move_to_end(client_id)
+                self.hits += 1
+                return entry.key
+
+        path = self._path(client_id)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.missing += 1
+            self._store(client_id, _KeyEntry(None, None, now + self.negative_ttl))
+            return None
+
+        file_id = (st.st_mtime_ns, st.st_ino, st.st_size)
+        if entry is not None and entry.file_id == file_id:
+            # same file as before, just push the next check forward
+            entry.check_at = now + self.recheck
+            with self._lock:
+                self.hits += 1
+            return entry.key
+
+        key = load_public_key(path)
+        with self._lock:
+            self.loads += 1
+        self._store(client_id, _KeyEntry(key, file_id, now + self.recheck))
+        return key
+
+    def preload(self):
+        """Parse every key in the folder up front, returns how many were loaded"""
+        loaded = 0
+        for name in os.listdir(self.folder):
+            if name.endswith(KEY_SUFFIX):
+                try:
+                    if self.get(name[:-len(KEY_SUFFIX)]) is not None:
+                        loaded += 1
+                except Exception as e:
+                    print(f"Could not load verification key {name}: {e}")
+        return loaded
+
+    def invalidate(self, client_id=None):
+        with self._lock:
+            if client_id is None:
+                self._keys.clear()
+            else:
+                self._keys.pop(client_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._keys),
+                'hits': self.hits,
+                'loads': self.loads,
+                'missing': self.missing,
+            }
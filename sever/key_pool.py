@@ -0,0 +1,92 @@
+# key_pool.py - Ephemeral server ECDH key pairs for the key exchange
+# With one static server key every session key comes from the same private key: whoever gets hold of it (and
+# recorded the key exchanges) can work out every session key, past ones included. A new key pair per key exchange,
+# thrown away right after, fixes that (forward secrecy), but generating it and serializing its public key would
+# be paid inside the handshake. So a background thread keeps up to `size` key pairs ready, public key already
+# in PEM, and a key exchange only pops one.
+#
+# If reconnect storms empty the pool, `fallback` says what happens: 'generate' makes a key pair on the spot (still
+# forward secret, a bit slower), 'static' uses the static server key (SERVER_KEY_FILE, like before the pool).
+# With size 0 there is no pool and every key exchange takes the fallback.
+
+import time
+import threading
+from collections import deque
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives import serialization
+from metrics import stage
+
+
+def generate_key_pair():
+    """(private key, public key PEM)"""
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    public_pem = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode()
+    return private_key, public_pem
+
+
+class KeyPool:
+    def __init__(self, size=64, refill_rate=0.0, fallback='generate', static_key=None):
+        if fallback not in ('generate', 'static'):
+            raise ValueError(f"Unknown key pool fallback {fallback!r} (generate or static)")
+        if fallback == 'static' and static_key is None:
+            raise ValueError("The static fallback needs the static server key")
+        self.size = size
+        self.refill_rate = refill_rate      # most key pairs made per second, 0 = as fast as they are used
+        self.fallback = fallback
+        self.static_key = static_key        # (private key, public key PEM)
+        self._keys = deque()
+        self._cond = threading.Condition()
+        self.taken = 0
+        self.generated = 0                  # by the refill thread
+        self.underflows = 0                 # key exchanges that found the pool empty
+        self.fallback_generated = 0
+        self.fallback_static = 0
+        if size > 0:
+            self._thread = threading.Thread(target=self._run, name='key-pool', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while len(self._keys) >= self.size:
+                    self._cond.wait()
+            start = time.perf_counter()
+            key = generate_key_pair()
+            with self._cond:
+                self._keys.append(key)
+                self.generated += 1
+            if self.refill_rate > 0:
+                # spread the refill out, a storm of key exchanges doesn't turn into a storm of key generation
+                time.sleep(max(0.0, 1 / self.refill_rate - (time.perf_counter() - start)))
+
+    def take(self):
+        """A key pair for one key exchange: (private key, public key PEM). Don't use it for anything else"""
+        with self._cond:
+            self.taken += 1
+            if self._keys:
+                key = self._keys.popleft()
+                # wake the refill thread
+                self._cond.notify()
+                return key
+            self.underflows += 1
+            if self.fallback == 'static':
+                self.fallback_static += 1
+                return self.static_key
+            self.fallback_generated += 1
+        with stage('key_generate'):
+            return generate_key_pair()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self.size,
+                'available': len(self._keys),
+                'taken': self.taken,
+                'generated': self.generated,
+                'underflows': self.underflows,
+                'fallback_generated': self.fallback_generated,
+                'fallback_static': self.fallback_static,
+            }
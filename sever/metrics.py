@@ -0,0 +1,173 @@
+# metrics.py - Per-stage timers, request counters and the Prometheus /metrics output
+# Wrap a step in `with stage('decrypt'):` and its duration goes to a histogram (https_stage_seconds) and to the
+# trace of the request being served. Every request gets a trace (begin/finish, called from the app hooks) that
+# ends up in https_request_seconds, in the https_requests_total counters and, when it was slow, maybe in the
+# slow-request log with the time of each of its stages. A timer is two perf_counter() calls and a bisect under a lock.
+
+import time
+import random
+import bisect
+import logging
+import threading
+import contextvars
+
+# seconds, from 50 us (a cached AES-GCM decrypt) to 10 s (a database that went away)
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, name, help_text, label, buckets=BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series = {}     # label value -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(value)
+            if series is None:
+                series = self._series[value] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[i] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {value: list(counts) for value, counts in self._series.items()}
+        for value, counts in sorted(series.items()):
+            label = f'{self.label}="{value}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {cumulative + counts[len(self.buckets)]}')
+            lines.append(f'{self.name}_sum{{{label}}} {counts[-2]:.6f}')
+            lines.append(f'{self.name}_count{{{label}}} {counts[-1]}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}     # tuple of label values -> count
+        self._lock = threading.Lock()
+
+    def inc(self, *values):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = dict(self._values)
+        for key, count in sorted(values.items()):
+            labels = ','.join(f'{label}="{value}"' for label, value in zip(self.labels, key))
+            lines.append(f'{self.name}{{{labels}}} {count}')
+        return lines
+
+
+class Trace:
+    __slots__ = ('endpoint', 'client_id', 'start', 'stages')
+
+    def __init__(self, endpoint, client_id):
+        self.endpoint = endpoint
+        self.client_id = client_id
+        self.start = time.perf_counter()
+        self.stages = []      # (stage, seconds) in the order they ran
+
+
+stage_times = Histogram('https_stage_seconds', 'Time spent in each step of a request', 'stage')
+request_times = Histogram('https_request_seconds', 'Time to answer a request', 'endpoint')
+outcomes = Counter('https_requests_total', 'Answered requests', ('endpoint', 'status', 'outcome'))
+
+_trace = contextvars.ContextVar('trace', default=None)
+_gauges = []          # functions returning a dict of stats, see add_stats()
+
+slow_log = logging.getLogger('slow_requests')
+slow_log.propagate = False
+slow_threshold = None
+slow_sample = 1.0
+
+
+class stage:
+    """with stage('pbkdf2'): ...  times the block"""
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        stage_times.observe(self.name, elapsed)
+        trace = _trace.get()
+        if trace is not None:
+            trace.stages.append((self.name, elapsed))
+
+
+def configure_slow_log(path, threshold_ms, sample=1.0):
+    """Log requests slower than threshold_ms (a sample of them) with the time of each stage"""
+    global slow_threshold, slow_sample
+    if not path:
+        return
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    slow_log.addHandler(handler)
+    slow_log.setLevel(logging.INFO)
+    slow_threshold = threshold_ms / 1000
+    slow_sample = sample
+
+def add_stats(source):
+    """source() returns a dict of dicts of numbers (like server_stats), exported as gauges https_<section>_<name>"""
+    _gauges.append(source)
+
+def begin(endpoint, client_id=None):
+    _trace.set(Trace(endpoint, client_id))
+
+def outcome(status, trace):
+    # the message went to the dead-letter log (not decodable, unknown columns, database down...)
+    if any(name == 'dead_letter' for name, _ in trace.stages):
+        return 'dead_lettered'
+    if status == 200:
+        return 'success'
+    if status == 401:
+        return 'unauthorized'
+    if status == 400:
+        return 'malformed'
+    if status in (413, 429, 503):
+        return 'refused'
+    return 'error'
+
+def finish(status):
+    trace = _trace.get()
+    if trace is None:
+        return
+    _trace.set(None)
+    elapsed = time.perf_counter() - trace.start
+    request_times.observe(trace.endpoint, elapsed)
+    outcomes.inc(trace.endpoint, str(status), outcome(status, trace))
+    if slow_threshold is not None and elapsed >= slow_threshold and random.random() < slow_sample:
+        steps = ' '.join(f'{name}={seconds * 1000:.2f}ms' for name, seconds in trace.stages)
+        slow_log.info(f'{trace.endpoint} {status} {elapsed * 1000:.1f}ms client={trace.client_id} {steps}')
+
+def render():
+    """Everything in the Prometheus text format"""
+    lines = request_times.render() + stage_times.render() + outcomes.render()
+    for source in _gauges:
+        for section, values in source().items():
+            if not isinstance(values, dict):
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f'# TYPE https_{section}_{key} gauge')
+                    lines.append(f'https_{section}_{key} {value}')
+    return '\n'.join(lines) + '\n'
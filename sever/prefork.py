@@ -0,0 +1,119 @@
+# prefork.py - Run the server as several worker processes
+# One Python process does the PBKDF2, ECDH, AES-GCM and ECDSA work of every request on a single core (the GIL).
+# This opens the listening socket once and forks SERVER_WORKERS workers that all accept connections on it, so
+# uploads are spread over every core of the machine. Workers that die are started again.
+#
+# What the workers have to agree on is kept in files: the sessions and revocations (SESSION_STORE=sqlite,
+# SESSION_DB), the session ticket keys and, with KEY_POOL_FALLBACK=static, the static server ECDH key
+# (SERVER_KEY_FILE). Each worker has its own database pool, caches, metrics, dead-letter journal, ingest queue and
+# pool of ephemeral server keys.
+#
+# Run with:
+#   python3 prefork.py --workers 4            (Flask server, https_server.py)
+#   python3 prefork.py --workers 4 --async    (async_server.py, needs quart and hypercorn)
+
+import os
+import sys
+import time
+import signal
+import socket
+import argparse
+import config
+
+
+def serve_flask(sock, host, port, ssl_context):
+    from werkzeug.serving import make_server
+    import https_server
+    server = make_server(host, port, https_server.app, threaded=True, ssl_context=ssl_context, fd=sock.fileno())
+    server.serve_forever()
+
+def serve_async(sock, ssl_context):
+    import asyncio
+    from hypercorn.config import Config
+    from hypercorn.asyncio import serve
+    import async_server
+    hypercorn_config = Config()
+    hypercorn_config.bind = [f'fd://{sock.fileno()}']
+    if ssl_context:
+        hypercorn_config.certfile, hypercorn_config.keyfile = ssl_context
+    hypercorn_config.keep_alive_timeout = config.ASYNC_KEEP_ALIVE
+    asyncio.run(serve(async_server.app, hypercorn_config))
+
+def start_worker(worker_id, sock, args, ssl_context):
+    pid = os.fork()
+    if pid:
+        return pid
+    # in the worker: the server modules are imported only now, so the pools, threads and files are its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    config.WORKER_ID = worker_id
+    try:
+        if args.use_async:
+            serve_async(sock, ssl_context)
+        else:
+            serve_flask(sock, args.host, args.port, ssl_context)
+    except Exception as e:
+        print(f"Worker {worker_id}: {e}")
+    os._exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the server with several worker processes')
+    parser.add_argument('--workers', type=int, default=config.SERVER_WORKERS, help='Worker processes')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--async', dest='use_async', action='store_true', help='Serve async_server.py instead of https_server.py')
+    args = parser.parse_args()
+
+    ssl_context = ('cert.pem', 'key.pem')
+    if not os.path.exists('cert.pem') or not os.path.exists('key.pem'):
+        print("SSL certificates not found. Create them with:")
+        print("openssl req -x509 -newkey rsa:4096 -nodes -out cert.pem -keyout key.pem -days 365")
+        print("The server is not secure, please create the SSL certificates and start again\n")
+        ssl_context = None
+
+    # the workers can't share memory, sessions have to go to the shared store
+    if args.workers > 1 and config.SESSION_STORE != 'sqlite':
+        print(f"Using the SQLite session store ({config.SESSION_DB}) so every worker sees every session")
+        config.SESSION_STORE = 'sqlite'
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+
+    workers = {}   # pid -> worker id
+    for worker_id in range(args.workers):
+        workers[start_worker(worker_id, sock, args, ssl_context)] = worker_id
+    print(f"Serving on {args.host}:{args.port} with {args.workers} workers")
+
+    stopping = False
+
+    def stop(signum, frame):
+        global stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        worker_id = workers.pop(pid, None)
+        if worker_id is None or stopping:
+            continue
+        print(f"Worker {worker_id} exited ({status}), starting it again")
+        # don't spin if it dies right away (port problem, broken config...)
+        time.sleep(1)
+        workers[start_worker(worker_id, sock, args, ssl_context)] = worker_id
+    sys.exit(0)
@@ -56,6 +56,31 @@ CREATE TABLE `users` (
   `accessed` timestamp NOT NULL DEFAULT current_timestamp() ON UPDATE current_timestamp()
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
 
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `dead_letter_replayed`
+-- (dead-letter records already replayed into `data`, used by dead_letter.py)
+--
+
+CREATE TABLE `dead_letter_replayed` (
+  `record_id` char(32) NOT NULL,
+  `replayed` timestamp NOT NULL DEFAULT current_timestamp()
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `ingest_checkpoint`
+-- (last record of the write-behind queue written to `data`, used by ingest_queue.py)
+--
+
+CREATE TABLE `ingest_checkpoint` (
+  `queue` varchar(64) NOT NULL,
+  `segment` varchar(64) NOT NULL,
+  `position` bigint(20) NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
 --
 -- Dumping data for table `users`
 --
@@ -71,13 +96,27 @@ INSERT INTO `users` (`ID`, `userid`, `token`, `created`, `until`, `valid`, `acce
 -- Indexes for table `data`
 --
 ALTER TABLE `data`
-  ADD PRIMARY KEY (`ID`);
+  ADD PRIMARY KEY (`ID`),
+  ADD KEY `user_date` (`user`,`date`);
+
+--
+-- Indexes for table `dead_letter_replayed`
+--
+ALTER TABLE `dead_letter_replayed`
+  ADD PRIMARY KEY (`record_id`);
+
+--
+-- Indexes for table `ingest_checkpoint`
+--
+ALTER TABLE `ingest_checkpoint`
+  ADD PRIMARY KEY (`queue`);
 
 --
 -- Indexes for table `users`
 --
 ALTER TABLE `users`
-  ADD PRIMARY KEY (`ID`);
+  ADD PRIMARY KEY (`ID`),
+  ADD UNIQUE KEY `userid` (`userid`);
 
 --
 -- AUTO_INCREMENT for dumped tables
@@ -0,0 +1,106 @@
+# records.py - Reading stored records back (GET /api/records)
+# A client can read the records it uploaded, optionally only those of some dates (date_from/date_to) or changed
+# since some time (updated_since). Pages are found with keyset pagination: the records are ordered by (date, ID)
+# and the next page starts after the last (date, ID) of this one, so page 1000 costs the same as page 1
+# (the data(user, date) index of project_CSS.sql does the work, no OFFSET scanning).
+#
+# build_query is the SQL of a page for the SQL storage backends (storage.py), the columnar one filters the same way.
+# The page is streamed as it is read from storage, as NDJSON: one line per chunk of READ_CHUNK_ROWS records
+#
+#   {"index": 0, "final": false, "nonce": base64, "ciphertext": base64}
+#
+# each one encrypted with the session key. The plaintext of a chunk is {"records": [...]}, the last one (final)
+# also has "next", the cursor of the next page (null when there are no more records). The request id, the chunk
+# index and the final flag are the associated data, so chunks can't be reordered, replayed in another response or
+# dropped from the end without the client noticing.
+
+import os
+import json
+import base64
+import binascii
+from datetime import date, datetime
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import wire
+
+
+def decode_cursor(token):
+    try:
+        last_date, last_id = json.loads(base64.urlsafe_b64decode(token))
+        return date.fromisoformat(last_date), int(last_id)
+    except (binascii.Error, ValueError, TypeError):
+        raise ValueError('invalid cursor')
+
+def encode_cursor(row):
+    return base64.urlsafe_b64encode(json.dumps([str(row['date']), row['ID']]).encode()).decode()
+
+def parse_query(args, max_limit=1000, default_limit=100):
+    """The filters of a read request (query string arguments), raises ValueError if one of them is wrong"""
+    filters = {}
+    if args.get('date_from'):
+        filters['date_from'] = date.fromisoformat(args['date_from'])
+    if args.get('date_to'):
+        filters['date_to'] = date.fromisoformat(args['date_to'])
+    if args.get('updated_since'):
+        filters['updated_since'] = datetime.fromisoformat(args['updated_since'])
+    limit = int(args.get('limit') or default_limit)
+    if not 1 <= limit <= max_limit:
+        raise ValueError(f'limit must be between 1 and {max_limit}')
+    filters['limit'] = limit
+    if args.get('after'):
+        filters['after'] = decode_cursor(args['after'])
+    return filters
+
+def build_query(client_id, filters):
+    conditions = ['user = %s']
+    params = [client_id]
+    if 'date_from' in filters:
+        conditions.append('date >= %s')
+        params.append(filters['date_from'])
+    if 'date_to' in filters:
+        conditions.append('date <= %s')
+        params.append(filters['date_to'])
+    if 'updated_since' in filters:
+        conditions.append('updated >= %s')
+        params.append(filters['updated_since'])
+    if 'after' in filters:
+        last_date, last_id = filters['after']
+        conditions.append('(date > %s OR (date = %s AND ID > %s))')
+        params.extend((last_date, last_date, last_id))
+    # one row more than asked for tells us if there is a next page
+    params.append(filters['limit'] + 1)
+    return f"SELECT * FROM data WHERE {' AND '.join(conditions)} ORDER BY date, ID LIMIT %s", params
+
+def _encrypt_line(aesgcm, request_id, index, final, body):
+    nonce = os.urandom(wire.NONCE_SIZE)
+    plaintext = json.dumps(body, default=str).encode('utf-8')
+    ciphertext = aesgcm.encrypt(nonce, plaintext, wire.read_chunk_aad(request_id, index, final))
+    return json.dumps({
+        'index': index,
+        'final': final,
+        'nonce': base64.b64encode(nonce).decode(),
+        'ciphertext': base64.b64encode(ciphertext).decode()
+    }) + '\n'
+
+def stream_records(rows, key, limit, request_id, chunk_rows=100):
+    """Yields the NDJSON lines of one page. rows are the records as the storage backend reads them (at most
+    limit + 1, in (date, ID) order), they are encrypted and sent chunk by chunk"""
+    aesgcm = AESGCM(key)
+    index = 0
+    count = 0
+    chunk = []
+    last = None
+    next_cursor = None
+    for row in rows:
+        if count == limit:
+            # the extra row: there is a next page, it starts after the last row we send
+            next_cursor = encode_cursor(last)
+            break
+        # a full chunk only goes out once we know it isn't the last one
+        if len(chunk) == chunk_rows:
+            yield _encrypt_line(aesgcm, request_id, index, False, {'records': chunk})
+            index += 1
+            chunk = []
+        chunk.append(row)
+        last = row
+        count += 1
+    yield _encrypt_line(aesgcm, request_id, index, True, {'records': chunk, 'next': next_cursor})
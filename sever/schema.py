@@ -0,0 +1,183 @@
+# schema.py - Column catalog of the data table and the insert planner built on it
+# Before, MySQL was the only one checking uploads: a misspelled key (PersonAge instead of Age) cost a round trip,
+# an exception and a dead letter. We now read the table definition from INFORMATION_SCHEMA once, keep it cached
+# (refreshed every SCHEMA_TTL seconds, on /api/schema_refresh, or when MySQL reports an unknown column) and check and
+# convert every record in memory. Valid records are written with prepared statements, one per set of columns,
+# so MySQL doesn't parse the INSERT again for every message.
+
+import time
+import weakref
+import threading
+from datetime import date, datetime
+
+INT_TYPES = {'tinyint', 'smallint', 'mediumint', 'int', 'integer', 'bigint'}
+FLOAT_TYPES = {'float', 'double', 'decimal', 'real'}
+TEXT_TYPES = {'char', 'varchar', 'tinytext', 'text', 'mediumtext', 'longtext'}
+
+
+class SchemaError(ValueError):
+    pass
+
+
+class Column:
+    __slots__ = ('name', 'data_type', 'nullable', 'required', 'max_length')
+
+    def __init__(self, name, data_type, nullable, required, max_length):
+        self.name = name
+        self.data_type = data_type
+        self.nullable = nullable
+        self.required = required      # NOT NULL, no default and not auto increment: the client has to send it
+        self.max_length = max_length
+
+    def coerce(self, value):
+        """Converts a JSON value to what the column takes, raises SchemaError if it can't"""
+        if value is None:
+            if not self.nullable:
+                raise SchemaError(f'{self.name} can not be null')
+            return None
+        try:
+            if self.data_type in INT_TYPES:
+                if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+                    raise ValueError
+                return int(value)
+            if self.data_type in FLOAT_TYPES:
+                if isinstance(value, bool):
+                    raise ValueError
+                return float(value)
+            if self.data_type in TEXT_TYPES:
+                if isinstance(value, (dict, list)):
+                    raise ValueError
+                value = str(value)
+                if self.max_length is not None and len(value) > self.max_length:
+                    raise SchemaError(f'{self.name} is longer than {self.max_length} characters')
+                return value
+            if self.data_type == 'date':
+                return value if isinstance(value, date) else date.fromisoformat(str(value))
+            if self.data_type in ('datetime', 'timestamp'):
+                return value if isinstance(value, datetime) else datetime.fromisoformat(str(value))
+        except (ValueError, TypeError, OverflowError) as e:
+            if isinstance(e, SchemaError):
+                raise
+            raise SchemaError(f'{self.name} expects a {self.data_type} value, got {value!r}')
+        # types we don't know about are left to MySQL
+        return value
+
+
+def information_schema_columns(conn, table):
+    """(name, data type, is nullable, default, extra, max length) of every column of a MySQL table"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT COLUMN_NAME, DATA_TYPE, IS_NULLABLE, COLUMN_DEFAULT, EXTRA, CHARACTER_MAXIMUM_LENGTH "
+            "FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+            (table,))
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+class InsertPlanner:
+    def __init__(self, table='data', ttl=300.0, read_columns=information_schema_columns):
+        self.table = table
+        self.ttl = ttl
+        self.read_columns = read_columns    # the other storage backends describe their table their own way
+        self._columns = None          # lower case name -> Column
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._sql = {}                # column tuple -> INSERT statement (always the same str object, see prepared_cursor)
+        self._cursors = weakref.WeakKeyDictionary()   # connection -> {column tuple: prepared cursor}
+        self.rejected = 0
+        self.loads = 0
+
+    def load(self, conn):
+        rows = self.read_columns(conn, self.table)
+        columns = {}
+        for name, data_type, is_nullable, default, extra, max_length in rows:
+            name = name.decode() if isinstance(name, bytes) else name
+            data_type = (data_type.decode() if isinstance(data_type, bytes) else data_type).lower()
+            extra = (extra.decode() if isinstance(extra, bytes) else extra or '').lower()
+            nullable = is_nullable == 'YES'
+            # MariaDB reports a missing default as the string NULL
+            has_default = default is not None and default != 'NULL'
+            required = not nullable and not has_default and 'auto_increment' not in extra
+            columns[name.lower()] = Column(name, data_type, nullable, required, max_length)
+        with self._lock:
+            self._columns = columns
+            self._loaded_at = time.monotonic()
+            self.loads += 1
+        return columns
+
+    def columns(self, conn):
+        if self._columns is None or time.monotonic() - self._loaded_at > self.ttl:
+            return self.load(conn)
+        return self._columns
+
+    def invalidate(self):
+        """Forget the catalog, it is loaded again on the next insert"""
+        with self._lock:
+            self._columns = None
+
+    def plan(self, conn, record):
+        """Checks and converts one record. Returns (column tuple, values) or raises SchemaError"""
+        catalog = self.columns(conn)
+        names = []
+        values = []
+        for key, value in record.items():
+            column = catalog.get(str(key).lower())
+            if column is None:
+                self.rejected += 1
+                raise SchemaError(f'unknown column {key}')
+            if column.name in names:
+                # Age and age are the same column for MySQL
+                self.rejected += 1
+                raise SchemaError(f'duplicate column {key}')
+            try:
+                values.append(column.coerce(value))
+            except SchemaError:
+                self.rejected += 1
+                raise
+            names.append(column.name)
+        sent = {name.lower() for name in names}
+        missing = [column.name for key, column in catalog.items() if column.required and key not in sent]
+        if missing:
+            self.rejected += 1
+            raise SchemaError(f'missing {", ".join(missing)}')
+        return tuple(names), values
+
+    def insert_sql(self, columns):
+        sql = self._sql.get(columns)
+        if sql is None:
+            sql = self._sql.setdefault(columns, f"INSERT INTO {self.table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})")
+        return sql
+
+    def prepared_cursor(self, conn, columns):
+        """A prepared statement cursor for this column set on this connection. The connector only prepares again
+        when it gets a different SQL string object, so handing it the cached string reuses the server side statement"""
+        per_connection = self._cursors.get(conn)
+        if per_connection is None:
+            per_connection = self._cursors.setdefault(conn, {})
+        cursor = per_connection.get(columns)
+        if cursor is None:
+            cursor = per_connection[columns] = conn.cursor(prepared=True)
+        return cursor
+
+    def insert(self, conn, columns, values):
+        cursor = self.prepared_cursor(conn, columns)
+        try:
+            cursor.execute(self.insert_sql(columns), values)
+        except Exception:
+            # don't keep a statement in an unknown state around, the next insert prepares a new one
+            self._cursors.get(conn, {}).pop(columns, None)
+            try:
+                cursor.close()
+            except Exception:
+                pass
+            raise
+
+    def stats(self):
+        return {
+            'columns': len(self._columns or {}),
+            'statements': len(self._sql),
+            'loads': self.loads,
+            'rejected': self.rejected,
+        }
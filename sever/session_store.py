@@ -0,0 +1,95 @@
+# session_store.py - Bounded store for the key exchange sessions
+# Keeps at most max_entries sessions (least recently used are dropped first) and expires them automatically:
+# every session goes into a heap ordered by expiry time, so removing the expired ones only looks at the top
+# of the heap instead of scanning every client.
+
+import time
+import heapq
+import threading
+from collections import OrderedDict
+
+
+class Session:
+    # only what the server needs to decrypt uploads, __slots__ keeps it small with lots of clients
+    __slots__ = ('key', 'created_at', 'expires_at')
+
+    def __init__(self, key, created_at, expires_at):
+        self.key = key
+        self.created_at = created_at
+        self.expires_at = expires_at
+
+
+class SessionStore:
+    def __init__(self, max_entries=100000, ttl=7200.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._sessions = OrderedDict()   # client_id -> Session, least recently used first
+        self._expiry = []                # heap of (expires_at, client_id)
+        self._lock = threading.Lock()
+        self.evicted = 0
+        self.expired = 0
+
+    def put(self, client_id, key):
+        now = time.time()
+        session = Session(key, now, now + self.ttl)
+        with self._lock:
+            self._expire(now)
+            self._sessions[client_id] = session
+            self._sessions.move_to_end(client_id)
+            heapq.heappush(self._expiry, (session.expires_at, client_id))
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+                self.evicted += 1
+            # replaced and evicted sessions leave old heap entries behind, rebuild the heap before it gets too big
+            if len(self._expiry) > 2 * len(self._sessions) + 1024:
+                self._expiry = [(s.expires_at, cid) for cid, s in self._sessions.items()]
+                heapq.heapify(self._expiry)
+        return session
+
+    def get(self, client_id):
+        """Returns the live Session for client_id or None"""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(client_id)
+            if session is None:
+                return None
+            self._sessions.move_to_end(client_id)
+            return session
+
+    def __contains__(self, client_id):
+        return self.get(client_id) is not None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _expire(self, now):
+        removed = 0
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, client_id = heapq.heappop(self._expiry)
+            session = self._sessions.get(client_id)
+            # skip heap entries of sessions that were replaced or evicted in the meantime
+            if session is not None and session.expires_at == expires_at:
+                del self._sessions[client_id]
+                removed += 1
+        self.expired += removed
+        return removed
+
+    def expire(self):
+        """Remove expired sessions now, returns how many were removed"""
+        with self._lock:
+            return self._expire(time.time())
+
+    def remove(self, client_id):
+        with self._lock:
+            return self._sessions.pop(client_id, None) is not None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'evicted': self.evicted,
+                'expired': self.expired,
+            }
@@ -0,0 +1,130 @@
+# shared_sessions.py - Key exchange sessions in a local SQLite file, shared by every worker process
+# With several workers (see prefork.py) the key exchange and the uploads of a client can land on different
+# processes, so the sessions can't live in the memory of one of them. This store has the same interface as
+# SessionStore but keeps the sessions in SESSION_DB (WAL mode: readers never wait for the writer). A lookup is
+# one primary key read, expired and surplus sessions are cleaned up every cleanup_every key exchanges.
+# Unlike SessionStore the oldest sessions (not the least recently used ones) are dropped past max_entries,
+# keeping track of every use would turn each upload into a write.
+#
+# The revocations table tells the other workers about /api/revoke: every worker has its own auth cache (see
+# auth_cache.py), and a worker that didn't handle the revoke would otherwise keep accepting the cached token.
+# Each revoke gets a generation number, the auth caches ask for the client ids revoked after the last one they saw.
+
+import time
+import sqlite3
+import threading
+from session_store import Session
+
+SESSIONS_TABLE = """CREATE TABLE IF NOT EXISTS sessions (
+  client_id TEXT NOT NULL PRIMARY KEY,
+  key BLOB NOT NULL,
+  created_at REAL NOT NULL,
+  expires_at REAL NOT NULL
+)"""
+
+REVOCATIONS_TABLE = """CREATE TABLE IF NOT EXISTS revocations (
+  generation INTEGER PRIMARY KEY AUTOINCREMENT,
+  client_id TEXT NOT NULL,
+  revoked_at REAL NOT NULL
+)"""
+
+
+class SQLiteSessionStore:
+    def __init__(self, path, max_entries=100000, ttl=7200.0, cleanup_every=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cleanup_every = cleanup_every
+        self._local = threading.local()    # one connection per thread, sqlite3 connections can't be shared
+        self._puts = 0
+        self.evicted = 0
+        self.expired = 0
+        db = self._db()
+        db.execute(SESSIONS_TABLE)
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_created ON sessions (created_at)")
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires_at)")
+        db.execute(REVOCATIONS_TABLE)
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            # autocommit, every statement is its own transaction
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            # a session lost in a power cut only costs the client a new key exchange
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def put(self, client_id, key):
+        now = time.time()
+        session = Session(key, now, now + self.ttl)
+        self._db().execute("INSERT OR REPLACE INTO sessions (client_id, key, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                           (client_id, key, session.created_at, session.expires_at))
+        self._puts += 1
+        if self._puts % self.cleanup_every == 0:
+            self._cleanup(now)
+        return session
+
+    def get(self, client_id):
+        """Returns the live Session for client_id or None"""
+        row = self._db().execute("SELECT key, created_at, expires_at FROM sessions WHERE client_id = ? AND expires_at > ?",
+                                 (client_id, time.time())).fetchone()
+        if row is None:
+            return None
+        return Session(row[0], row[1], row[2])
+
+    def __contains__(self, client_id):
+        return self.get(client_id) is not None
+
+    def __len__(self):
+        return self._db().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def _cleanup(self, now):
+        removed = self._expire(now)
+        surplus = len(self) - self.max_entries
+        if surplus > 0:
+            db = self._db()
+            db.execute("DELETE FROM sessions WHERE client_id IN "
+                       "(SELECT client_id FROM sessions ORDER BY created_at LIMIT ?)", (surplus,))
+            self.evicted += surplus
+        return removed
+
+    def _expire(self, now):
+        # a revocation older than a session is of no use to an auth cache (AUTH_CACHE_TTL is far shorter)
+        self._db().execute("DELETE FROM revocations WHERE revoked_at <= ?", (now - self.ttl,))
+        removed = self._db().execute("DELETE FROM sessions WHERE expires_at <= ?", (now,)).rowcount
+        self.expired += removed
+        return removed
+
+    def expire(self):
+        """Remove expired sessions now, returns how many were removed"""
+        return self._expire(time.time())
+
+    def remove(self, client_id):
+        return self._db().execute("DELETE FROM sessions WHERE client_id = ?", (client_id,)).rowcount > 0
+
+    def add_revocation(self, client_id):
+        self._db().execute("INSERT INTO revocations (client_id, revoked_at) VALUES (?, ?)", (client_id, time.time()))
+
+    def revocations_since(self, generation):
+        """(latest generation, client ids revoked after generation). With generation None only the latest one,
+        a new auth cache has nothing to drop"""
+        db = self._db()
+        if generation is None:
+            return db.execute("SELECT COALESCE(MAX(generation), 0) FROM revocations").fetchone()[0], []
+        rows = db.execute("SELECT generation, client_id FROM revocations WHERE generation > ? ORDER BY generation",
+                          (generation,)).fetchall()
+        if not rows:
+            return generation, []
+        return rows[-1][0], [client_id for _, client_id in rows]
+
+    def stats(self):
+        # evicted/expired only count what this process removed
+        return {
+            'sessions': len(self),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'evicted': self.evicted,
+            'expired': self.expired,
+        }
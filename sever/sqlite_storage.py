@@ -0,0 +1,212 @@
+# sqlite_storage.py - Storage backend on a local SQLite file (STORAGE_BACKEND=sqlite)
+# For sites too small for a MySQL server, and for running the whole server on a laptop. The users and data tables
+# of project_CSS.sql are created in SQLITE_PATH on first start, in WAL mode so reads never wait for the writer.
+# Every thread gets its own connection (and every records read one more, see read_connection); SQLite has one
+# writer at a time, busy writers wait up to 30 seconds.
+#
+# The connections are wrapped to look like the MySQL connector ones (%s placeholders, dictionary cursors,
+# prepared=True ignored), so storage.SQLStorage, the ingest queue and the dead-letter replay run unchanged.
+
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime
+from schema import InsertPlanner
+from storage import SQLStorage
+
+# the defaults are local time like MySQL's CURRENT_DATE / CURRENT_TIMESTAMP (SQLite's are UTC)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS data (
+  ID integer PRIMARY KEY AUTOINCREMENT,
+  FirstName varchar(50) NOT NULL,
+  LastName varchar(50) NOT NULL,
+  Age int NOT NULL,
+  hight float NOT NULL,
+  Address varchar(200) NOT NULL,
+  Comments text NOT NULL,
+  date date NOT NULL DEFAULT (date('now', 'localtime')),
+  updated timestamp NOT NULL DEFAULT (datetime('now', 'localtime')),
+  user varchar(128) NOT NULL
+);
+CREATE INDEX IF NOT EXISTS user_date ON data (user, date);
+CREATE TABLE IF NOT EXISTS users (
+  ID integer PRIMARY KEY AUTOINCREMENT,
+  userid varchar(36) NOT NULL UNIQUE,
+  token varchar(128) NOT NULL,
+  created date NOT NULL,
+  until date NOT NULL,
+  valid tinyint NOT NULL DEFAULT 1,
+  accessed timestamp
+);
+"""
+
+# SQLite keeps dates as text, these turn them back into what the MySQL connector returns
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('date', lambda value: date.fromisoformat(value.decode()))
+sqlite3.register_converter('timestamp', lambda value: datetime.fromisoformat(value.decode()))
+
+DECLARED_TYPE = re.compile(r'^\s*(\w+)\s*(?:\((\d+)\))?')
+
+
+def table_columns(db, table):
+    """The column catalog of a SQLite table in the shape of INFORMATION_SCHEMA.COLUMNS (see schema.py)"""
+    rows = []
+    for cid, name, declared, notnull, default, pk in db.execute(f"PRAGMA table_info({table})").fetchall():
+        match = DECLARED_TYPE.match(declared or '')
+        data_type = match.group(1).lower() if match else ''
+        max_length = int(match.group(2)) if match and match.group(2) else None
+        if data_type == 'integer':
+            data_type = 'int'
+        if data_type == 'text':
+            max_length = 65535
+        extra = 'auto_increment' if pk else ''
+        rows.append((name, data_type, 'NO' if notnull or pk else 'YES', default, extra, max_length))
+    return rows
+
+
+class Cursor:
+    """A sqlite3 cursor that takes %s placeholders and can return rows as dicts, like the MySQL connector"""
+
+    def __init__(self, db, dictionary=False):
+        self._cursor = db.cursor()
+        self._db = db
+        self.dictionary = dictionary
+
+    @staticmethod
+    def _sql(operation):
+        return operation.replace('%s', '?')
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def execute(self, operation, params=()):
+        self._cursor.execute(self._sql(operation), tuple(params))
+
+    def executemany(self, operation, seq_params):
+        # sqlite3 keeps the rows inserted before a failing one, MySQL runs the whole multi-row INSERT or nothing.
+        # A savepoint gives us the MySQL behaviour, callers retry a failed group row by row
+        if not self._db.in_transaction:
+            # a savepoint outside a transaction would commit when it is released
+            self._db.execute('BEGIN')
+        self._db.execute('SAVEPOINT executemany')
+        try:
+            self._cursor.executemany(self._sql(operation), [tuple(params) for params in seq_params])
+        except sqlite3.Error:
+            self._db.execute('ROLLBACK TO executemany')
+            self._db.execute('RELEASE executemany')
+            raise
+        self._db.execute('RELEASE executemany')
+
+    def _rows(self, rows):
+        if not self.dictionary:
+            return rows
+        names = [column[0] for column in self._cursor.description]
+        return [dict(zip(names, row)) for row in rows]
+
+    def fetchone(self):
+        rows = self._rows(self._cursor.fetchmany(1))
+        return rows[0] if rows else None
+
+    def fetchmany(self, size=1):
+        return self._rows(self._cursor.fetchmany(size))
+
+    def fetchall(self):
+        return self._rows(self._cursor.fetchall())
+
+    def close(self):
+        self._cursor.close()
+
+
+class Connection:
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self, dictionary=False, prepared=False):
+        # sqlite3 keeps its own cache of prepared statements, prepared=True has nothing to add
+        return Cursor(self.db, dictionary)
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+
+class SQLiteStorage(SQLStorage):
+    name = 'sqlite'
+    errors = (sqlite3.Error,)
+
+    def __init__(self, path, planner=None, timeout=30.0):
+        super().__init__(planner or InsertPlanner('data'))
+        self.planner.read_columns = lambda conn, table: table_columns(conn.db, table)
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()    # one connection per thread, sqlite3 connections can't be shared
+        self.connections = 0
+        self._conn().db.executescript(SCHEMA)
+
+    def _open(self):
+        db = sqlite3.connect(self.path, timeout=self.timeout, detect_types=sqlite3.PARSE_DECLTYPES,
+                             check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        # fsync at checkpoints only: a power cut can lose the last commits, never corrupt the file
+        db.execute('PRAGMA synchronous=NORMAL')
+        self.connections += 1
+        return Connection(db)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # closed by the garbage collector when the thread ends
+            conn = self._local.conn = self._open()
+        return conn
+
+    @contextmanager
+    def connection(self):
+        conn = self._conn()
+        try:
+            yield conn
+        except BaseException:
+            # don't leave a half done transaction behind for the next user of this thread's connection
+            conn.rollback()
+            raise
+
+    @contextmanager
+    def read_connection(self):
+        # a connection of its own: the thread's connection is used by other requests between two steps of the
+        # records generator, and closing the generator must not roll back their transactions
+        conn = self._open()
+        try:
+            yield conn
+        finally:
+            conn.db.close()
+
+    def unavailable(self, error):
+        # locked for longer than the timeout, disk full or the file gone: nothing wrong with the record
+        return isinstance(error, sqlite3.OperationalError) and not self.unknown_column(error) \
+            and 'syntax error' not in str(error)
+
+    def unknown_column(self, error):
+        message = str(error)
+        return 'no such column' in message or 'has no column named' in message
+
+    def stats(self):
+        return {'sqlite': {'path': self.path, 'connections_opened': self.connections}, 'schema': self.planner.stats()}
+
+    def close(self):
+        # only this thread's connection, the others go with their threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.db.close()
+            self._local.conn = None
@@ -0,0 +1,284 @@
+# storage.py - Where the users and the records are kept
+# The server code doesn't talk to MySQL directly anymore, it goes through a storage backend picked with
+# STORAGE_BACKEND. Every backend does the same few things:
+#
+#   find_user / add_user / expire_user / revoke_user    the users table (token check, new clients, /api/revoke)
+#   check / insert / insert_many                        records for the data table, checked against its columns
+#   read                                                a client's records in (date, ID) order (GET /api/records)
+#   refresh_schema / stats
+#
+# and comes in three flavours:
+#
+#   mysql     MySQL through the connection pool (db_pool.py), the default
+#   sqlite    one local SQLite file in WAL mode (sqlite_storage.py), for small sites and tests without a MySQL server
+#   columnar  append-only column files on local disk (columnar_storage.py), for sites that write a lot and read little
+#
+# Records that don't fit the table raise SchemaError, a database we can't reach raises StorageUnavailable (the
+# upload goes to the dead letters), anything else from the database raises StorageError.
+
+from contextlib import contextmanager
+from schema import InsertPlanner, SchemaError
+from metrics import stage
+import records
+
+
+class StorageError(Exception):
+    pass
+
+
+class StorageUnavailable(StorageError):
+    pass
+
+
+class SQLStorage:
+    """What the MySQL and SQLite backends share: the SQL is the same, only the connections and the errors differ.
+    The connections take %s placeholders (SQLite ones are wrapped, see sqlite_storage.py)"""
+    name = 'sql'
+    errors = ()          # exception classes of the database driver
+
+    def __init__(self, planner):
+        self.planner = planner
+
+    def connection(self):
+        """Context manager giving a connection, rolled back if the block fails. A driver error getting out of the
+        block also throws the connection away (the MySQL pool doesn't reuse it), so code that catches a driver
+        error inside the block has to raise it again when unavailable() says the database is gone"""
+        raise NotImplementedError
+
+    def read_connection(self):
+        """Connection for read(). The records generator can be moved on from different threads (the async server
+        runs every step on whichever DB thread is free), so backends with per-thread connections give it its own"""
+        return self.connection()
+
+    def unavailable(self, error):
+        """True if the driver error means the database can't be reached (as opposed to a bad statement)"""
+        raise NotImplementedError
+
+    def unknown_column(self, error):
+        raise NotImplementedError
+
+    def _error(self, error):
+        if self.unavailable(error):
+            return StorageUnavailable(str(error))
+        return StorageError(str(error))
+
+    @contextmanager
+    def transaction(self):
+        """(conn, cursor) for one transaction, committed at the end of the block. The ingest queue and the
+        dead-letter replay write their bookkeeping tables in the same transaction as the records"""
+        try:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    yield conn, cursor
+                    conn.commit()
+                finally:
+                    cursor.close()
+        except self.errors as e:
+            raise self._error(e) from e
+
+    def _fetch(self, query, params):
+        with self.transaction() as (conn, cursor):
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+    def _change(self, query, params):
+        with self.transaction() as (conn, cursor):
+            cursor.execute(query, params)
+            return cursor.rowcount
+
+    # users
+
+    def find_user(self, client_id):
+        """{'ID', 'token', 'until'} of the valid user with this client id, or None"""
+        with stage('user_lookup'):
+            rows = self._fetch("SELECT ID, token, until FROM users WHERE userid = %s AND valid = 1", (client_id,))
+        if len(rows) != 1:
+            return None
+        user_id, token, until = rows[0]
+        return {'ID': user_id, 'token': token, 'until': until}
+
+    def add_user(self, client_id, token_hash, created, until):
+        """Gives a client a new token. userid is unique, an expired or revoked client gets its old row back"""
+        with self.transaction() as (conn, cursor):
+            cursor.execute("SELECT ID FROM users WHERE userid = %s", (client_id,))
+            rows = cursor.fetchall()
+            if rows:
+                cursor.execute("UPDATE users SET token = %s, created = %s, until = %s, valid = 1 WHERE ID = %s",
+                               (token_hash, created, until, rows[0][0]))
+            else:
+                cursor.execute("INSERT INTO users (userid, token, created, until) VALUES (%s, %s, %s, %s)",
+                               (client_id, token_hash, created, until))
+
+    def expire_user(self, user_id):
+        self._change("UPDATE users SET valid = 0 WHERE ID = %s", (user_id,))
+
+    def revoke_user(self, client_id):
+        """Invalidates every token of a client, returns how many there were"""
+        return self._change("UPDATE users SET valid = 0 WHERE userid = %s", (client_id,))
+
+    # records
+
+    def check(self, record):
+        """Checks a record against the table columns without writing it. Returns (columns, values)"""
+        try:
+            with self.connection() as conn:
+                return self.planner.plan(conn, record)
+        except self.errors as e:
+            raise self._error(e) from e
+
+    def insert(self, record):
+        try:
+            with self.connection() as conn:
+                columns, values = self.planner.plan(conn, record)
+                try:
+                    self.planner.insert(conn, columns, values)
+                except self.errors as e:
+                    if self.unavailable(e):
+                        raise
+                    self.schema_changed(e)
+                    # the database refused the values (out of range...), the record is the problem not the database
+                    conn.rollback()
+                    raise SchemaError(str(e))
+                conn.commit()
+        except self.errors as e:
+            raise self._error(e) from e
+
+    def insert_many(self, batch):
+        """Inserts a list of records in one transaction. Returns [(index, reason)] for the records that were refused,
+        raises StorageUnavailable (and nothing is written) if the database went away"""
+        failed = []
+        with self.transaction() as (conn, cursor):
+            groups = {}
+            for i, record in enumerate(batch):
+                # checked in memory, a bad record costs nothing on the database
+                try:
+                    columns, values = self.planner.plan(conn, record)
+                except SchemaError as e:
+                    failed.append((i, 'malformed data: ' + str(e)))
+                    continue
+                groups.setdefault(columns, []).append((i, values))
+            with stage('insert'):
+                failed.extend(self.write_groups(cursor, groups))
+        return sorted(failed)
+
+    def write_groups(self, cursor, groups):
+        """groups is {columns: [(tag, values)]}. Records with the same columns share one INSERT statement, executemany
+        turns each group into a multi-row insert. Returns [(tag, reason)] for the rows the database refused"""
+        failed = []
+        for columns, rows in groups.items():
+            query = self.planner.insert_sql(columns)
+            try:
+                cursor.executemany(query, [values for _, values in rows])
+            except self.errors as e:
+                if self.unavailable(e):
+                    raise
+                self.schema_changed(e)
+                # a failed statement is rolled back on its own, redo the group row by row to find the bad ones
+                for tag, values in rows:
+                    try:
+                        cursor.execute(query, values)
+                    except self.errors as e:
+                        if self.unavailable(e):
+                            raise
+                        failed.append((tag, 'malformed data: ' + str(e)))
+        return failed
+
+    def schema_changed(self, error):
+        # the database doesn't know a column we had in the catalog: the table changed under us, load it again
+        if self.unknown_column(error):
+            self.planner.invalidate()
+
+    def read(self, client_id, filters):
+        """Yields the client's records (dicts) in (date, ID) order, at most filters['limit'] + 1 of them"""
+        query, params = records.build_query(client_id, filters)
+        try:
+            with self.read_connection() as conn:
+                cursor = conn.cursor(dictionary=True)
+                try:
+                    with stage('read_query'):
+                        cursor.execute(query, params)
+                    while True:
+                        rows = cursor.fetchmany(100)
+                        if not rows:
+                            break
+                        yield from rows
+                finally:
+                    # an unbuffered cursor has to be read to the end before the connection can run anything else
+                    try:
+                        cursor.fetchall()
+                    except self.errors:
+                        pass
+                    cursor.close()
+        except self.errors as e:
+            raise self._error(e) from e
+
+    def refresh_schema(self):
+        """Loads the table columns again right away, returns their names"""
+        try:
+            with self.connection() as conn:
+                columns = self.planner.load(conn)
+        except self.errors as e:
+            raise self._error(e) from e
+        return [column.name for column in columns.values()]
+
+    def stats(self):
+        return {'schema': self.planner.stats()}
+
+    def close(self):
+        pass
+
+
+class MySQLStorage(SQLStorage):
+    name = 'mysql'
+
+    def __init__(self, db_config, planner=None, **pool_options):
+        # imported here, the other backends work without the MySQL connector
+        import mysql.connector
+        from mysql.connector import errorcode
+        from db_pool import ConnectionPool, PoolTimeout
+        super().__init__(planner or InsertPlanner('data'))
+        self.pool = ConnectionPool(db_config, **pool_options)
+        self.errors = (mysql.connector.Error,)
+        self._unavailable = (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError, PoolTimeout)
+        self._bad_field = errorcode.ER_BAD_FIELD_ERROR
+
+    def connection(self):
+        return self.pool.connection()
+
+    def unavailable(self, error):
+        return isinstance(error, self._unavailable)
+
+    def unknown_column(self, error):
+        return getattr(error, 'errno', None) == self._bad_field
+
+    def stats(self):
+        return {'db_pool': self.pool.stats(), 'schema': self.planner.stats()}
+
+    def close(self):
+        self.pool.close_all()
+
+
+def open_storage(config):
+    """The backend chosen by config.STORAGE_BACKEND"""
+    planner = InsertPlanner('data', ttl=config.SCHEMA_TTL)
+    backend = config.STORAGE_BACKEND
+    if backend == 'mysql':
+        return MySQLStorage(config.DB_CONFIG, planner,
+                            size=config.DB_POOL_SIZE,
+                            timeout=config.DB_POOL_TIMEOUT,
+                            max_idle=config.DB_POOL_MAX_IDLE,
+                            max_lifetime=config.DB_POOL_MAX_LIFETIME,
+                            ping_after=config.DB_POOL_PING_AFTER)
+    if backend == 'sqlite':
+        from sqlite_storage import SQLiteStorage
+        return SQLiteStorage(config.SQLITE_PATH, planner)
+    if backend == 'columnar':
+        from columnar_storage import ColumnarStorage
+        return ColumnarStorage(config.COLUMNAR_FOLDER, planner,
+                               row_group_rows=config.COLUMNAR_ROW_GROUP,
+                               linger=config.COLUMNAR_LINGER,
+                               max_segment_bytes=config.COLUMNAR_SEGMENT_BYTES,
+                               fsync=config.COLUMNAR_FSYNC,
+                               suffix=f'.{config.WORKER_ID}' if config.WORKER_ID else '')
+    raise ValueError(f'Unknown STORAGE_BACKEND {backend!r} (mysql, sqlite or columnar)')
@@ -0,0 +1,236 @@
+# streaming.py - Chunked, resumable file uploads
+# A file is sent as fixed-size chunks (see wire.py for the chunk format). Every chunk is decrypted and appended
+# to a .part file on disk right away, so memory use doesn't depend on the file size. The number of chunks we have
+# is kept in a small state file, which lets a client resume an interrupted upload from the last acknowledged chunk.
+#
+# A client that gives up leaves its .part file behind, so uploads nobody touched for `ttl` seconds are deleted
+# (checked from start() every sweep_every seconds). Disk use is bounded per client: at most max_uploads unfinished
+# uploads, each at most max_file_size bytes (0 turns a limit off).
+
+import os
+import re
+import json
+import time
+import uuid
+import fcntl
+import hashlib
+from cryptography.hazmat.primitives.asymmetric import ec, utils
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidSignature, InvalidTag
+import wire
+
+UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class StreamStore:
+    def __init__(self, work_folder, files_folder, chunk_size=1024 * 1024, ttl=86400.0, max_file_size=0,
+                 max_uploads=0, sweep_every=60.0):
+        self.work_folder = work_folder      # .part and state files of uploads in progress
+        self.files_folder = files_folder    # finished files
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self.max_file_size = max_file_size
+        self.max_uploads = max_uploads
+        self.sweep_every = sweep_every
+        self._last_sweep = 0.0
+        self.expired = 0
+        os.makedirs(work_folder, exist_ok=True)
+        os.makedirs(files_folder, exist_ok=True)
+
+    def _state_path(self, upload_id):
+        return os.path.join(self.work_folder, upload_id + '.json')
+
+    def _part_path(self, upload_id):
+        return os.path.join(self.work_folder, upload_id + '.part')
+
+    def _load(self, client_id, upload_id):
+        if not upload_id or not UPLOAD_ID.match(upload_id):
+            return None
+        try:
+            with open(self._state_path(upload_id), 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        # uploads are private to the client that started them
+        if state['client_id'] != client_id:
+            return None
+        return state
+
+    def _save(self, upload_id, state):
+        # write + rename so a crash never leaves a half written state file behind
+        tmp = self._state_path(upload_id) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._state_path(upload_id))
+
+    def _status(self, upload_id, state):
+        return {
+            'upload_id': upload_id,
+            'chunk_size': state['chunk_size'],
+            'next_chunk': state['next_chunk'],
+            'bytes_received': state['bytes'],
+            'complete': state['complete'],
+        }
+
+    def _states(self):
+        """(upload_id, state) of every upload in the work folder"""
+        for name in os.listdir(self.work_folder):
+            upload_id, ext = os.path.splitext(name)
+            if ext != '.json' or not UPLOAD_ID.match(upload_id):
+                continue
+            try:
+                with open(self._state_path(upload_id), 'r') as f:
+                    yield upload_id, json.load(f)
+            except (FileNotFoundError, ValueError):
+                # removed or being replaced by another process
+                continue
+
+    def expire(self):
+        """Deletes the uploads nobody touched for ttl seconds, returns how many"""
+        now = time.time()
+        self._last_sweep = now
+        removed = 0
+        for upload_id, state in self._states():
+            if now - state.get('updated', state['created']) < self.ttl:
+                continue
+            try:
+                part = open(self._part_path(upload_id), 'r+b')
+            except FileNotFoundError:
+                # finished, only the state file is left
+                part = None
+            if part is not None:
+                with part:
+                    try:
+                        # a chunk being written right now, leave it alone
+                        fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    os.remove(self._part_path(upload_id))
+            try:
+                os.remove(self._state_path(upload_id))
+            except FileNotFoundError:
+                pass
+            removed += 1
+        self.expired += removed
+        return removed
+
+    def start(self, client_id, filename, upload_id=None, size=None):
+        """Starts a new upload, or returns where to continue if upload_id is an unfinished upload of this client.
+        size is the file size the client announces, a file over the limit is refused before any chunk is sent"""
+        if self.ttl and time.time() - self._last_sweep >= self.sweep_every:
+            self.expire()
+        if upload_id:
+            state = self._load(client_id, upload_id)
+            if state is not None:
+                return self._status(upload_id, state), 200
+        if self.max_file_size and isinstance(size, int) and size > self.max_file_size:
+            return f'File too big, the limit is {self.max_file_size} bytes', 413
+        if self.max_uploads:
+            unfinished = sum(1 for _, state in self._states() if state['client_id'] == client_id and not state['complete'])
+            if unfinished >= self.max_uploads:
+                return f'Too many unfinished uploads (the limit is {self.max_uploads}), resume one of them', 403
+        upload_id = uuid.uuid4().hex
+        # only keep something harmless of the client's file name
+        safe_name = re.sub(r'[^A-Za-z0-9._-]', '_', os.path.basename(filename or '')) or 'file'
+        state = {
+            'client_id': client_id,
+            'filename': safe_name,
+            'chunk_size': self.chunk_size,
+            'next_chunk': 0,
+            'bytes': 0,
+            'complete': False,
+            'created': time.time(),
+            'updated': time.time(),
+        }
+        open(self._part_path(upload_id), 'wb').close()
+        self._save(upload_id, state)
+        return self._status(upload_id, state), 200
+
+    def status(self, client_id, upload_id):
+        state = self._load(client_id, upload_id)
+        if state is None:
+            return 'Unknown upload', 404
+        return self._status(upload_id, state), 200
+
+    def write_chunk(self, client_id, session_key, upload_id, index, body, verify_key=None):
+        """Decrypts one chunk and appends it to the upload. Returns (body, status)"""
+        try:
+            final, nonce, signature, ciphertext = wire.unpack_chunk(body)
+        except ValueError as e:
+            return 'Malformed chunk: ' + str(e), 400
+        if len(ciphertext) > self.chunk_size + 16:
+            return f'Chunk too big, the limit is {self.chunk_size} bytes', 413
+
+        part_path = self._part_path(upload_id)
+        state = self._load(client_id, upload_id)
+        if state is None:
+            return 'Unknown upload', 404
+        if state['complete']:
+            return self._status(upload_id, state), 200
+        try:
+            part = open(part_path, 'r+b')
+        except FileNotFoundError:
+            # another request just finished the upload
+            return self.status(client_id, upload_id)
+        with part:
+            # one writer per upload, also across server processes
+            fcntl.flock(part, fcntl.LOCK_EX)
+            state = self._load(client_id, upload_id)
+            if state['complete'] or index < state['next_chunk']:
+                # we already have this chunk (the client didn't get our answer), acknowledge it again
+                return self._status(upload_id, state), 200
+            if index > state['next_chunk']:
+                return dict(self._status(upload_id, state), error='Out of order chunk'), 409
+            if self.max_file_size and state['bytes'] + len(ciphertext) - 16 > self.max_file_size:
+                return f'File too big, the limit is {self.max_file_size} bytes', 413
+
+            try:
+                plaintext = AESGCM(session_key).decrypt(nonce, ciphertext, wire.chunk_aad(upload_id, index, final))
+            except InvalidTag:
+                return 'Chunk failed authentication', 400
+
+            # drop anything a crashed writer left after the last acknowledged chunk
+            part.truncate(state['bytes'])
+            part.seek(state['bytes'])
+            part.write(plaintext)
+            part.flush()
+            os.fsync(part.fileno())
+            state['next_chunk'] = index + 1
+            state['bytes'] += len(plaintext)
+            state['updated'] = time.time()
+
+            if final:
+                if signature:
+                    if verify_key is None:
+                        return 'No verification key for this client', 400
+                    try:
+                        verify_key.verify(bytes(signature), self._file_digest(part_path),
+                                          ec.ECDSA(utils.Prehashed(hashes.SHA256())))
+                    except InvalidSignature:
+                        return 'Invalid signature', 400
+                final_path = os.path.join(self.files_folder, upload_id + '_' + state['filename'])
+                os.replace(part_path, final_path)
+                state['complete'] = True
+                state['path'] = final_path
+            self._save(upload_id, state)
+            return self._status(upload_id, state), 200
+
+    def stats(self):
+        # expired only counts what this process removed
+        return {
+            'ttl': self.ttl,
+            'max_file_size': self.max_file_size,
+            'max_uploads': self.max_uploads,
+            'expired': self.expired,
+        }
+
+    def _file_digest(self, path):
+        # hash the assembled file chunk by chunk, never the whole thing in memory
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(self.chunk_size), b''):
+                digest.update(block)
+        return digest.digest()
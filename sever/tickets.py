@@ -0,0 +1,164 @@
+# tickets.py - Session tickets, so clients can skip the key exchange
+# With every key exchange the server hands out a ticket: the session key and its expiry, encrypted with a ticket key
+# only the server knows and bound to the client id. The client keeps the ticket (and its copy of the session key)
+# and sends it back in the X-Session-Ticket header. The server gets the session key back by decrypting the ticket,
+# no lookup in client_sessions, so sessions survive restarts and don't need to be shared between servers.
+#
+# Ticket keys are kept in TICKET_KEY_FILE and rotated every TICKET_KEY_ROTATE seconds. Old keys stay around
+# until the last ticket they encrypted has expired.
+#
+# Ticket layout (base64url):  version (1) | ticket key id (4) | nonce (12) | AES-GCM(expires (8) | session key (32))
+# with the header and the client id as associated data.
+
+import os
+import json
+import time
+import fcntl
+import base64
+import struct
+import binascii
+import threading
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+from session_store import Session
+
+VERSION = 1
+HEADER = struct.Struct('!B4s')
+PAYLOAD = struct.Struct('!Q32s')
+NONCE_SIZE = 12
+
+
+class TicketKeys:
+    def __init__(self, path, lifetime, rotate_after=86400.0):
+        self.path = path
+        self.lifetime = lifetime            # how long a ticket is good for (the session TTL)
+        self.rotate_after = rotate_after
+        self._lock = threading.Lock()
+        self._keys = {}                     # key id -> (AESGCM, created)
+        self._current = None                # (key id, created)
+        self._mtime = None
+        self.rotations = 0
+        with self._lock:
+            self._reload()
+            if self._current is None or time.time() - self._current[1] > self.rotate_after:
+                self._rotate()
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f).get('keys', [])
+        except FileNotFoundError:
+            return []
+
+    def _reload(self):
+        # another server process may have rotated the keys, the file is the reference
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        keys = {}
+        current = None
+        for entry in self._read():
+            key_id = bytes.fromhex(entry['id'])
+            keys[key_id] = (AESGCM(base64.b64decode(entry['key'])), entry['created'])
+            if current is None or entry['created'] > current[1]:
+                current = (key_id, entry['created'])
+        self._keys = keys
+        self._current = current
+        self._mtime = mtime
+
+    def _rotate(self):
+        # the lock file makes the read-modify-write safe when several processes rotate at the same time
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            now = time.time()
+            entries = self._read()
+            newest = max((entry['created'] for entry in entries), default=0)
+            if now - newest > self.rotate_after:
+                entries.append({'id': os.urandom(4).hex(),
+                                'key': base64.b64encode(AESGCM.generate_key(bit_length=256)).decode(),
+                                'created': now})
+                self.rotations += 1
+            # a key is needed until the tickets issued just before it was replaced expire
+            entries = [entry for entry in entries if now - entry['created'] < self.rotate_after + self.lifetime]
+            tmp = self.path + '.tmp'
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'keys': entries}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        self._mtime = None
+        self._reload()
+
+    def current(self):
+        """(key id, AESGCM) to encrypt new tickets with, rotating the key when it's due"""
+        with self._lock:
+            if time.time() - self._current[1] > self.rotate_after:
+                self._reload()
+                if time.time() - self._current[1] > self.rotate_after:
+                    self._rotate()
+            key_id = self._current[0]
+            return key_id, self._keys[key_id][0]
+
+    def get(self, key_id):
+        key = self._keys.get(key_id)
+        if key is None:
+            # maybe a key another process just created
+            with self._lock:
+                self._reload()
+                key = self._keys.get(key_id)
+        return key[0] if key else None
+
+    def stats(self):
+        return {'keys': len(self._keys), 'rotations': self.rotations}
+
+
+class Tickets:
+    def __init__(self, keys):
+        self.keys = keys
+        self.issued = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    def issue(self, client_id, session_key, expires_at):
+        """Returns the ticket (a str) for this client's session key"""
+        key_id, aesgcm = self.keys.current()
+        header = HEADER.pack(VERSION, key_id)
+        nonce = os.urandom(NONCE_SIZE)
+        ciphertext = aesgcm.encrypt(nonce, PAYLOAD.pack(int(expires_at), session_key), header + client_id.encode())
+        self.issued += 1
+        return base64.urlsafe_b64encode(header + nonce + ciphertext).decode()
+
+    def open(self, client_id, ticket):
+        """The Session inside a ticket, or None if it isn't a valid and unexpired ticket of this client"""
+        try:
+            raw = base64.urlsafe_b64decode(ticket)
+        except (binascii.Error, ValueError):
+            self.rejected += 1
+            return None
+        if len(raw) != HEADER.size + NONCE_SIZE + PAYLOAD.size + 16:
+            self.rejected += 1
+            return None
+        version, key_id = HEADER.unpack_from(raw)
+        aesgcm = self.keys.get(key_id) if version == VERSION else None
+        if aesgcm is None:
+            self.rejected += 1
+            return None
+        try:
+            payload = aesgcm.decrypt(raw[HEADER.size:HEADER.size + NONCE_SIZE], raw[HEADER.size + NONCE_SIZE:],
+                                     raw[:HEADER.size] + client_id.encode())
+        except InvalidTag:
+            self.rejected += 1
+            return None
+        expires_at, session_key = PAYLOAD.unpack(payload)
+        if time.time() >= expires_at:
+            self.rejected += 1
+            return None
+        self.accepted += 1
+        return Session(session_key, None, expires_at)
+
+    def stats(self):
+        return dict(self.keys.stats(), issued=self.issued, accepted=self.accepted, rejected=self.rejected)
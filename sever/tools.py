@@ -1,9 +1,9 @@
 import os
+import fcntl
 import hashlib
 import base64
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives import serialization
-import os
 
 def generate_token(length=32):
     token_bytes = os.urandom(length)
@@ -23,6 +23,29 @@ def generate_key_pair(curve=ec.SECP256R1):
     public_key = private_key.public_key()
     return private_key, public_key
 
+def load_or_create_server_key(path):
+    """The server ECDH key pair kept in path, created the first time. Every worker process loads the same key"""
+    # the lock file stops two workers starting at the same time from creating two different keys
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            private_key, _ = generate_key_pair()
+            pem = private_key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption()
+            )
+            tmp = path + '.tmp'
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(pem)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+    with open(path, 'rb') as f:
+        private_key = serialization.load_pem_private_key(f.read(), password=None)
+    return private_key, private_key.public_key()
+
 def load_public_key(filename="public_key.pem"):
     with open(filename, "rb") as f:
         return serialization.load_pem_public_key(f.read())
@@ -0,0 +1,430 @@
+# benchmark.py - Load generator and benchmark for the HTTPS server
+# The old test.py timed one `python3 client.py` subprocess per message, so its ~0.6 s numbers were mostly interpreter
+# start-up, key generation and a fresh handshake. This drives the server's Flask app directly, in-process through
+# the Flask test client or over a local HTTPS socket, from many concurrent senders, and only times the requests.
+#
+# The database is a SQLite stand-in (sqlite_mysql.py) unless --mysql is given, then the server uses config.DB_CONFIG
+# (a benchmark user is added to the users table and the records really go to the data table). With --storage the
+# server uses its own SQLite or columnar storage backend instead (see sever/storage.py).
+#
+# Scenarios, the same ones as the old CSV files:
+#   db / files       valid records (payloads.txt) or records with wrong keys (payloads2.txt, they go to the dead letters)
+#   no_signature     messages are not signed
+#   no_token         the cached token verdict is used, otherwise every request pays PBKDF2 + the users query
+#
+# Examples:
+#   python3 benchmark.py                                      # every scenario, in-process, 500 requests, 8 senders
+#   python3 benchmark.py --transport https --concurrency 32 --requests 2000
+#   python3 benchmark.py --scenario db --save-baseline baseline.json
+#   python3 benchmark.py --baseline baseline.json             # exit code 1 if a scenario got slower
+#   python3 benchmark.py --overload 10                        # a flooding client next to a polite one, admission off / on
+
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import argparse
+import shutil
+import tempfile
+import ipaddress
+import threading
+from datetime import date, datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+TEST_FOLDER = os.path.dirname(os.path.abspath(__file__))
+SERVER_FOLDER = os.path.join(os.path.dirname(TEST_FOLDER), 'sever')
+
+SCENARIOS = [(target, sign, token) for target in ('db', 'files') for sign in (True, False) for token in (True, False)]
+# latency histogram buckets, in ms
+BUCKETS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+def scenario_name(target, sign, token):
+    return target + ('' if sign else '_no_signature') + ('' if token else '_no_token')
+
+def load_payloads(path):
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def percentile(sorted_values, pct):
+    # nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+def histogram(latencies_ms):
+    counts = [0] * (len(BUCKETS) + 1)
+    for value in latencies_ms:
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+    labels = [f'<={bound}ms' for bound in BUCKETS] + [f'>{BUCKETS[-1]}ms']
+    return dict(zip(labels, counts))
+
+
+class InProcess:
+    """Requests go straight to the WSGI app through the Flask test client (one per sender thread)"""
+    name = 'in-process'
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def post(self, path, body, headers):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.post(path, data=body, headers=headers)
+        return response.status_code, response.get_json(silent=True)
+
+    def close(self):
+        pass
+
+
+class OverHTTPS:
+    """Requests go over TLS to the app served by werkzeug on a local port, on keep-alive connections"""
+    name = 'https'
+
+    def __init__(self, app, folder, concurrency):
+        import logging
+        import requests
+        from requests.adapters import HTTPAdapter
+        from werkzeug.serving import make_server
+        # no access log line per request
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        cert, key = self._self_signed(folder)
+        self.server = make_server('127.0.0.1', 0, app, threaded=True, ssl_context=(cert, key))
+        self.url = f'https://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        # the werkzeug server closes the connection after every request, so each one pays a TLS handshake like
+        # with the real server
+        self.http = requests.Session()
+        self.http.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+        # trust only our certificate (and don't let REQUESTS_CA_BUNDLE & co load a whole CA bundle per connection)
+        self.http.trust_env = False
+        self.http.verify = cert
+
+    @staticmethod
+    def _self_signed(folder):
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+        now = datetime.now(timezone.utc)
+        cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+                .serial_number(x509.random_serial_number()).not_valid_before(now).not_valid_after(now + timedelta(days=1))
+                .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]), critical=False)
+                .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+                .sign(key, hashes.SHA256()))
+        cert_path = os.path.join(folder, 'cert.pem')
+        key_path = os.path.join(folder, 'key.pem')
+        with open(cert_path, 'wb') as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+        with open(key_path, 'wb') as f:
+            f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                      serialization.NoEncryption()))
+        return cert_path, key_path
+
+    def post(self, path, body, headers):
+        response = self.http.post(self.url + path, data=body, headers=headers)
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, None
+
+    def close(self):
+        self.server.shutdown()
+
+
+class BenchClient:
+    """Just enough of SecureHTTPSClient to build envelopes, so the timed part is only the request"""
+    def __init__(self, transport, wire, client_id, token, signing_key):
+        self.transport = transport
+        self.wire = wire
+        self.client_id = client_id
+        self.token = token
+        self.signing_key = signing_key
+        self.key = None
+        self.headers = {'X-Client-ID': client_id, 'token': token, 'Content-Type': wire.CONTENT_TYPE}
+
+    def handshake(self):
+        private_key = ec.generate_private_key(ec.SECP256R1())
+        public_pem = private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode()
+        body = json.dumps({'client_id': self.client_id, 'public_key': public_pem}).encode()
+        status, data = self.transport.post('/api/key_exchange', body, {'Content-Type': 'application/json'})
+        if status != 200:
+            raise RuntimeError(f'Key exchange failed: {status} {data}')
+        server_key = serialization.load_pem_public_key(data['public_key'].encode())
+        self.key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                        info=b'handshake data').derive(private_key.exchange(ec.ECDH(), server_key))
+
+    def envelope(self, record, sign):
+        plaintext = json.dumps(record).encode('utf-8')
+        nonce = os.urandom(12)
+        ciphertext = AESGCM(self.key).encrypt(nonce, plaintext, None)
+        signature = self.signing_key.sign(plaintext, ec.ECDSA(hashes.SHA256())) if sign else b''
+        return self.wire.pack_envelope(nonce, ciphertext, signature)
+
+
+def setup_server(work_folder, use_mysql, backend=None):
+    """Imports the server inside work_folder (it creates its folders in the current directory) and registers a client"""
+    os.chdir(work_folder)
+    sys.path.insert(0, SERVER_FOLDER)
+    if backend:
+        os.environ['STORAGE_BACKEND'] = backend
+    elif not use_mysql:
+        import sqlite_mysql
+        sqlite_mysql.install(os.path.join(work_folder, 'bench.db'))
+    # one client sending as fast as it can, the per-client rate limit would only measure itself (see --overload)
+    os.environ.setdefault('CLIENT_RATE', '0')
+    import https_server
+    import wire
+
+    client_id, token, signing_key = register_client(https_server)
+    return https_server, wire, client_id, token, signing_key
+
+def register_client(server):
+    from tools import generate_token, hash_token
+    client_id = str(uuid.uuid4())
+    token = generate_token()
+    server.storage.add_user(client_id, hash_token(token, client_id[:16]), date.today(), date.today() + timedelta(days=1))
+    signing_key = ec.generate_private_key(ec.SECP256R1())
+    with open(os.path.join(server.KEY_FOLDER, f'{client_id}_public_key.pem'), 'wb') as f:
+        f.write(signing_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo))
+    return client_id, token, signing_key
+
+def run_scenario(server, client, payloads, target, sign, token, requests, concurrency, warmup):
+    from auth_cache import AuthCache
+    cached = server.auth_cache
+    if token:
+        # entries expire as soon as they are stored: every request goes through PBKDF2 and the users query
+        server.auth_cache = AuthCache(ttl=0)
+    expected = 200 if target == 'db' else 400
+
+    # envelopes are built up front, only the requests are timed
+    envelopes = [client.envelope(payloads[i % len(payloads)], sign) for i in range(warmup + requests)]
+
+    def send(body):
+        start = time.perf_counter()
+        status, _ = client.transport.post('/api/upload', body, client.headers)
+        return status, (time.perf_counter() - start) * 1000
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(send, envelopes[:warmup]))
+            start = time.perf_counter()
+            results = list(pool.map(send, envelopes[warmup:]))
+            elapsed = time.perf_counter() - start
+    finally:
+        server.auth_cache = cached
+
+    latencies = sorted(latency for _, latency in results)
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'scenario': scenario_name(target, sign, token),
+        'requests': requests,
+        'concurrency': concurrency,
+        'unexpected': sum(count for status, count in statuses.items() if status != str(expected)),
+        'statuses': statuses,
+        'elapsed': round(elapsed, 3),
+        'throughput': round(requests / elapsed, 1) if elapsed else 0.0,
+        'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p90_ms': round(percentile(latencies, 90), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'max_ms': round(latencies[-1], 3) if latencies else 0.0,
+        'histogram': histogram(latencies),
+    }
+
+def run_overload(server, noisy, polite, payloads, seconds, senders, admission, interval=0.1):
+    """noisy sends from `senders` threads as fast as it can (ignoring Retry-After) while polite sends one request
+    every interval seconds. Returns the latencies of polite and the answers both got"""
+    cached = server.admission
+    server.admission = admission
+    envelopes = [noisy.envelope(payloads[i % len(payloads)], True) for i in range(200)]
+    stop = threading.Event()
+    noisy_statuses = {}
+    lock = threading.Lock()
+
+    def flood(n):
+        i = n
+        while not stop.is_set():
+            status, _ = noisy.transport.post('/api/upload', envelopes[i % len(envelopes)], noisy.headers)
+            i += 1
+            with lock:
+                noisy_statuses[str(status)] = noisy_statuses.get(str(status), 0) + 1
+
+    latencies = []
+    polite_statuses = {}
+    threads = [threading.Thread(target=flood, args=(n,)) for n in range(senders)]
+    try:
+        for thread in threads:
+            thread.start()
+        end = time.perf_counter() + seconds
+        i = 0
+        while time.perf_counter() < end:
+            body = polite.envelope(payloads[i % len(payloads)], True)
+            i += 1
+            start = time.perf_counter()
+            status, _ = polite.transport.post('/api/upload', body, polite.headers)
+            latency = time.perf_counter() - start
+            polite_statuses[str(status)] = polite_statuses.get(str(status), 0) + 1
+            if status == 200:
+                latencies.append(latency * 1000)
+            time.sleep(max(0.0, interval - latency))
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        server.admission = cached
+
+    latencies.sort()
+    return {
+        'polite_statuses': polite_statuses,
+        'polite_p50_ms': round(percentile(latencies, 50), 3),
+        'polite_p99_ms': round(percentile(latencies, 99), 3),
+        'polite_max_ms': round(latencies[-1], 3) if latencies else 0.0,
+        'noisy_statuses': noisy_statuses,
+        'noisy_per_second': round(noisy_statuses.get('200', 0) / seconds, 1),
+    }
+
+def overload(server, wire, client, payloads, seconds, senders):
+    """The same flood with admission control off and on"""
+    from admission import Admission
+    import config
+    polite = BenchClient(client.transport, wire, *register_client(server))
+    polite.handshake()
+    results = {}
+    for name, admission in (('off', Admission(max_inflight=0, client_rate=0, key_exchange_rate=0)),
+                            ('on', Admission(max_inflight=config.MAX_INFLIGHT,
+                                             low_priority_share=config.LOW_PRIORITY_SHARE,
+                                             client_rate=float(os.environ.get('OVERLOAD_CLIENT_RATE', 100)),
+                                             client_burst=config.CLIENT_BURST))):
+        result = run_overload(server, client, polite, payloads, seconds, senders, admission)
+        results[name] = result
+        print(f"\nadmission {name}: polite client p50 {result['polite_p50_ms']} ms, p99 {result['polite_p99_ms']} ms, "
+              f"max {result['polite_max_ms']} ms, answers {result['polite_statuses']}")
+        print(f"  flooding client: {result['noisy_per_second']} stored/s, answers {result['noisy_statuses']}")
+    return results
+
+def print_result(result):
+    print(f"\n{result['scenario']}: {result['throughput']} req/s, mean {result['mean_ms']} ms, "
+          f"p50 {result['p50_ms']} ms, p90 {result['p90_ms']} ms, p99 {result['p99_ms']} ms, max {result['max_ms']} ms")
+    if result['unexpected']:
+        print(f"  unexpected answers: {result['statuses']}")
+    largest = max(result['histogram'].values()) or 1
+    for label, count in result['histogram'].items():
+        if count:
+            print(f"  {label:>10} {count:>7} {'#' * max(1, round(40 * count / largest))}")
+
+def compare(results, baseline, tolerance):
+    """Prints each scenario against the baseline, returns the names of the ones that got slower"""
+    regressions = []
+    print(f"\nAgainst the baseline (tolerance {tolerance:.0%}):")
+    for result in results:
+        before = baseline.get(result['scenario'])
+        if before is None:
+            print(f"  {result['scenario']}: not in the baseline")
+            continue
+        throughput = result['throughput'] / before['throughput'] - 1 if before['throughput'] else 0.0
+        p99 = result['p99_ms'] / before['p99_ms'] - 1 if before['p99_ms'] else 0.0
+        slower = throughput < -tolerance or p99 > tolerance
+        if slower:
+            regressions.append(result['scenario'])
+        print(f"  {result['scenario']}: throughput {throughput:+.1%}, p99 {p99:+.1%}{'  REGRESSION' if slower else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the HTTPS server upload path')
+    parser.add_argument('--transport', choices=['inprocess', 'https'], default='inprocess',
+                        help='Flask test client or a local HTTPS socket')
+    parser.add_argument('--requests', type=int, default=500, help='Timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20, help='Untimed requests before each scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent senders')
+    parser.add_argument('--scenario', action='append', help='Only run these scenarios (repeatable), e.g. db, files_no_token')
+    parser.add_argument('--mysql', action='store_true', help='Use the MySQL server of config.py instead of SQLite')
+    parser.add_argument('--storage', choices=['sqlite', 'columnar'], help="Use the server's own SQLite or columnar storage backend")
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--save-baseline', help='Store the results as the baseline in this file')
+    parser.add_argument('--baseline', help='Compare against the baseline in this file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown against the baseline (0.25 = 25%%)')
+    parser.add_argument('--keep', action='store_true', help="Don't delete the work folder (database, dead letters) at the end")
+    parser.add_argument('--overload', type=float, metavar='SECONDS',
+                        help='Instead of the scenarios: one client floods the server from 4x --concurrency senders while '
+                             'another sends 10 req/s, with admission control off and on (OVERLOAD_CLIENT_RATE, default 100/s)')
+    args = parser.parse_args()
+
+    # paths given on the command line are relative to where we were started, not to the work folder
+    for option in ('output', 'save_baseline', 'baseline'):
+        if getattr(args, option):
+            setattr(args, option, os.path.abspath(getattr(args, option)))
+    good = load_payloads(os.path.join(TEST_FOLDER, 'payloads.txt'))
+    bad = load_payloads(os.path.join(TEST_FOLDER, 'payloads2.txt'))
+
+    work_folder = tempfile.mkdtemp(prefix='https_bench_')
+    server, wire, client_id, token, signing_key = setup_server(work_folder, args.mysql, args.storage)
+    if args.transport == 'https':
+        # the flood of --overload has 4x more senders, and the polite client one more
+        transport = OverHTTPS(server.app, work_folder, args.concurrency * (4 if args.overload else 1) + 1)
+    else:
+        transport = InProcess(server.app)
+    client = BenchClient(transport, wire, client_id, token, signing_key)
+    client.handshake()
+
+    database = args.storage or ('MySQL' if args.mysql else 'SQLite')
+    print(f"Benchmark: {transport.name}, {database}, {args.concurrency} senders, "
+          f"{args.requests} requests per scenario (work folder {work_folder})")
+    results = []
+    try:
+        if args.overload:
+            overloaded = overload(server, wire, client, good, args.overload, args.concurrency * 4)
+        for target, sign, with_token in ([] if args.overload else SCENARIOS):
+            name = scenario_name(target, sign, with_token)
+            if args.scenario and name not in args.scenario:
+                continue
+            result = run_scenario(server, client, good if target == 'db' else bad, target, sign, with_token,
+                                  args.requests, args.concurrency, args.warmup)
+            print_result(result)
+            results.append(result)
+    finally:
+        transport.close()
+        os.chdir(TEST_FOLDER)
+        if not args.keep:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(overloaded if args.overload else results, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({result['scenario']: result for result in results}, f, indent=2)
+        print(f"\nBaseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\nSlower than the baseline: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+# sqlite_mysql.py - SQLite stand-in for mysql.connector, for benchmarks and tests without a MySQL server
+# install() replaces mysql.connector.connect, after that the server code (pool, auth, inserts, dead-letter replay...)
+# runs unchanged against a local SQLite file. It only speaks the SQL the server uses: %s placeholders, dictionary
+# and prepared cursors, and the INFORMATION_SCHEMA query of schema.py.
+
+import re
+import sqlite3
+from datetime import date, datetime
+import mysql.connector
+from mysql.connector import errorcode
+
+# project_CSS.sql in SQLite syntax. The MySQL column types are kept, schema.py reads them back
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS data (
+  ID integer PRIMARY KEY AUTOINCREMENT,
+  FirstName varchar(50) NOT NULL,
+  LastName varchar(50) NOT NULL,
+  Age int(3) NOT NULL,
+  hight float NOT NULL,
+  Address varchar(200) NOT NULL,
+  Comments text NOT NULL,
+  date date NOT NULL DEFAULT CURRENT_DATE,
+  updated timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  user varchar(128) NOT NULL
+);
+CREATE INDEX IF NOT EXISTS user_date ON data (user, date);
+CREATE TABLE IF NOT EXISTS users (
+  ID integer PRIMARY KEY AUTOINCREMENT,
+  userid varchar(36) NOT NULL,
+  token varchar(128) NOT NULL,
+  created date NOT NULL,
+  until date NOT NULL,
+  valid tinyint(1) NOT NULL DEFAULT 1,
+  accessed timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE UNIQUE INDEX IF NOT EXISTS userid ON users (userid);
+CREATE TABLE IF NOT EXISTS dead_letter_replayed (
+  record_id char(32) NOT NULL PRIMARY KEY,
+  replayed timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS ingest_checkpoint (
+  queue varchar(64) NOT NULL PRIMARY KEY,
+  segment varchar(64) NOT NULL,
+  position bigint NOT NULL
+);
+"""
+
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('date', lambda value: date.fromisoformat(value.decode()))
+sqlite3.register_converter('timestamp', lambda value: datetime.fromisoformat(value.decode()))
+
+TYPE = re.compile(r'^(\w+)(?:\((\d+)\))?')
+
+
+def _error(e):
+    # turn SQLite errors into the mysql.connector ones the server code expects
+    message = str(e)
+    if 'no such column' in message or 'has no column named' in message:
+        return mysql.connector.errors.ProgrammingError(msg=message, errno=errorcode.ER_BAD_FIELD_ERROR)
+    if isinstance(e, sqlite3.IntegrityError):
+        return mysql.connector.errors.IntegrityError(msg=message, errno=errorcode.ER_BAD_NULL_ERROR)
+    if 'locked' in message or 'busy' in message:
+        return mysql.connector.errors.OperationalError(msg=message)
+    return mysql.connector.errors.ProgrammingError(msg=message)
+
+
+class Cursor:
+    def __init__(self, db, dictionary=False):
+        self._cursor = db.cursor()
+        self._dictionary = dictionary
+        self._rows = None
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def execute(self, operation, params=()):
+        if 'INFORMATION_SCHEMA.COLUMNS' in operation:
+            return self._columns(params[0])
+        try:
+            self._cursor.execute(operation.replace('%s', '?'), tuple(params or ()))
+        except sqlite3.Error as e:
+            raise _error(e)
+        self.rowcount = self._cursor.rowcount
+        self.lastrowid = self._cursor.lastrowid
+        self._rows = None
+
+    def executemany(self, operation, seq_params):
+        try:
+            self._cursor.executemany(operation.replace('%s', '?'), [tuple(params) for params in seq_params])
+        except sqlite3.Error as e:
+            raise _error(e)
+        self.rowcount = self._cursor.rowcount
+
+    def _columns(self, table):
+        # answers schema.py's INFORMATION_SCHEMA query from PRAGMA table_info
+        rows = []
+        for cid, name, declared, notnull, default, pk in self._cursor.execute(f'PRAGMA table_info({table})').fetchall():
+            match = TYPE.match(declared.lower())
+            data_type, length = match.group(1), match.group(2)
+            extra = 'auto_increment' if pk and data_type == 'integer' else ''
+            max_length = int(length) if length and data_type in ('char', 'varchar') else None
+            if data_type == 'text':
+                max_length = 65535
+            rows.append((name, 'int' if data_type == 'integer' else data_type, 'NO' if notnull or pk else 'YES',
+                         default, extra, max_length))
+        self._rows = rows
+        self.rowcount = len(rows)
+
+    def fetchall(self):
+        rows = self._rows if self._rows is not None else self._cursor.fetchall()
+        self._rows = []
+        if self._dictionary and rows:
+            names = [column[0] for column in self._cursor.description]
+            return [dict(zip(names, row)) for row in rows]
+        return rows
+
+    def fetchmany(self, size=1):
+        if self._rows is not None:
+            rows, self._rows = self._rows[:size], self._rows[size:]
+        else:
+            rows = self._cursor.fetchmany(size)
+        if self._dictionary and rows:
+            names = [column[0] for column in self._cursor.description]
+            return [dict(zip(names, row)) for row in rows]
+        return rows
+
+    def fetchone(self):
+        rows = self.fetchall()
+        return rows[0] if rows else None
+
+    def close(self):
+        self._cursor.close()
+
+
+class Connection:
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+
+    def cursor(self, dictionary=False, prepared=False, **kwargs):
+        return Cursor(self._db, dictionary)
+
+    def commit(self):
+        try:
+            self._db.commit()
+        except sqlite3.Error as e:
+            raise _error(e)
+
+    def rollback(self):
+        self._db.rollback()
+
+    @property
+    def in_transaction(self):
+        return self._db.in_transaction
+
+    def is_connected(self):
+        return True
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        pass
+
+    def close(self):
+        self._db.close()
+
+
+def create(path):
+    """Creates the project tables in the SQLite file (if they aren't there yet)"""
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    db.close()
+
+def install(path):
+    """Every mysql.connector.connect() from now on opens the SQLite file instead"""
+    create(path)
+    mysql.connector.connect = lambda **kwargs: Connection(path)
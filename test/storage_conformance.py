@@ -0,0 +1,295 @@
+# storage_conformance.py - The same checks and throughput numbers for every storage backend (sever/storage.py)
+# Each backend is opened in a temporary folder and has to behave like the others: users (lookup, expiry,
+# revocation), inserts, refused records, batches with bad records in them, paging through reads with filters,
+# unique IDs with many writers and everything still there after a restart. Then single inserts (from several
+# threads), batch inserts and reads are timed.
+#
+# The mysql backend runs on the SQLite stand-in (sqlite_mysql.py) unless --mysql is given, then it uses
+# config.DB_CONFIG (the checks only add users and records with random client ids, and read those back).
+#
+# Examples:
+#   python3 storage_conformance.py                                 # mysql (stand-in), sqlite and columnar
+#   python3 storage_conformance.py --backend columnar --rows 20000
+#   python3 storage_conformance.py --backend mysql --mysql
+
+import os
+import sys
+import time
+import uuid
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from datetime import date, datetime, timedelta
+
+TEST_FOLDER = os.path.dirname(os.path.abspath(__file__))
+SERVER_FOLDER = os.path.join(os.path.dirname(TEST_FOLDER), 'sever')
+sys.path.insert(0, SERVER_FOLDER)
+
+import config
+import records
+from schema import InsertPlanner, SchemaError
+from storage import MySQLStorage
+
+BACKENDS = ['mysql', 'sqlite', 'columnar']
+
+
+def open_backend(name, folder, use_mysql):
+    if name == 'mysql':
+        if not use_mysql:
+            import sqlite_mysql
+            sqlite_mysql.install(os.path.join(folder, 'mysql.db'))
+        return MySQLStorage(config.DB_CONFIG, InsertPlanner('data'), size=16)
+    if name == 'sqlite':
+        from sqlite_storage import SQLiteStorage
+        return SQLiteStorage(os.path.join(folder, 'storage.db'))
+    from columnar_storage import ColumnarStorage
+    return ColumnarStorage(os.path.join(folder, 'columnar'), linger=0.002)
+
+def new_client():
+    return str(uuid.uuid4())
+
+def make_record(client_id, i, day=None):
+    record = {'FirstName': f'First{i}', 'LastName': 'Last', 'Age': 20 + i % 50, 'hight': 1.5 + (i % 50) / 100,
+              'Address': 'somewhere under the rainbow', 'Comments': f'record {i}', 'user': client_id}
+    if day is not None:
+        record['date'] = day
+    return record
+
+def read_all(storage, client_id, limit=7, **filters):
+    """Every record of a client, reading page after page like GET /api/records does"""
+    rows = []
+    after = None
+    while True:
+        page = dict(filters, limit=limit)
+        if after:
+            page['after'] = after
+        got = list(storage.read(client_id, page))
+        rows.extend(got[:limit])
+        if len(got) <= limit:
+            return rows
+        # through the cursor encoding, like a client would send it back
+        after = records.decode_cursor(records.encode_cursor(got[limit - 1]))
+
+
+class Checks:
+    def __init__(self, backend):
+        self.backend = backend
+        self.failed = []
+        self.passed = 0
+
+    def expect(self, condition, name, detail=''):
+        if condition:
+            self.passed += 1
+        else:
+            self.failed.append(name)
+            print(f"  FAIL {self.backend}: {name} {detail}")
+
+    def raises(self, error, name, fn, *args):
+        try:
+            fn(*args)
+        except error:
+            self.passed += 1
+            return
+        except Exception as e:
+            self.failed.append(name)
+            print(f"  FAIL {self.backend}: {name} raised {type(e).__name__}: {e}")
+            return
+        self.failed.append(name)
+        print(f"  FAIL {self.backend}: {name} didn't raise {error.__name__}")
+
+
+def check_users(storage, checks):
+    today = date.today()
+    until = today + timedelta(days=365)
+    client_id = new_client()
+    checks.expect(storage.find_user(client_id) is None, 'unknown user is not found')
+    storage.add_user(client_id, 'token-hash', today, until)
+    user = storage.find_user(client_id)
+    checks.expect(user is not None and user['token'] == 'token-hash' and user['until'] == until,
+                  'added user is found', repr(user))
+    if user:
+        storage.expire_user(user['ID'])
+    checks.expect(storage.find_user(client_id) is None, 'expired user is not found')
+
+    revoked = new_client()
+    storage.add_user(revoked, 'token-hash', today, until)
+    checks.expect(storage.revoke_user(revoked) == 1, 'revoke counts the tokens')
+    checks.expect(storage.find_user(revoked) is None, 'revoked user is not found')
+    checks.expect(storage.revoke_user(new_client()) == 0, 'revoking an unknown client revokes nothing')
+    # userid is unique, a new token for a revoked client goes in its old row
+    storage.add_user(revoked, 'new-hash', today, until)
+    user = storage.find_user(revoked)
+    checks.expect(user is not None and user['token'] == 'new-hash', 'a revoked client gets a new token', repr(user))
+    checks.expect(storage.revoke_user(revoked) == 1, 'a client id is only added once')
+
+    # kept for the restart check
+    keeper = new_client()
+    storage.add_user(keeper, 'keeper-hash', today, until)
+    return keeper
+
+def check_inserts(storage, checks):
+    client_id = new_client()
+    storage.insert(make_record(client_id, 1))
+    rows = read_all(storage, client_id)
+    checks.expect(len(rows) == 1, 'inserted record is read back', f'({len(rows)} rows)')
+    if rows:
+        row = rows[0]
+        checks.expect(row['FirstName'] == 'First1' and row['Age'] == 21 and abs(row['hight'] - 1.51) < 1e-6,
+                      'values come back as they went in', repr(row))
+        checks.expect(isinstance(row['ID'], int) and row['date'] == date.today() and row['updated'] is not None,
+                      'ID, date and updated are filled in', repr(row))
+    checks.expect(read_all(storage, new_client()) == [], "a client doesn't see the records of another one")
+
+    bad = {
+        'unknown column': dict(make_record(client_id, 2), PersonAge=56),
+        'missing column': {k: v for k, v in make_record(client_id, 3).items() if k != 'Age'},
+        'wrong type': dict(make_record(client_id, 4), Age='old'),
+        'too long': dict(make_record(client_id, 5), FirstName='x' * 51),
+        'null': dict(make_record(client_id, 6), LastName=None),
+    }
+    for name, record in bad.items():
+        checks.raises(SchemaError, f'{name} is refused', storage.insert, record)
+        checks.raises(SchemaError, f'{name} is refused by check', storage.check, record)
+    checks.expect(len(read_all(storage, client_id)) == 1, 'refused records are not written')
+
+    batch = [make_record(client_id, 10), bad['unknown column'], make_record(client_id, 11), bad['missing column'],
+             make_record(client_id, 12)]
+    failed = storage.insert_many(batch)
+    checks.expect([index for index, reason in failed] == [1, 3], 'batch reports the bad records', repr(failed))
+    checks.expect(len(read_all(storage, client_id)) == 4, 'batch writes the good records once')
+
+def check_reads(storage, checks):
+    client_id = new_client()
+    first_day = date.today() - timedelta(days=10)
+    batch = [make_record(client_id, i, first_day + timedelta(days=i % 5)) for i in range(45)]
+    random.shuffle(batch)
+    checks.expect(storage.insert_many(batch) == [], 'batch of good records is written')
+
+    rows = read_all(storage, client_id)
+    keys = [(row['date'], row['ID']) for row in rows]
+    checks.expect(len(rows) == 45, 'pages add up to every record', f'({len(rows)} rows)')
+    checks.expect(keys == sorted(keys), 'records are ordered by date and ID')
+    checks.expect(len({row['ID'] for row in rows}) == 45, 'no record is read twice')
+
+    ranged = read_all(storage, client_id, date_from=first_day + timedelta(days=1), date_to=first_day + timedelta(days=3))
+    checks.expect(len(ranged) == 27 and all(first_day < row['date'] < first_day + timedelta(days=4) for row in ranged),
+                  'date_from / date_to', f'({len(ranged)} rows)')
+    checks.expect(read_all(storage, client_id, updated_since=datetime.now() + timedelta(days=1)) == [],
+                  'updated_since in the future finds nothing')
+    checks.expect(len(read_all(storage, client_id, updated_since=datetime.now() - timedelta(days=1))) == 45,
+                  'updated_since in the past finds everything')
+    one_page = list(storage.read(client_id, {'limit': 1000}))
+    checks.expect(len(one_page) == 45, 'a page bigger than the records has them all')
+    return client_id
+
+def check_concurrency(storage, checks, threads=8, per_thread=50):
+    client_id = new_client()
+    errors = []
+
+    def writer(n):
+        try:
+            for i in range(per_thread):
+                storage.insert(make_record(client_id, n * per_thread + i))
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=writer, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    rows = read_all(storage, client_id, limit=100)
+    checks.expect(not errors, 'concurrent inserts succeed', repr(errors[:1]))
+    checks.expect(len(rows) == threads * per_thread, 'concurrent inserts are all written', f'({len(rows)} rows)')
+    checks.expect(len({row['ID'] for row in rows}) == len(rows), 'concurrent inserts get unique IDs')
+
+def check_restart(name, folder, use_mysql, keeper, read_client, checks):
+    storage = open_backend(name, folder, use_mysql)
+    try:
+        checks.expect(storage.find_user(keeper) is not None, 'users are still there after a restart')
+        checks.expect(len(read_all(storage, read_client)) == 45, 'records are still there after a restart')
+        storage.insert(make_record(read_client, 99))
+        rows = read_all(storage, read_client)
+        checks.expect(len({row['ID'] for row in rows}) == 46, 'IDs stay unique after a restart')
+    finally:
+        storage.close()
+
+
+def throughput(storage, rows, threads=8, batch_size=500):
+    results = {}
+    client_id = new_client()
+    per_thread = max(1, rows // threads)
+
+    def writer(n):
+        for i in range(per_thread):
+            storage.insert(make_record(client_id, n * per_thread + i))
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=writer, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    results['insert'] = per_thread * threads / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for offset in range(0, rows, batch_size):
+        storage.insert_many([make_record(client_id, i) for i in range(offset, min(rows, offset + batch_size))])
+    results['insert_many'] = rows / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    read = len(read_all(storage, client_id, limit=1000))
+    results['read'] = read / (time.perf_counter() - start)
+    return results
+
+def run_backend(name, rows, use_mysql):
+    folder = tempfile.mkdtemp(prefix=f'storage_{name}_')
+    checks = Checks(name)
+    try:
+        storage = open_backend(name, folder, use_mysql)
+        try:
+            keeper = check_users(storage, checks)
+            check_inserts(storage, checks)
+            read_client = check_reads(storage, checks)
+            check_concurrency(storage, checks)
+        finally:
+            storage.close()
+        check_restart(name, folder, use_mysql, keeper, read_client, checks)
+
+        storage = open_backend(name, folder, use_mysql)
+        try:
+            numbers = throughput(storage, rows)
+        finally:
+            storage.close()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return checks, numbers
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Conformance checks and throughput of the storage backends')
+    parser.add_argument('--backend', action='append', choices=BACKENDS, help='Only these backends (repeatable)')
+    parser.add_argument('--rows', type=int, default=5000, help='Records written and read for the throughput numbers')
+    parser.add_argument('--mysql', action='store_true', help='Use the MySQL server of config.py for the mysql backend')
+    args = parser.parse_args()
+
+    failed = False
+    summary = []
+    for name in args.backend or BACKENDS:
+        print(f"{name}:")
+        checks, numbers = run_backend(name, args.rows, args.mysql)
+        print(f"  {checks.passed} checks passed, {len(checks.failed)} failed")
+        print('  ' + ', '.join(f'{key} {value:.0f} rows/s' for key, value in numbers.items()))
+        failed = failed or bool(checks.failed)
+        summary.append((name, numbers))
+
+    print(f"\n{'backend':<10} {'insert':>12} {'insert_many':>12} {'read':>12}   (rows/s, {args.rows} rows)")
+    for name, numbers in summary:
+        print(f"{name:<10} {numbers['insert']:>12.0f} {numbers['insert_many']:>12.0f} {numbers['read']:>12.0f}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()